@@ -1,40 +1,102 @@
 from flask import Flask, request, abort
-from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.exc import IntegrityError, OperationalError
+import click
+import csv
+import io
+import os
 import json
-from jsonschema import validate, ValidationError
-from sqlalchemy.engine import Engine
-from sqlalchemy import event
-
-from flask import Flask, Response, url_for
+import copy
+import functools
+import re
+from sqlalchemy import and_, event, func, select, tuple_
+from sqlalchemy.orm import Load, contains_eager, selectinload
+
+from flask import Flask, Response, current_app, send_from_directory, url_for, stream_with_context
+from flask.cli import with_appcontext
 from flask_restful import Api, Resource
-import os
-import tempfile
+import base64
 from datetime import date, time
-from flask_cors import CORS
+
+from asgi import ASGIAdapter
+from compression import COMPRESSIBLE, coding_etag, compress, etag_variants, negotiate
+from schemas import SchemaRegistry, ValidationError
+from search import (
+    install_track_fts, lyrics_snippet, mark_snippet, match_expression, matches, rank, rebuild_track_fts,
+    track_fts
+)
+from metrics import PROMETHEUS, MetricsMiddleware, RequestMetrics, install_sql_timing
+from profiling import PSTATS, ProfilingMiddleware, list_profiles, token_allowed
+from serialization import dumps
+from slowlog import SlowQueryLog
+from storage import StorageSQLAlchemy, add_engine_hook
+from versioning import VersionCounters
+from cache import ResponseCache
 
 
 
 
 #sys.path.insert(0, '/home/kali/Documents/web/')
 #from masonbuilder import MasonBuilder
-app = Flask(__name__, static_folder="static")
-CORS(app)
-api = Api(app)
-
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///test.db"
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config['CORS_HEADERS'] = 'Content-Type'
-db = SQLAlchemy(app)
+db = StorageSQLAlchemy()
+api = Api()
+
+DEFAULT_CONFIG = {
+    "SQLALCHEMY_DATABASE_URI": "sqlite:///test.db",
+    "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+    # dev, production or bulk-load, see storage.PROFILES
+    "SQLITE_PROFILE": "production",
+    "SQLITE_PRAGMAS": {},
+    "CORS_ENABLED": True,
+    "CORS_HEADERS": "Content-Type",
+    # requests are profiled into PROFILE_DIR when it is set, see
+    # profiling.ProfilingMiddleware
+    "PROFILE_DIR": None,
+    "PROFILE_HEADER": "X-Profile",
+    "PROFILE_TOKENS": [],
+    "PROFILE_SAMPLE_RATE": 0.0,
+    "PROFILE_KEEP": 50,
+    # request and SQL metrics served at /metrics
+    "METRICS_ENABLED": True,
+    # statements slower than the threshold (in seconds) are logged to
+    # SLOW_QUERY_LOG when it is set, see slowlog.SlowQueryLog
+    "SLOW_QUERY_LOG": None,
+    "SLOW_QUERY_THRESHOLD": 0.1,
+    "SLOW_QUERY_LOG_MAX_BYTES": 10 * 1024 * 1024,
+    "SLOW_QUERY_LOG_BACKUPS": 5,
+    # requests handled at the same time by create_asgi_app
+    "ASGI_WORKERS": 8,
+    # responses of at least COMPRESSION_MIN_SIZE bytes are compressed with
+    # brotli or gzip as negotiated, levels by coding, see compression.py
+    "COMPRESSION_ENABLED": True,
+    "COMPRESSION_MIN_SIZE": 1024,
+    "COMPRESSION_LEVELS": {"br": 5, "gzip": 6},
+}
 
 
 MASON = "application/vnd.mason+json"
+NDJSON = "application/x-ndjson"
+CSV = "text/csv"
 CHOREOGRAPHY_PROFILE = "/profiles/choreography/"
 TRACK_PROFILE = "/profiles/track/"
 ALBUM_PROFILE = "/profiles/album/"
 ARTIST_PROFILE = "/profiles/artist/"
 ERROR_PROFILE = "/profiles/error/"
 LINK_RELATIONS_URL = "/instadium/link-relations/"
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 500
+RESPONSE_CACHE_MAX_ENTRIES = 4096
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+IMPORT_BATCH_SIZE = 5000
+# SQLite allows at most 999 bound parameters per statement in older versions
+LOOKUP_BATCH_SIZE = 500
+EXPORT_BATCH_SIZE = 500
+BATCH_MAX_REQUESTS = 50
+BATCH_METHODS = ["GET", "POST", "PUT", "PATCH", "DELETE"]
+# items of one bulk update or delete, so their ids are found with one query
+BULK_MAX_ITEMS = LOOKUP_BATCH_SIZE
+DATE_PATTERN = "^[0-9]{4}-[01][0-9]-[0-3][0-9]$"
+TIME_PATTERN = "^[0-9]{2}:[0-5][0-9]:[0-5][0-9]$"
 
 
 class Choreography(db.Model):
@@ -43,6 +105,8 @@ class Choreography(db.Model):
     description = db.Column(db.String(64), nullable=False)
     in_track = db.relationship('Track', back_populates='choreography')
 
+    sortfields = ["name"]
+
     @staticmethod
     def get_schema():
         schema = {
@@ -63,14 +127,21 @@ class Choreography(db.Model):
  
 class Track(db.Model):
     
-    __table_args__ = (db.UniqueConstraint("disc_number", "track_number", "album_id", name="_track_index_uc"), )
+    # column order follows the URL, so the constraint's index also serves
+    # lookups of all tracks of an album
+    __table_args__ = (
+        db.UniqueConstraint("album_id", "disc_number", "track_number", name="_track_index_uc"),
+        db.Index("ix_track_choreography_id", "choreography_id"),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String, nullable=False)
     disc_number = db.Column(db.Integer, default=1)
     track_number = db.Column(db.Integer, nullable=False)
     length = db.Column(db.Time, nullable=False)
-    lyrics = db.Column(db.String, nullable=False)
+    # lyrics can be long, they are only read by the lyrics sub resource,
+    # the export and when asked for with ?fields=
+    lyrics = db.deferred(db.Column(db.String, nullable=False))
     album_id = db.Column(db.ForeignKey("album.id", ondelete="CASCADE"), nullable=False)
     choreography_id = db.Column(db.ForeignKey("choreography.id", ondelete="CASCADE"), nullable=True)
     #artist_id = db.Column(db.ForeignKey("artist.id", ondelete="SET NULL"), nullable=False)
@@ -79,37 +150,79 @@ class Track(db.Model):
     #artist = db.relationship("Artist", back_populates="artist_track")
 
     def __repr__(self):
-        return "{} <{}> on {}".format(self.title, self.id, self.album.title)
+        return "{} <{}> on album <{}>".format(self.title, self.id, self.album_id)
     
     @staticmethod
     def get_schema():
         schema = {
             "type": "object",
-            "required": ["disc_number", "track_number", "album_id"]
+            "required": ["title", "disc_number", "track_number"]
         }
         props = schema["properties"] = {}
+        props["title"] = {
+            "description": "track title",
+            "type": "string"
+        }
         props["disc_number"] = {
             "description": "disc number",
-            "type": "number"
+            "type": "integer",
+            "minimum": 1
         }
         props["track_number"] = {
             "description": "track's number on the disc",
-            "type": "number"
+            "type": "integer",
+            "minimum": 1
+        }
+        props["length"] = {
+            "description": "track length",
+            "type": "string",
+            "pattern": TIME_PATTERN
+        }
+        props["lyrics"] = {
+            "description": "track lyrics",
+            "type": "string"
         }
         return schema
     
+class Genre(db.Model):
+    """
+    Normalized album genres. Albums keep the genre text they were given, and
+    are linked to the genre whose key is that text folded with fold_genre,
+    so that "Pop Rock" and " pop  rock" are the same genre. The link is kept
+    up to date by the Album mapper events below.
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String, nullable=False, unique=True)
+    name = db.Column(db.String, nullable=False)
+
+    albums = db.relationship("Album", back_populates="genre_ref")
+
+    def __repr__(self):
+        return "{} <{}>".format(self.key, self.id)
+
 class Album(db.Model):
     
-    __table_args__ = (db.UniqueConstraint("title", "artist_id", name="_artist_title_uc"), )
+    __table_args__ = (
+        # column order follows the URL, see Track
+        db.UniqueConstraint("artist_id", "title", name="_artist_title_uc"),
+        db.Index("ix_album_title_id", "title", "id"),
+        db.Index("ix_album_release_id", "release", "id"),
+        db.Index("ix_album_artist_id_id", "artist_id", "id"),
+        db.Index("ix_album_artist_id_release_id", "artist_id", "release", "id"),
+        db.Index("ix_album_genre_id_id", "genre_id", "id"),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String, nullable=False)
     release = db.Column(db.Date, nullable=False)
     artist_id = db.Column(db.ForeignKey("artist.id", ondelete="CASCADE"), nullable=True)
     genre = db.Column(db.String, nullable=True)
+    genre_id = db.Column(db.ForeignKey("genre.id"), nullable=True)
     discs = db.Column(db.Integer, default=1)
     
     artist = db.relationship("Artist", back_populates="albums")
+    genre_ref = db.relationship("Genre", back_populates="albums")
     #va_artists = db.relationship("Artist", secondary=va_artist_table)
     tracks = db.relationship("Track",
         cascade="all,delete",
@@ -133,10 +246,26 @@ class Album(db.Model):
             "description": "album title",
             "type": "string"
         }
+        props["release"] = {
+            "description": "release date",
+            "type": "string",
+            "pattern": DATE_PATTERN
+        }
+        props["genre"] = {
+            "description": "album genre",
+            "type": ["string", "null"]
+        }
+        props["discs"] = {
+            "description": "number of discs",
+            "type": "integer",
+            "minimum": 1
+        }
         return schema
 
 class Artist(db.Model):
     
+    __table_args__ = (db.Index("ix_artist_name_id", "name", "id"), )
+    
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
     unique_name = db.Column(db.String, nullable=False, unique=True)
@@ -144,6 +273,8 @@ class Artist(db.Model):
     
     albums = db.relationship("Album", cascade="all,delete", back_populates="artist")
 
+    sortfields = ["name", "unique_name"]
+
     def __repr__(self):
         return "{} <{}>".format(self.name, self.id)
 
@@ -165,6 +296,274 @@ class Artist(db.Model):
         return schema
 
 
+install_track_fts(Track.__table__)
+
+
+def fold_genre(name):
+    """
+    Returns the key of a genre: its words separated by single spaces and
+    case folded. Returns None for missing or blank genres.
+    """
+
+    if name is None:
+        return None
+    return " ".join(name.split()).casefold() or None
+
+def resolve_genres(connection, names):
+    """
+    Returns a dictionary from genre key to genre id for the given genre
+    names, inserting the genres that don't exist yet. New genres are named
+    after the first spelling seen.
+
+    : param connection: connection of the transaction to work in
+    """
+
+    new = {}
+    for name in names:
+        key = fold_genre(name)
+        if key is not None:
+            new.setdefault(key, " ".join(name.split()))
+    if not new:
+        return {}
+    table = Genre.__table__
+    connection.execute(table.insert().prefix_with("OR IGNORE"), [
+        {"key": key, "name": name} for key, name in new.items()
+    ])
+    keys = list(new)
+    ids = {}
+    for i in range(0, len(keys), LOOKUP_BATCH_SIZE):
+        ids.update(connection.execute(
+            select([table.c.key, table.c.id]).where(table.c.key.in_(keys[i:i + LOOKUP_BATCH_SIZE]))
+        ).fetchall())
+    return ids
+
+@event.listens_for(Album, "before_insert")
+@event.listens_for(Album, "before_update")
+def _link_genre(mapper, connection, target):
+    state = db.inspect(target)
+    if state.persistent and not state.attrs.genre.history.has_changes():
+        return
+    target.genre_id = resolve_genres(connection, [target.genre]).get(fold_genre(target.genre))
+
+schemas = SchemaRegistry()
+schemas.register(Choreography, Track, Album, Artist)
+
+
+def _import_schema(model, required, **properties):
+    """
+    Builds the schema of one bulk import record from the schema of its
+    model. Import records refer to other records by their natural keys
+    instead of database ids, so some properties are added or replaced.
+    """
+
+    schema = copy.deepcopy(model.get_schema())
+    schema["required"] = ["type"] + required
+    schema["properties"].update(properties)
+    schema["properties"]["type"] = {
+        "description": "record type",
+        "type": "string"
+    }
+    return schema
+
+IMPORT_MODELS = {
+    "choreography": Choreography,
+    "artist": Artist,
+    "album": Album,
+    "track": Track,
+}
+schemas.add(("import", "choreography"), _import_schema(Choreography, ["name", "description"]))
+schemas.add(("import", "artist"), _import_schema(Artist, ["name", "unique_name"]))
+schemas.add(("import", "album"), _import_schema(Album, ["title", "release", "artist"],
+    release={"description": "release date", "type": "string", "pattern": DATE_PATTERN},
+    artist={"description": "artist unique name", "type": "string"},
+    genre={"description": "album genre", "type": ["string", "null"]},
+    discs={"description": "number of discs", "type": "integer", "minimum": 1}
+))
+schemas.add(("import", "track"), _import_schema(Track, ["title", "track_number", "length", "lyrics", "artist", "album"],
+    title={"description": "track title", "type": "string"},
+    disc_number={"description": "disc number", "type": "integer", "minimum": 1},
+    track_number={"description": "track's number on the disc", "type": "integer", "minimum": 1},
+    length={"description": "track length", "type": "string", "pattern": TIME_PATTERN},
+    lyrics={"description": "track lyrics", "type": "string"},
+    artist={"description": "album artist unique name", "type": "string"},
+    album={"description": "album title", "type": "string"},
+    choreography={"description": "choreography name", "type": ["string", "null"]}
+))
+
+# Python types of the JSON types that _record_check understands
+JSON_TYPES = {
+    "string": (str,),
+    "integer": (int,),
+    "number": (int, float),
+    "null": (type(None),),
+}
+
+def _record_check(schema):
+    """
+    Returns a function telling whether a record matches a flat object
+    schema, much faster than jsonschema. Only required, additionalProperties
+    and the type, minimum and pattern of the properties are understood; for
+    any other keyword the function always returns False. A False result
+    only means the record must be validated with jsonschema, which also
+    explains what is wrong with it.
+    """
+
+    understood = {"type", "required", "properties", "additionalProperties", "description"}
+    if schema.get("type") != "object" or set(schema) - understood or any(
+        set(prop) - {"type", "minimum", "pattern", "description"}
+        or not set(prop.get("type") if isinstance(prop.get("type"), list) else [prop.get("type")]) <= set(JSON_TYPES)
+        for prop in schema["properties"].values()
+    ):
+        return lambda record: False
+
+    required = schema.get("required", [])
+    closed = schema.get("additionalProperties", True) is False
+    properties = {}
+    for name, prop in schema["properties"].items():
+        kinds = prop["type"] if isinstance(prop["type"], list) else [prop["type"]]
+        types = tuple(t for kind in kinds for t in JSON_TYPES[kind])
+        pattern = re.compile(prop["pattern"]) if "pattern" in prop else None
+        properties[name] = (types, prop.get("minimum"), pattern)
+
+    def check(record):
+        for name in required:
+            if name not in record:
+                return False
+        for name, value in record.items():
+            prop = properties.get(name)
+            if prop is None:
+                if closed:
+                    return False
+                continue
+            types, minimum, pattern = prop
+            # bool is an int in Python but not in JSON
+            if not isinstance(value, types) or value is True or value is False:
+                return False
+            if minimum is not None and isinstance(value, (int, float)) and value < minimum:
+                return False
+            if pattern is not None and isinstance(value, str) and not pattern.search(value):
+                return False
+        return True
+
+    return check
+
+IMPORT_CHECKS = {kind: _record_check(schemas.schema(("import", kind))) for kind in IMPORT_MODELS}
+schemas.add("batch", {
+    "type": "object",
+    "required": ["requests"],
+    "properties": {
+        "requests": {
+            "description": "requests to run in order",
+            "type": "array",
+            "minItems": 1,
+            "maxItems": BATCH_MAX_REQUESTS,
+            "items": {
+                "type": "object",
+                "required": ["method", "href"],
+                "properties": {
+                    "method": {"description": "HTTP method", "type": "string", "enum": BATCH_METHODS},
+                    "href": {"description": "path and query string", "type": "string", "pattern": "^/"},
+                    "body": {"description": "JSON document of the request"}
+                }
+            }
+        },
+        "atomic": {
+            "description": "roll back every write when a request fails",
+            "type": "boolean"
+        }
+    }
+})
+
+
+def _add_bulk_schemas(model, key):
+    """
+    Registers the schemas of bulk updates and deletes of a collection. Items
+    are addressed by the natural key in their URL, and the changes of an
+    item are like its PUT document with only the fields that change. The
+    schemas of single items are registered too, as items are validated one
+    by one.
+    """
+
+    changes = copy.deepcopy(model.get_schema())
+    del changes["required"]
+    changes["description"] = "fields to change"
+    # the changes are written to the columns as they are
+    changes["additionalProperties"] = False
+    changes["minProperties"] = 1
+    update = {
+        "type": "object",
+        "required": ["key", "changes"],
+        "properties": {"key": key, "changes": changes}
+    }
+    delete = {
+        "type": "object",
+        "required": ["key"],
+        "properties": {"key": key}
+    }
+    for kind, item in (("bulk-update", update), ("bulk-delete", delete)):
+        schemas.add((kind, model), {
+            "type": "object",
+            "required": ["items"],
+            "properties": {
+                "items": {
+                    "description": "items to change, in any order",
+                    "type": "array",
+                    "minItems": 1,
+                    "maxItems": BULK_MAX_ITEMS,
+                    "items": item
+                }
+            }
+        })
+        schemas.add((kind, "item", model), item)
+    schemas.add(("bulk-changes", model), changes)
+
+_add_bulk_schemas(Choreography, {"description": "choreography name", "type": "string"})
+_add_bulk_schemas(Artist, {"description": "artist unique name", "type": "string"})
+_add_bulk_schemas(Album, {
+    "description": "album artist unique name and title",
+    "type": "object",
+    "required": ["artist", "title"],
+    "properties": {
+        "artist": {"description": "artist unique name", "type": "string"},
+        "title": {"description": "album title", "type": "string"}
+    }
+})
+schemas.add("bulk", {
+    "type": "object",
+    "required": ["items"],
+    "properties": {
+        "items": {"type": "array", "minItems": 1, "maxItems": BULK_MAX_ITEMS}
+    }
+})
+versions = VersionCounters()
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MAX_BYTES)
+request_metrics = RequestMetrics()
+
+
+def _album_key(db_album):
+    return (db_album.artist.unique_name, db_album.title)
+
+def _track_key(db_track):
+    return _album_key(db_track.album) + (db_track.disc_number, db_track.track_number)
+
+def _album_url(key):
+    artist, title = key
+    return api.url_for(AlbumItem, artist=artist, title=title)
+
+def _track_url(key):
+    artist, album, disc, track = key
+    return api.url_for(TrackItem, artist=artist, album=album, disc=disc, track=track)
+
+def _track_parent_urls(key):
+    """
+    Returns the paths of the resources that embed or count the tracks of an
+    album: the album itself and the albums of its artist.
+    """
+
+    artist, album, disc, track = key
+    return _album_url((artist, album)), api.url_for(AlbumsByArtistCollection, artist=artist)
+
+
 def _get_choreography(name="chore", description='une purée de choreo'):
     return Choreography(
         name=name,
@@ -220,22 +619,6 @@ def _populate_db():
     artist.albums.append(album)
     db.session.commit()
 
-meta = db.metadata
-for table in reversed(meta.sorted_tables):
-    print('Clear table')
-    db.session.execute(table.delete())
-db.session.commit()
-
-
-
-db.create_all()
-_populate_db()
-
-db_fd, db_fname = tempfile.mkstemp()
-db.session.remove()
-os.close(db_fd)
-os.unlink(db_fname)
-
 
 class MasonBuilder(dict):
     """
@@ -325,6 +708,30 @@ class InStadiumBuilder(MasonBuilder):
             title="Get all artists"
         )
 
+    def add_control_albums_by(self, artist):
+        self.add_control(
+            "stadium:albums-by",
+            api.url_for(AlbumsByArtistCollection, artist=artist),
+            method="GET",
+            title="Albums by this artist"
+        )
+
+    def add_control_lyrics(self, artist, album, disc, track):
+        self.add_control(
+            "stadium:lyrics",
+            api.url_for(TrackLyrics, artist=artist, album=album, disc=disc, track=track),
+            method="GET",
+            title="Lyrics of this track"
+        )
+
+    def add_control_tracks_by_genre(self, genre):
+        self.add_control(
+            "stadium:tracks-by-genre",
+            api.url_for(TracksByGenreCollection, genre=genre),
+            method="GET",
+            title="Collection of all tracks in the genre"
+        )
+
     def add_control_all_choreographies(self):
         self.add_control(
             "stadium:choreographies-all",
@@ -337,10 +744,10 @@ class InStadiumBuilder(MasonBuilder):
 
 
 
-    def add_control_delete_album(self,title):
+    def add_control_delete_album(self, artist, title):
             self.add_control(
                 "stadium:delete",
-                api.url_for(AlbumItem, title=title),
+                api.url_for(AlbumItem, artist=artist, title=title),
                 method="DELETE",
                 title="delete this album"
             )
@@ -361,6 +768,14 @@ class InStadiumBuilder(MasonBuilder):
                 title="delete this choreography"
             )
 
+    def add_control_delete_track(self, artist, album, disc, track):
+            self.add_control(
+                "stadium:delete",
+                api.url_for(TrackItem, artist=artist, album=album, disc=disc, track=track),
+                method="DELETE",
+                title="delete this track"
+            )
+
 
 
     def add_control_add_album(self):
@@ -370,7 +785,7 @@ class InStadiumBuilder(MasonBuilder):
                 method="POST",
                 encoding="json",
                 title="Add new album",
-                schema=Album.get_schema()
+                schema=schemas.schema(Album)
             )
 
     def add_control_add_choreography(self):
@@ -380,10 +795,38 @@ class InStadiumBuilder(MasonBuilder):
                 method="POST",
                 encoding="json",
                 title="Add new choreography",
-                schema=Choreography.get_schema()
+                schema=schemas.schema(Choreography)
             )
 
 
+    def add_control_batch(self):
+        self.add_control(
+            "stadium:batch",
+            api.url_for(Batch),
+            method="POST",
+            encoding="json",
+            title="Run several requests at once",
+            schema=schemas.schema("batch")
+        )
+
+    def add_control_bulk(self, resource, model):
+        self.add_control(
+            "stadium:bulk-edit",
+            api.url_for(resource),
+            method="PATCH",
+            encoding="json",
+            title="Edit several items at once",
+            schema=schemas.schema(("bulk-update", model))
+        )
+        self.add_control(
+            "stadium:bulk-delete",
+            api.url_for(resource),
+            method="DELETE",
+            encoding="json",
+            title="Delete several items at once",
+            schema=schemas.schema(("bulk-delete", model))
+        )
+
     def add_control_add_artist(self):
             self.add_control(
                 "stadium:add-artist",
@@ -391,29 +834,29 @@ class InStadiumBuilder(MasonBuilder):
                 method="POST",
                 encoding="json",
                 title="Add new artist",
-                schema=Artist.get_schema()
+                schema=schemas.schema(Artist)
             )        
 
-    def add_control_add_track(self):
+    def add_control_add_track(self, artist, title):
             self.add_control(
                 "stadium:add-track",
-                api.url_for(AlbumItem),
+                api.url_for(AlbumItem, artist=artist, title=title),
                 method="POST",
                 encoding="json",
                 title="Add new track",
-                schema=Track.get_schema()
+                schema=schemas.schema(Track)
             ) 
 
 
     
-    def add_control_edit_album(self, title):
+    def add_control_edit_album(self, artist, title):
                 self.add_control(
                     "edit",
-                    api.url_for(AlbumItem, title=title),
+                    api.url_for(AlbumItem, artist=artist, title=title),
                     method="PUT",
                     encoding="json",
                     title="edit album",
-                    schema=Album.get_schema()
+                    schema=schemas.schema(Album)
                 )
 
     def add_control_edit_artist(self, unique_name):
@@ -423,7 +866,7 @@ class InStadiumBuilder(MasonBuilder):
                     method="PUT",
                     encoding="json",
                     title="edit artist",
-                    schema=Artist.get_schema()
+                    schema=schemas.schema(Artist)
                 )
 
 
@@ -435,139 +878,1004 @@ class InStadiumBuilder(MasonBuilder):
                     method="PUT",
                     encoding="json",
                     title="edit choreography",
-                    schema=Choreography.get_schema()
+                    schema=schemas.schema(Choreography)
+                )
+
+    def add_control_edit_track(self, artist, album, disc, track):
+                self.add_control(
+                    "edit",
+                    api.url_for(TrackItem, artist=artist, album=album, disc=disc, track=track),
+                    method="PUT",
+                    encoding="json",
+                    title="edit track",
+                    schema=schemas.schema(Track)
                 )
 
+def mason_response(body, status_code=200):
+    """
+    Returns a Mason response with body encoded straight into the response
+    bytes by the serialization layer, which also writes dates and times.
+    """
+
+    return Response(dumps(body), status_code, mimetype=MASON)
+
 def create_error_response(status_code, title, message=None):
     resource_url = request.path
     body = MasonBuilder(resource_url=resource_url)
     body.add_error(title, message)
     body.add_control("profile", href=ERROR_PROFILE)
-    return Response(json.dumps(body), status_code, mimetype=MASON)
+    return mason_response(body, status_code)
 
-class AlbumCollection(Resource):
 
-    def get(self):
-        body = InStadiumBuilder()
-        
-        body.add_namespace("stadium", LINK_RELATIONS_URL)
-        body.add_control("self", api.url_for(AlbumCollection))
-        body.add_control_add_album()
-        body["items"] = []
+def cacheable(dependencies):
+    """
+    Decorator for Resource get methods that adds an ETag header to successful
+    responses, answers If-None-Match with 304 Not Modified (weak comparison,
+    and * only for resources that exist) and serves repeated
+    requests from the response cache. The tag only depends on version
+    counters, so both are done before the database is touched. dependencies
+    is called with the URL variables of the request and returns the version
+    dependencies given to VersionCounters.etag.
+
+    Cache entries are stored together with the tag they were built for and
+    are only used while it is still current, so a response built from data
+    that was modified while the request was running is never served.
+    Streamed responses are not cached, and neither are responses made in a
+    Batch after its first write. Cached responses are compressed
+    here instead of by compress_response, and every compressed body is
+    kept in the cache entry so that it's only compressed once.
+    """
 
-        for db_album in Album.query.all():
-            item = InStadiumBuilder(
-                title=db_album.title,
-                release=db_album.release,
-                genre=db_album.genre,
-                disc= db_album.disc
-            )
-            item.add_control("self", api.url_for(AlbumItem, title=db_album.title))
-            item.add_control("profile", ALBUM_PROFILE)
-            body["items"].append(item)
-            
-        return Response(json.dumps(body), 200, mimetype=MASON)
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, **kwargs):
+            if versions.deferred():
+                # a batch request after a write that may still be rolled back
+                return func(self, **kwargs)
+            etag = versions.etag(*dependencies(**kwargs))
+            if_none_match = request.if_none_match
+            # * only matches if the resource exists, which the handler decides
+            if if_none_match and not if_none_match.star_tag:
+                for tag in etag_variants(etag):
+                    if if_none_match.contains_weak(tag):
+                        return _not_modified(tag)
+
+            key = (request.path, request.query_string)
+            entry = response_cache.get(key)
+            if entry is not None and entry.etag == etag:
+                response = Response(entry.data, 200, mimetype=entry.mimetype)
+            else:
+                entry = None
+                response = func(self, **kwargs)
+                if response.status_code != 200:
+                    return response
+                if not response.is_streamed:
+                    response_cache.put(key, request.path, response.get_data(), response.mimetype, etag)
+            if if_none_match.star_tag:
+                response.close()
+                return _not_modified(etag)
+            response.set_etag(etag)
+
+            coding = _compression_coding(response)
+            if coding is not None:
+                data = entry.variants.get(coding) if entry is not None else None
+                if data is None:
+                    data = compress(response.get_data(), coding, current_app.config["COMPRESSION_LEVELS"])
+                    response_cache.put_variant(key, etag, coding, data)
+                _encode_response(response, coding, data)
+            return response
+        return wrapper
+    return decorator
+
+
+def _not_modified(etag):
+    """
+    Returns a 304 Not Modified response for a representation with the given
+    entity tag.
+    """
 
-    
+    response = Response(status=304)
+    response.set_etag(etag)
+    if current_app.config["COMPRESSION_ENABLED"]:
+        response.vary.add("Accept-Encoding")
+    return response
 
-class AlbumItem(Resource):
-    
-    def get(self, title):
-        db_album = Album.query.filter_by(title=title).first()
-        if db_album is None:
-            return create_error_response(404, "Not found", 
-                "No product was found with the name {}".format(title)
-            )
-        
-        body = InStadiumBuilder(
-            title=db_album.title,
-            release=db_album.release,
-            genre=db_album.genre,
-            disc= db_album.disc
-        )
-        body.add_namespace("stadium", "/api/")
-        body.add_control("self", api.url_for(AlbumItem, title=title))
-        body.add_control("profile", ALBUM_PROFILE)
-        body.add_control("collection", api.url_for(AlbumCollection))
-        body.add_control_delete_album(title)
-        body.add_control_edit_album(title)
-        body.add_control_add_album()
-      
 
-        
-        return Response(json.dumps(body), 200, mimetype=MASON)
-    
-    def put(self, title):
-        db_album = Album.query.filter_by(title=title).first()
-        if db_album is None:
-            return create_error_response(404, "Not found", 
-                "No product was found with the name {}".format(title)
-            )
-        
+def _compression_coding(response):
+    """
+    Returns the content coding a response should be compressed with, or
+    None. Streamed, already encoded and small responses and media types
+    that don't compress well are sent as they are. Adds Accept-Encoding to
+    Vary of every response whose coding is negotiated.
+    """
+
+    config = current_app.config
+    if (not config["COMPRESSION_ENABLED"] or response.is_streamed or response.direct_passthrough
+            or response.mimetype not in COMPRESSIBLE or "Content-Encoding" in response.headers):
+        return None
+    response.vary.add("Accept-Encoding")
+    if response.calculate_content_length() < config["COMPRESSION_MIN_SIZE"]:
+        return None
+    return negotiate(request.accept_encodings)
+
+def _encode_response(response, coding, data):
+    response.set_data(data)
+    response.headers["Content-Encoding"] = coding
+    etag, weak = response.get_etag()
+    if etag is not None:
+        response.set_etag(coding_etag(etag, coding), weak)
+
+def compress_response(response):
+    """
+    Compresses the body of responses that weren't served by a cacheable
+    resource, registered with after_request when COMPRESSION_ENABLED is set.
+    """
+
+    coding = _compression_coding(response)
+    if coding is not None:
+        data = compress(response.get_data(), coding, current_app.config["COMPRESSION_LEVELS"])
+        _encode_response(response, coding, data)
+    return response
+
+
+def encode_cursor(values):
+    """
+    Turns the sort key values of the last (or first) item of a page into an
+    opaque cursor string that can be used in the ?after= and ?before= query
+    parameters. Dates are stored in ISO format.
+    """
+
+    return base64.urlsafe_b64encode(dumps(values)).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor, columns):
+    """
+    Reverses encode_cursor. The cursor must contain exactly one value of the
+    right type for each sort column. Raises ValueError if the cursor has
+    been tampered with.
+    """
+
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except (ValueError, TypeError):
+        raise ValueError("Malformed cursor")
+    if not isinstance(values, list) or len(values) != len(columns):
+        raise ValueError("Malformed cursor")
+    for i, column in enumerate(columns):
+        expected = column.type.python_type
+        if expected is float:
+            expected = (int, float)
+        if expected is date:
+            if not isinstance(values[i], str):
+                raise ValueError("Malformed cursor")
+            try:
+                values[i] = date.fromisoformat(values[i])
+            except ValueError:
+                raise ValueError("Malformed cursor")
+        # bool is a subclass of int but not a JSON number
+        elif not isinstance(values[i], expected) or isinstance(values[i], bool):
+            raise ValueError("Malformed cursor")
+    return values
+
+def parse_page_args(sort_columns, default_sort):
+    """
+    Reads the sortby, limit, after and before query parameters of a
+    collection request. sort_columns maps every allowed sortby value to the
+    tuple of columns that make up its keyset (the sort field followed by a
+    unique tie breaker). Raises ValueError with a message for the client if
+    any of the parameters is invalid.
+
+    : return: (sortby, columns, limit, after, before)
+    """
+
+    sortby = request.args.get("sortby", default_sort)
+    if sortby not in sort_columns:
+        raise ValueError("sortby must be one of: {}".format(", ".join(sort_columns)))
+    columns = sort_columns[sortby]
+
+    try:
+        limit = int(request.args.get("limit", DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise ValueError("limit must be an integer")
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError("limit must be between 1 and {}".format(MAX_PAGE_SIZE))
+
+    after = request.args.get("after")
+    before = request.args.get("before")
+    if after is not None and before is not None:
+        raise ValueError("after and before cannot be used together")
+    if before is not None and stream_requested():
+        # streams only go forward from the start or from after
+        raise ValueError("before cannot be used with stream")
+    if after is not None:
+        after = decode_cursor(after, columns)
+    if before is not None:
+        before = decode_cursor(before, columns)
+    return sortby, columns, limit, after, before
+
+def keyset_order(columns, after=None, before=None):
+    """
+    Returns the condition that selects the rows after (or before) the given
+    key, or None if there is no key, and the ORDER BY clauses that go with
+    it. For queries that can't simply be filtered, see keyset_page.
+
+    : return: (condition, order_by)
+    """
+
+    if before is not None:
+        return tuple_(*columns) < tuple_(*before), [column.desc() for column in columns]
+    if after is not None:
+        return tuple_(*columns) > tuple_(*after), list(columns)
+    return None, list(columns)
+
+def trim_page(rows, limit, before=None):
+    """
+    Turns the rows fetched with a limit of one more than the page size into
+    the page in ascending order.
+
+    : return: (rows, has_more)
+    """
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if before is not None:
+        rows.reverse()
+    return rows, has_more
+
+def keyset_page(query, columns, limit, after=None, before=None):
+    """
+    Fetches one page of a query using keyset pagination. Rows are ordered by
+    columns and the page starts right after (or ends right before) the given
+    key, so the database can seek in the matching index instead of scanning
+    and skipping with OFFSET. One extra row is fetched to find out whether
+    there is more data in the direction of travel.
+
+    : return: (rows, has_more)
+    """
+
+    condition, order_by = keyset_order(columns, after, before)
+    if condition is not None:
+        query = query.filter(condition)
+    rows = query.order_by(*order_by).limit(limit + 1).all()
+    return trim_page(rows, limit, before)
+
+def add_page_controls(body, resource, rows, keys, has_more, sortby, limit, after, before, **params):
+    """
+    Adds the Mason next and prev controls to a collection page. The cursors
+    are built from the sort keys of the last and first rows respectively.
+    keys is a function that returns the sort key values of a row. Other
+    query parameters of the collection are passed in params.
+    """
+
+    if not rows:
+        return
+    if before is None:
+        has_next, has_prev = has_more, after is not None
+    else:
+        has_next, has_prev = True, has_more
+    if has_next:
+        body.add_control("next", api.url_for(resource,
+            sortby=sortby, limit=limit, after=encode_cursor(keys(rows[-1])), **params
+        ))
+    if has_prev:
+        body.add_control("prev", api.url_for(resource,
+            sortby=sortby, limit=limit, before=encode_cursor(keys(rows[0])), **params
+        ))
+
+def parse_fields(available, default=None, param="fields"):
+    """
+    Reads a sparse fieldset, the comma separated names of the fields the
+    client wants in a representation, from the param query parameter.
+    available lists every field of the representation, default the ones
+    returned without the parameter (all of them if not given). Fields are
+    returned in the order of available, so the same selection always gives
+    the same body. Controls are not fields and are always included. Raises
+    ValueError with a message for the client for unknown fields.
+    """
+
+    value = request.args.get(param)
+    if value is None:
+        return available if default is None else default
+    fields = set(name.strip() for name in value.split(",") if name.strip())
+    if not fields.issubset(available):
+        raise ValueError("{} must only contain: {}".format(param, ", ".join(available)))
+    return tuple(name for name in available if name in fields)
+
+def fields_params(*params):
+    """
+    Returns the sparse fieldset query parameters of the request, so that the
+    page controls of a collection keep the selection.
+    """
+
+    return {param: request.args[param] for param in params or ("fields", ) if param in request.args}
+
+def field_columns(model, fields, *required):
+    """
+    Returns the names of the columns of model to load for a representation
+    with the given fields, for use with load_only: the required columns,
+    such as those in URLs and sort keys, and the fields that are columns of
+    model. Columns of unselected fields are not read, deferred ones included.
+    """
+
+    columns = model.__mapper__.column_attrs
+    return tuple(dict.fromkeys(list(required) + [name for name in fields if name in columns]))
+
+class LoadPolicy(object):
+    """
+    The declarative loading policy of a resource: the columns of a model it
+    always loads, such as those in its URLs, and the relationship the model
+    is reached through, if any, loaded with loader. Resources declare it as
+    LOAD_POLICY and extend it per request with the columns of the sparse
+    fieldset and the sort keys.
+
+    : param model: the model class
+    : param columns: names of the columns that are always loaded
+    : param via: relationship attribute to load the model through
+    : param loader: relationship loader function used with via
+    """
+
+    def __init__(self, model, *columns, via=None, loader=selectinload):
+        self.model = model
+        self.columns = columns
+        self.via = via
+        self.loader = loader
+
+    def options(self, fields, *columns):
+        """
+        Returns the query option that loads the policy's columns, the given
+        ones and the columns of the selected fields.
+        """
+
+        names = field_columns(self.model, fields, *(self.columns + columns))
+        if self.via is None:
+            return Load(self.model).load_only(*names)
+        return self.loader(self.via).load_only(*names)
+
+def stream_requested():
+    """
+    Checks whether the client asked for the whole collection to be streamed
+    instead of paginated with ?stream=true.
+    """
+
+    return request.args.get("stream", "").lower() in ("1", "true")
+
+def keyset_stream(query, columns, after=None):
+    """
+    Like keyset_page but without a limit: returns an iterator over all rows
+    after the given key that reads them from the database in batches of
+    STREAM_BATCH_SIZE instead of loading the whole result.
+    """
+
+    if after is not None:
+        query = query.filter(tuple_(*columns) > tuple_(*after))
+    return query.order_by(*columns).yield_per(STREAM_BATCH_SIZE)
+
+def stream_collection(body, rows, build_item):
+    """
+    Returns a collection response whose items are serialized one batch at a
+    time while they are read from the database. body contains everything
+    except the items, and build_item turns one row into an item. Only one
+    batch of rows and its JSON is held in memory at any time.
+    """
+
+    head = dumps(body)[:-1]
+    if body:
+        head += b","
+
+    def generate():
+        yield head + b'"items":['
+        separator = b""
+        chunk = []
+        for row in rows:
+            chunk.append(dumps(build_item(row)))
+            if len(chunk) == STREAM_BATCH_SIZE:
+                yield separator + b",".join(chunk)
+                separator = b","
+                chunk = []
+        if chunk:
+            yield separator + b",".join(chunk)
+        yield b"]}"
+
+    return Response(stream_with_context(generate()), 200, mimetype=MASON)
+
+
+class BulkCollection(object):
+    """
+    Bulk update (PATCH) and bulk delete (DELETE) of the items of a
+    collection, mixed into its resource. Every item is validated first,
+    then all of them are found with one IN query by their natural keys,
+    written with one executemany UPDATE or one DELETE and committed once.
+    Invalid, duplicate, missing and conflicting items are reported and
+    skipped, the others are written. The outcome of every item is returned
+    in the order of the request, with the status its PUT or DELETE would
+    have had.
+
+    Renaming an item to the key of another one is a conflict even if the
+    other item is renamed in the same request.
+
+    Subclasses set MODEL and implement these hooks:
+
+    - _bulk_find(keys) returns a dictionary from natural key to id of the
+      existing items, reading them with one IN query
+    - _bulk_url(key) returns the URL of an item
+    - _bulk_new_key(key, values) returns the natural key of an item after
+      its column values are written
+    - _bulk_written(keys, deleted) bumps versions and invalidates cached
+      responses, keys being the (old key, new key) of the written items
+
+    and may override _bulk_key, _bulk_values, _bulk_resolve and
+    _bulk_delete. The bulk UPDATE skips mapper events, so values that they
+    would set are added by _bulk_resolve.
+    """
+
+    MODEL = None
+
+    @staticmethod
+    def _bulk_key(key):
+        """
+        Returns the natural key of an item from its key in the request.
+        """
+
+        return key
+
+    @staticmethod
+    def _bulk_values(changes):
+        """
+        Returns the column values of the changes of an item. Raises
+        ValueError if they can't be stored.
+        """
+
+        return dict(changes)
+
+    def _bulk_resolve(self, rows):
+        """
+        Adds values that need the database to the rows to update, for all
+        rows at once.
+        """
+
+    def _bulk_delete(self, ids):
+        self.MODEL.query.filter(self.MODEL.id.in_(ids)).delete(synchronize_session=False)
+
+    def patch(self):
+        return self._bulk_write(update=True)
+
+    def delete(self):
+        return self._bulk_write(update=False)
+
+    @staticmethod
+    def _outcome(item, status, message=None):
+        outcome = InStadiumBuilder(key=item.get("key") if isinstance(item, dict) else None, status=status)
+        if message is not None:
+            outcome["message"] = message
+        return outcome
+
+    def _bulk_write(self, update):
         if not request.json:
             return create_error_response(415, "Unsupported media type",
                 "Requests must be JSON"
             )
 
         try:
-            validate(request.json, Album.get_schema())
+            schemas.validate(request.json, "bulk")
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
-    
-        db_album.title = request.json["title"]
-        db_album.release = request.json["release"]
-        db_album.genre = request.json["genre"]
-        db_album.disc = request.json["disc"]
+
+        kind = "bulk-update" if update else "bulk-delete"
+        items = request.json["items"]
+        outcomes = [None] * len(items)
+        # natural key -> (index, column values)
+        pending = {}
+        for index, item in enumerate(items):
+            try:
+                schemas.validate(item, (kind, "item", self.MODEL))
+                key = self._bulk_key(item["key"])
+                values = None
+                if update:
+                    schemas.validate(item["changes"], ("bulk-changes", self.MODEL))
+                    values = self._bulk_values(item["changes"])
+            except ValidationError as e:
+                outcomes[index] = self._outcome(item, 400, e.message)
+                continue
+            except ValueError as e:
+                outcomes[index] = self._outcome(item, 400, str(e))
+                continue
+            if key in pending:
+                outcomes[index] = self._outcome(item, 409, "The item is listed more than once")
+                continue
+            pending[key] = (index, values)
+
+        ids = self._bulk_find(list(pending)) if pending else {}
+        for key, (index, values) in list(pending.items()):
+            if key not in ids:
+                outcomes[index] = self._outcome(items[index], 404, "No item was found with this key")
+                del pending[key]
+
+        new_keys = {}
+        if update:
+            new_keys = {key: self._bulk_new_key(key, values) for key, (index, values) in pending.items()}
+            targets = [new_key for key, new_key in new_keys.items() if new_key != key]
+            taken = set(self._bulk_find(targets)) if targets else set()
+            for key, new_key in new_keys.items():
+                if new_key != key and new_key in taken:
+                    index = pending.pop(key)[0]
+                    outcomes[index] = self._outcome(items[index], 409, "Another item already has this key")
+                taken.add(new_key)
+
         try:
+            if update:
+                rows = [dict(values, id=ids[key]) for key, (index, values) in pending.items()]
+                self._bulk_resolve(rows)
+                db.session.bulk_update_mappings(self.MODEL, rows)
+            elif pending:
+                self._bulk_delete([ids[key] for key in pending])
             db.session.commit()
-        except IntegrityError:
-            return create_error_response(409, "Already exists", 
-                "Album with name '{}' already exists.".format(request.json["title"])
+        except IntegrityError as e:
+            db.session.rollback()
+            return create_error_response(409, "Bulk write conflict",
+                "The items conflict with concurrent changes: {}".format(e.orig)
             )
-        
-        return Response(status=204)
-
-    def delete(self, title):
-        db_album = Album.query.filter_by(title=title).first()
-        if db_album is None:
-            return create_error_response(404, "Not found", 
-                "No product was found with the name {}".format(handle)
-            )
-        
-        db.session.delete(db_album)
-        db.session.commit()
-        
-        return Response(status=204)
 
-class ArtistCollection(Resource):
+        written = [(key, new_keys.get(key, key)) for key in pending]
+        if written:
+            self._bulk_written(written, deleted=not update)
+        for key, (index, values) in pending.items():
+            outcomes[index] = self._outcome(items[index], 204)
+            if update:
+                outcomes[index].add_control("self", self._bulk_url(new_keys[key]))
 
-    def get(self):
         body = InStadiumBuilder()
-        
+        body["updated" if update else "deleted"] = len(written)
         body.add_namespace("stadium", LINK_RELATIONS_URL)
-        body.add_control("self", api.url_for(ArtistCollection))
-        body.add_control_add_artist()
-        body["items"] = []
+        body.add_control("self", api.url_for(type(self)))
+        body["items"] = outcomes
+        return mason_response(body)
 
-        for db_artist in Artist.query.all():
-            item = InStadiumBuilder(
-                name=db_artist.name,
-                unique_name=db_artist.unique_name
-            )
-            item.add_control("self", api.url_for(ArtistItem, unique_name=db_artist.unique_name))
-            item.add_control("profile", ARTIST_PROFILE)
-            body["items"].append(item)
-            
-        return Response(json.dumps(body), 200, mimetype=MASON)
 
-    def post(self):
-        if not request.json:
-            return create_error_response(415, "Unsupported media type",
-                "Requests must be JSON"
-            )
+class AlbumCollection(BulkCollection, Resource):
+    """
+    All albums. Albums are addressed through their artist, so albums
+    without one have no URL and are left out.
+    """
 
-        try:
-            validate(request.json, Artist.get_schema())
+    SORT_COLUMNS = {
+        "artist": (Artist.unique_name, Album.id),
+        "release": (Album.release, Album.id),
+        "title": (Album.title, Album.id),
+    }
+    FIELDS = ("title", "release", "genre", "discs")
+    LOAD_POLICY = LoadPolicy(Album, "title")
+    MODEL = Album
+
+    @staticmethod
+    def _item(row, fields=FIELDS):
+        db_album, artist = row
+        item = InStadiumBuilder((field, getattr(db_album, field)) for field in fields)
+        item.add_control("self", api.url_for(AlbumItem, artist=artist, title=db_album.title))
+        item.add_control("profile", ALBUM_PROFILE)
+        return item
+
+    @cacheable(lambda: ["album", "artist"])
+    def get(self):
+        try:
+            sortby, columns, limit, after, before = parse_page_args(
+                {field: self.SORT_COLUMNS[field] for field in Album.sortfields},
+                "title"
+            )
+            fields = parse_fields(self.FIELDS)
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameters", str(e))
+        load = self.LOAD_POLICY.options(fields, *[column.key for column in columns if column.class_ is Album])
+        build_item = functools.partial(self._item, fields=fields)
+
+        body = InStadiumBuilder()
+        
+        body.add_namespace("stadium", LINK_RELATIONS_URL)
+        body.add_control("self", api.url_for(AlbumCollection))
+        body.add_control_add_album()
+        body.add_control_bulk(AlbumCollection, Album)
+
+        # albums are addressed through their artist, so the join is needed
+        # for the item URLs regardless of the sort field, and drops albums
+        # without an artist
+        query = db.session.query(Album, Artist.unique_name).join(Album.artist).options(load)
+        if stream_requested():
+            return stream_collection(body, keyset_stream(query, columns, after), build_item)
+
+        rows, has_more = keyset_page(query, columns, limit, after, before)
+        keys = lambda row: [
+            row.unique_name if column is Artist.unique_name else getattr(row.Album, column.key)
+            for column in columns
+        ]
+        body["items"] = [build_item(row) for row in rows]
+
+        add_page_controls(body, AlbumCollection, rows, keys, has_more, sortby, limit, after, before,
+            **fields_params()
+        )
+        return mason_response(body)
+
+    @staticmethod
+    def _bulk_key(key):
+        return key["artist"], key["title"]
+
+    def _bulk_find(self, keys):
+        found = {}
+        # every key takes two parameters
+        size = LOOKUP_BATCH_SIZE // 2
+        for i in range(0, len(keys), size):
+            query = db.session.query(Album.id, Artist.unique_name, Album.title).join(Album.artist).filter(
+                tuple_(Artist.unique_name, Album.title).in_(keys[i:i + size])
+            )
+            for row in query:
+                found[(row.unique_name, row.title)] = row.id
+        return found
+
+    def _bulk_url(self, key):
+        return _album_url(key)
+
+    def _bulk_new_key(self, key, values):
+        return key[0], values.get("title", key[1])
+
+    @staticmethod
+    def _bulk_values(changes):
+        values = dict(changes)
+        if "release" in values:
+            values["release"] = date.fromisoformat(values["release"])
+        return values
+
+    def _bulk_resolve(self, rows):
+        genres = resolve_genres(db.session.connection(), [row["genre"] for row in rows if "genre" in row])
+        for row in rows:
+            if "genre" in row:
+                row["genre_id"] = genres.get(fold_genre(row["genre"]))
+
+    def _bulk_written(self, keys, deleted):
+        versions.bump("album", *[key for pair in keys for key in pair])
+        versions.bump("track")
+        for old_key, new_key in keys:
+            response_cache.invalidate_prefix(_album_url(old_key))
+        response_cache.invalidate(
+            *[_album_url(new_key) for old_key, new_key in keys if not deleted],
+            api.url_for(AlbumCollection)
+        )
+
+    
+
+def _find_album(artist, title, options=()):
+    """
+    Resolves an album URL with one join that uses the unique indexes of
+    artist.unique_name and (album.artist_id, album.title). The artist is
+    loaded by the same query, options are added to it.
+    """
+
+    return (
+        Album.query.join(Album.artist)
+        .filter(Artist.unique_name == artist, Album.title == title)
+        .options(contains_eager(Album.artist), *options)
+        .first()
+    )
+
+def _find_track(artist, album, disc, track, options=()):
+    """
+    Resolves a track URL with one join over the unique indexes of the whole
+    path. The album and artist are loaded by the same query, options are
+    added to it.
+    """
+
+    return (
+        Track.query.join(Track.album).join(Album.artist)
+        .filter(
+            Artist.unique_name == artist,
+            Album.title == album,
+            Track.disc_number == disc,
+            Track.track_number == track
+        )
+        .options(contains_eager(Track.album).contains_eager(Album.artist), *options)
+        .first()
+    )
+
+class AlbumsByArtistCollection(Resource):
+    """
+    The albums of one artist, newest last. The artist and one page of its
+    albums are read with a single query: the artist is outer joined to the
+    albums after the page cursor, so an artist without (more) albums still
+    produces a row and a 404 is only returned for artists that don't exist.
+    The (artist_id, release, id) index serves the join, the cursor and the
+    ordering, so no other albums of the artist are read. With ?tracks=true
+    every album also gets the number of its tracks, counted from the track
+    index.
+    """
+
+    SORT_COLUMNS = {
+        "release": (Album.release, Album.id),
+        "title": (Album.title, ),
+    }
+    FIELDS = ("title", "artist", "release", "genre", "discs")
+    LOAD_POLICY = AlbumCollection.LOAD_POLICY
+
+    @staticmethod
+    def _item(artist, row, fields=FIELDS):
+        db_album = row.Album
+        item = InStadiumBuilder(
+            (field, row.name if field == "artist" else getattr(db_album, field)) for field in fields
+        )
+        if "track_count" in row.keys():
+            item["track_count"] = row.track_count
+        item.add_control("self", api.url_for(AlbumItem, artist=artist, title=db_album.title))
+        item.add_control("profile", ALBUM_PROFILE)
+        return item
+
+    @cacheable(lambda artist: ["album", "track", ("artist", artist)])
+    def get(self, artist):
+        try:
+            sortby, columns, limit, after, before = parse_page_args(self.SORT_COLUMNS, "release")
+            fields = parse_fields(self.FIELDS)
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameters", str(e))
+        with_counts = request.args.get("tracks", "").lower() in ("1", "true")
+
+        condition, order_by = keyset_order(columns, after, before)
+        join_on = Album.artist_id == Artist.id
+        if condition is not None:
+            join_on = and_(join_on, condition)
+        entities = [Artist.name, Album]
+        if with_counts:
+            entities.append(
+                select([func.count(Track.id)]).where(Track.album_id == Album.id)
+                .as_scalar().label("track_count")
+            )
+        rows = (
+            db.session.query(*entities)
+            .select_from(Artist)
+            .outerjoin(Album, join_on)
+            .filter(Artist.unique_name == artist)
+            .options(self.LOAD_POLICY.options(fields, *[column.key for column in columns]))
+            .order_by(*order_by)
+            .limit(limit + 1)
+            .all()
+        )
+        if not rows:
+            return create_error_response(404, "Not found",
+                "No artist was found with the name {}".format(artist)
+            )
+        rows, has_more = trim_page([row for row in rows if row.Album is not None], limit, before)
+
+        body = InStadiumBuilder()
+        body.add_namespace("stadium", LINK_RELATIONS_URL)
+        body.add_control("self", api.url_for(AlbumsByArtistCollection, artist=artist))
+        body.add_control("author", api.url_for(ArtistItem, unique_name=artist))
+        body.add_control_all_artists()
+        body.add_control_all_albums()
+        body["items"] = [self._item(artist, row, fields) for row in rows]
+
+        keys = lambda row: [getattr(row.Album, column.key) for column in columns]
+        params = fields_params()
+        if with_counts:
+            params["tracks"] = "true"
+        add_page_controls(body, AlbumsByArtistCollection, rows, keys, has_more, sortby, limit, after, before,
+            artist=artist, **params
+        )
+        return mason_response(body)
+
+
+class AlbumItem(Resource):
+    """
+    An album with its tracks embedded as items. The fields of the album are
+    selected with ?fields= and those of the tracks with ?fields[track]=.
+    """
+
+    FIELDS = ("title", "release", "genre", "discs", "artist")
+    TRACK_FIELDS = ("title", "length", "disc_number", "track_number")
+    # the genre columns are read by the genre control, the tracks are
+    # embedded as items
+    LOAD_POLICY = LoadPolicy(Album, "title", "genre", "genre_id")
+    TRACK_LOAD_POLICY = LoadPolicy(Track, "disc_number", "track_number", via=Album.tracks)
+
+    @staticmethod
+    def _item(artist, title, db_track, fields=TRACK_FIELDS):
+        item = InStadiumBuilder((field, getattr(db_track, field)) for field in fields)
+        item.add_control("self", api.url_for(TrackItem,
+            artist=artist, album=title, disc=db_track.disc_number, track=db_track.track_number
+        ))
+        item.add_control("profile", TRACK_PROFILE)
+        return item
+    
+    @cacheable(lambda artist, title: ["track", ("artist", artist), ("album", (artist, title))])
+    def get(self, artist, title):
+        try:
+            fields = parse_fields(self.FIELDS)
+            track_fields = parse_fields(self.TRACK_FIELDS, param="fields[track]")
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameters", str(e))
+        db_album = _find_album(artist, title, (
+            self.LOAD_POLICY.options(fields), self.TRACK_LOAD_POLICY.options(track_fields)
+        ))
+        if db_album is None:
+            return create_error_response(404, "Not found", 
+                "No album was found with the name {} by {}".format(title, artist)
+            )
+        
+        body = InStadiumBuilder(
+            (field, db_album.artist.name if field == "artist" else getattr(db_album, field))
+            for field in fields
+        )
+        body.add_namespace("stadium", "/api/")
+        body.add_control("self", api.url_for(AlbumItem, artist=artist, title=title))
+        body.add_control("profile", ALBUM_PROFILE)
+        body.add_control("collection", api.url_for(AlbumCollection))
+        body.add_control("author", api.url_for(ArtistItem, unique_name=artist))
+        body.add_control_albums_by(artist)
+        body.add_control_delete_album(artist, title)
+        body.add_control_edit_album(artist, title)
+        body.add_control_add_track(artist, title)
+        if db_album.genre_id is not None:
+            body.add_control_tracks_by_genre(fold_genre(db_album.genre))
+        body["items"] = [self._item(artist, title, db_track, track_fields) for db_track in db_album.tracks]
+        
+        return mason_response(body)
+    
+    def put(self, artist, title):
+        db_album = _find_album(artist, title)
+        if db_album is None:
+            return create_error_response(404, "Not found", 
+                "No album was found with the name {} by {}".format(title, artist)
+            )
+        
+        if not request.json:
+            return create_error_response(415, "Unsupported media type",
+                "Requests must be JSON"
+            )
+
+        try:
+            schemas.validate(request.json, Album)
+            # the pattern accepts dates that don't exist, like 2020-02-31
+            release = date.fromisoformat(request.json["release"]) if "release" in request.json else None
+        except ValidationError as e:
+            return create_error_response(400, "Invalid JSON document", str(e))
+        except ValueError as e:
+            return create_error_response(400, "Invalid JSON document", str(e))
+    
+        old_key = _album_key(db_album)
+        db_album.title = request.json["title"]
+        if release is not None:
+            db_album.release = release
+        db_album.genre = request.json.get("genre", db_album.genre)
+        db_album.discs = request.json.get("discs", db_album.discs)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return create_error_response(409, "Already exists", 
+                "Album with name '{}' already exists.".format(request.json["title"])
+            )
+        
+        versions.bump("album", old_key, _album_key(db_album))
+        versions.bump("track")
+        response_cache.invalidate_prefix(_album_url(old_key))
+        response_cache.invalidate(_album_url(_album_key(db_album)), api.url_for(AlbumCollection))
+        return Response(status=204)
+
+    def post(self, artist, title):
+        db_album = _find_album(artist, title)
+        if db_album is None:
+            return create_error_response(404, "Not found", 
+                "No album was found with the name {} by {}".format(title, artist)
+            )
+
+        if not request.json:
+            return create_error_response(415, "Unsupported media type",
+                "Requests must be JSON"
+            )
+
+        try:
+            schemas.validate(request.json, Track)
+            # the columns can't be empty, but PUT may leave them out
+            for field in ("length", "lyrics"):
+                if field not in request.json:
+                    raise ValueError("'{}' is a required property".format(field))
+            length = time.fromisoformat(request.json["length"])
+        except ValidationError as e:
+            return create_error_response(400, "Invalid JSON document", str(e))
+        except ValueError as e:
+            return create_error_response(400, "Invalid JSON document", str(e))
+
+        db_track = Track(
+            title=request.json["title"],
+            disc_number=request.json["disc_number"],
+            track_number=request.json["track_number"],
+            length=length,
+            lyrics=request.json["lyrics"],
+            album=db_album
+        )
+        try:
+            db.session.add(db_track)
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return create_error_response(409, "Already exists", 
+                "Track {}/{} already exists on {}.".format(
+                    request.json["disc_number"], request.json["track_number"], title
+                )
+            )
+
+        key = (artist, title, db_track.disc_number, db_track.track_number)
+        versions.bump("track", key)
+        response_cache.invalidate(*_track_parent_urls(key))
+        return Response(status=201, headers={"Location": _track_url(key)})
+
+    def delete(self, artist, title):
+        db_album = _find_album(artist, title)
+        if db_album is None:
+            return create_error_response(404, "Not found", 
+                "No album was found with the name {} by {}".format(title, artist)
+            )
+        
+        key = _album_key(db_album)
+        db.session.delete(db_album)
+        db.session.commit()
+        
+        versions.bump("album", key)
+        versions.bump("track")
+        response_cache.invalidate_prefix(_album_url(key))
+        response_cache.invalidate(api.url_for(AlbumCollection))
+        return Response(status=204)
+
+class ArtistCollection(BulkCollection, Resource):
+
+    SORT_COLUMNS = {
+        "name": (Artist.name, Artist.id),
+        "unique_name": (Artist.unique_name, ),
+    }
+    FIELDS = ("name", "unique_name")
+    LOAD_POLICY = LoadPolicy(Artist, "unique_name")
+    MODEL = Artist
+
+    @staticmethod
+    def _item(db_artist, fields=FIELDS):
+        item = InStadiumBuilder((field, getattr(db_artist, field)) for field in fields)
+        item.add_control("self", api.url_for(ArtistItem, unique_name=db_artist.unique_name))
+        item.add_control("profile", ARTIST_PROFILE)
+        return item
+
+    @cacheable(lambda: ["artist"])
+    def get(self):
+        try:
+            sortby, columns, limit, after, before = parse_page_args(
+                {field: self.SORT_COLUMNS[field] for field in Artist.sortfields},
+                "unique_name"
+            )
+            fields = parse_fields(self.FIELDS)
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameters", str(e))
+        build_item = functools.partial(self._item, fields=fields)
+
+        body = InStadiumBuilder()
+        
+        body.add_namespace("stadium", LINK_RELATIONS_URL)
+        body.add_control("self", api.url_for(ArtistCollection))
+        body.add_control_add_artist()
+        body.add_control_bulk(ArtistCollection, Artist)
+
+        query = Artist.query.options(self.LOAD_POLICY.options(fields, *[column.key for column in columns]))
+        if stream_requested():
+            return stream_collection(body, keyset_stream(query, columns, after), build_item)
+
+        rows, has_more = keyset_page(query, columns, limit, after, before)
+        keys = lambda db_artist: [getattr(db_artist, column.key) for column in columns]
+        body["items"] = [build_item(db_artist) for db_artist in rows]
+
+        add_page_controls(body, ArtistCollection, rows, keys, has_more, sortby, limit, after, before,
+            **fields_params()
+        )
+        return mason_response(body)
+
+    def post(self):
+        if not request.json:
+            return create_error_response(415, "Unsupported media type",
+                "Requests must be JSON"
+            )
+
+        try:
+            schemas.validate(request.json, Artist)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
@@ -584,35 +1892,69 @@ class ArtistCollection(Resource):
                 "Artist with name '{}' already exists.".format(request.json["unique_name"])
             )
         
+        versions.bump("artist", artist.unique_name)
+        response_cache.invalidate(api.url_for(ArtistCollection))
         return Response(status=201, headers={
             "Location": api.url_for(ArtistItem, unique_name=request.json["unique_name"])
         })
 
+    def _bulk_find(self, keys):
+        return _lookup_ids((Artist.id, Artist.unique_name), keys)
+
+    def _bulk_url(self, key):
+        return api.url_for(ArtistItem, unique_name=key)
+
+    def _bulk_new_key(self, key, values):
+        return values.get("unique_name", key)
+
+    def _bulk_written(self, keys, deleted):
+        versions.bump("artist", *[key for pair in keys for key in pair])
+        if deleted:
+            versions.bump("album")
+            versions.bump("track")
+        # album and track URLs contain the artist's unique name
+        for old_key, new_key in keys:
+            response_cache.invalidate_prefix(self._bulk_url(old_key))
+        response_cache.invalidate(
+            *[self._bulk_url(new_key) for old_key, new_key in keys if not deleted],
+            api.url_for(ArtistCollection),
+            api.url_for(AlbumCollection)
+        )
+
 
 class ArtistItem(Resource):
+
+    FIELDS = ArtistCollection.FIELDS
+    LOAD_POLICY = ArtistCollection.LOAD_POLICY
     
+    @cacheable(lambda unique_name: [("artist", unique_name)])
     def get(self, unique_name):
-        db_artist = Artist.query.filter_by(unique_name=unique_name).first()
+        try:
+            fields = parse_fields(self.FIELDS)
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameters", str(e))
+        db_artist = (
+            Artist.query.options(self.LOAD_POLICY.options(fields))
+            .filter_by(unique_name=unique_name).first()
+        )
         if db_artist is None:
             return create_error_response(404, "Not found", 
                 "No artist was found with the name {}".format(unique_name)
             )
         
-        body = InStadiumBuilder(
-                name=db_artist.name,
-                unique_name=db_artist.unique_name
-            )
+        body = InStadiumBuilder((field, getattr(db_artist, field)) for field in fields)
         body.add_namespace("stadium", "/api/")
         body.add_control("self", api.url_for(ArtistItem, unique_name=unique_name))
         body.add_control("profile", ARTIST_PROFILE)
         body.add_control("collection", api.url_for(ArtistCollection))
+        body.add_control_albums_by(unique_name)
         body.add_control_delete_artist(unique_name)
         body.add_control_edit_artist(unique_name)
         body.add_control_add_artist()
       
 
         
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return mason_response(body)
     
     def put(self, unique_name):
         db_artist = Artist.query.filter_by(unique_name=unique_name).first()
@@ -627,7 +1969,7 @@ class ArtistItem(Resource):
             )
 
         try:
-            validate(request.json, Artist.get_schema())
+            schemas.validate(request.json, Artist)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
     
@@ -640,6 +1982,14 @@ class ArtistItem(Resource):
                 "Artist with name '{}' already exists.".format(request.json["unique_name"])
             )
         
+        versions.bump("artist", unique_name, db_artist.unique_name)
+        # album and track URLs contain the artist's unique name
+        response_cache.invalidate_prefix(api.url_for(ArtistItem, unique_name=unique_name))
+        response_cache.invalidate(
+            api.url_for(ArtistItem, unique_name=db_artist.unique_name),
+            api.url_for(ArtistCollection),
+            api.url_for(AlbumCollection)
+        )
         return Response(status=204)
 
     def delete(self, unique_name):
@@ -652,31 +2002,63 @@ class ArtistItem(Resource):
         db.session.delete(db_artist)
         db.session.commit()
         
+        versions.bump("artist", unique_name)
+        versions.bump("album")
+        versions.bump("track")
+        response_cache.invalidate_prefix(api.url_for(ArtistItem, unique_name=unique_name))
+        response_cache.invalidate(api.url_for(ArtistCollection), api.url_for(AlbumCollection))
         return Response(status=204)
 
 
 
 
-class ChoreographyCollection(Resource):
+class ChoreographyCollection(BulkCollection, Resource):
+
+    SORT_COLUMNS = {
+        "name": (Choreography.name, ),
+    }
+    FIELDS = ("name", "description")
+    LOAD_POLICY = LoadPolicy(Choreography, "name")
+    MODEL = Choreography
+
+    @staticmethod
+    def _item(db_chore, fields=FIELDS):
+        item = InStadiumBuilder((field, getattr(db_chore, field)) for field in fields)
+        item.add_control("self", api.url_for(ChoreographyItem, name=db_chore.name))
+        item.add_control("profile", CHOREOGRAPHY_PROFILE)
+        return item
 
+    @cacheable(lambda: ["choreography"])
     def get(self):
+        try:
+            sortby, columns, limit, after, before = parse_page_args(
+                {field: self.SORT_COLUMNS[field] for field in Choreography.sortfields},
+                "name"
+            )
+            fields = parse_fields(self.FIELDS)
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameters", str(e))
+        build_item = functools.partial(self._item, fields=fields)
+
         body = InStadiumBuilder()
         
         body.add_namespace("stadium", LINK_RELATIONS_URL)
         body.add_control("self", api.url_for(ChoreographyCollection))
         body.add_control_add_choreography()
-        body["items"] = []
+        body.add_control_bulk(ChoreographyCollection, Choreography)
 
-        for db_chore in Choreography.query.all():
-            item = InStadiumBuilder(
-                name=db_chore.name,
-                description=db_chore.description
-            )
-            item.add_control("self", api.url_for(ChoreographyItem, name=db_chore.name))
-            item.add_control("profile", CHOREOGRAPHY_PROFILE)
-            body["items"].append(item)
-            
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        query = Choreography.query.options(self.LOAD_POLICY.options(fields))
+        if stream_requested():
+            return stream_collection(body, keyset_stream(query, columns, after), build_item)
+
+        rows, has_more = keyset_page(query, columns, limit, after, before)
+        keys = lambda db_chore: [db_chore.name]
+        body["items"] = [build_item(db_chore) for db_chore in rows]
+
+        add_page_controls(body, ChoreographyCollection, rows, keys, has_more, sortby, limit, after, before,
+            **fields_params()
+        )
+        return mason_response(body)
 
     def post(self):
         if not request.json:
@@ -685,7 +2067,7 @@ class ChoreographyCollection(Resource):
             )
 
         try:
-            validate(request.json, Choreography.get_schema())
+            schemas.validate(request.json, Choreography)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
@@ -702,23 +2084,58 @@ class ChoreographyCollection(Resource):
                 "Choreography with name '{}' already exists.".format(request.json["name"])
             )
         
+        versions.bump("choreography", choreography.name)
+        response_cache.invalidate(api.url_for(ChoreographyCollection))
         return Response(status=201, headers={
             "Location": api.url_for(ChoreographyItem, name=request.json["name"])
         })
 
+    def _bulk_find(self, keys):
+        return _lookup_ids((Choreography.id, Choreography.name), keys)
+
+    def _bulk_url(self, key):
+        return api.url_for(ChoreographyItem, name=key)
+
+    def _bulk_new_key(self, key, values):
+        return values.get("name", key)
+
+    def _bulk_delete(self, ids):
+        # like the ORM does for a single choreography, its tracks are kept
+        Track.query.filter(Track.choreography_id.in_(ids)).update(
+            {Track.choreography_id: None}, synchronize_session=False
+        )
+        super()._bulk_delete(ids)
+
+    def _bulk_written(self, keys, deleted):
+        versions.bump("choreography", *[key for pair in keys for key in pair])
+        if deleted:
+            versions.bump("track")
+        response_cache.invalidate(
+            *[self._bulk_url(key) for pair in keys for key in pair],
+            api.url_for(ChoreographyCollection)
+        )
+
 class ChoreographyItem(Resource):
+
+    FIELDS = ChoreographyCollection.FIELDS
+    LOAD_POLICY = ChoreographyCollection.LOAD_POLICY
     
+    @cacheable(lambda name: [("choreography", name)])
     def get(self, name):
-        db_chore = Choreography.query.filter_by(name=name).first()
+        try:
+            fields = parse_fields(self.FIELDS)
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameters", str(e))
+        db_chore = (
+            Choreography.query.options(self.LOAD_POLICY.options(fields))
+            .filter_by(name=name).first()
+        )
         if db_chore is None:
             return create_error_response(404, "Not found", 
                 "No choreography was found with the name {}".format(name)
             )
         
-        body = InStadiumBuilder(
-                name=db_chore.name,
-                description=db_chore.description
-            )
+        body = InStadiumBuilder((field, getattr(db_chore, field)) for field in fields)
         body.add_namespace("stadium", "/api/")
         body.add_control("self", api.url_for(ChoreographyItem, name=name))
         body.add_control("profile", CHOREOGRAPHY_PROFILE)
@@ -729,7 +2146,7 @@ class ChoreographyItem(Resource):
       
 
         
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return mason_response(body)
     
     def put(self, name):
         db_chore = Choreography.query.filter_by(name=name).first()
@@ -744,7 +2161,7 @@ class ChoreographyItem(Resource):
             )
 
         try:
-            validate(request.json, Choreography.get_schema())
+            schemas.validate(request.json, Choreography)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
     
@@ -757,6 +2174,12 @@ class ChoreographyItem(Resource):
                 "Choreography with name '{}' already exists.".format(request.json["name"])
             )
         
+        versions.bump("choreography", name, db_chore.name)
+        response_cache.invalidate(
+            api.url_for(ChoreographyItem, name=name),
+            api.url_for(ChoreographyItem, name=db_chore.name),
+            api.url_for(ChoreographyCollection)
+        )
         return Response(status=204)
 
     def delete(self, name):
@@ -769,40 +2192,63 @@ class ChoreographyItem(Resource):
         db.session.delete(db_chore)
         db.session.commit()
         
+        versions.bump("choreography", name)
+        versions.bump("track")
+        response_cache.invalidate(
+            api.url_for(ChoreographyItem, name=name),
+            api.url_for(ChoreographyCollection)
+        )
         return Response(status=204)
 
 
+def _track_dependencies(artist, album, disc, track):
+    return [
+        ("artist", artist),
+        ("album", (artist, album)),
+        ("track", (artist, album, disc, track)),
+    ]
+
 class TrackItem(Resource):
+    """
+    A track. The lyrics are left out unless they are asked for with
+    ?fields=, they have their own sub resource.
+    """
+
+    FIELDS = ("title", "disc_number", "track_number", "length", "lyrics")
+    DEFAULT_FIELDS = FIELDS[:-1]
+    LOAD_POLICY = LoadPolicy(Track, "disc_number", "track_number")
     
-    def get(self, title):
-        db_track = Track.query.filter_by(title=title).first()
+    @cacheable(_track_dependencies)
+    def get(self, artist, album, disc, track):
+        try:
+            fields = parse_fields(self.FIELDS, self.DEFAULT_FIELDS)
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameters", str(e))
+        db_track = _find_track(artist, album, disc, track, (self.LOAD_POLICY.options(fields), ))
         if db_track is None:
             return create_error_response(404, "Not found", 
-                "No track was found with the name {}".format(title)
+                "No track {}/{} was found on {} by {}".format(disc, track, album, artist)
             )
         
-        body = InStadiumBuilder(
-                title = db_track.title,
-                disc_number = db_track.disc_number,
-                track_number = db_track.track_number
-            )
+        body = InStadiumBuilder((field, getattr(db_track, field)) for field in fields)
         body.add_namespace("stadium", "/api/")
-        body.add_control("self", api.url_for(TrackItem, title=title))
+        body.add_control("self", api.url_for(TrackItem, artist=artist, album=album, disc=disc, track=track))
         body.add_control("profile", TRACK_PROFILE)
-        body.add_control("collection", api.url_for(AlbumItem))
-        body.add_control_delete_track(title)
-        body.add_control_edit_track(title)
-        body.add_control_add_track()
+        body.add_control("collection", api.url_for(AlbumItem, artist=artist, title=album))
+        body.add_control_lyrics(artist, album, disc, track)
+        body.add_control_delete_track(artist, album, disc, track)
+        body.add_control_edit_track(artist, album, disc, track)
+        body.add_control_add_track(artist, album)
       
 
         
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return mason_response(body)
     
-    def put(self, title):
-        db_track = Track.query.filter_by(title=title).first()
+    def put(self, artist, album, disc, track):
+        db_track = _find_track(artist, album, disc, track)
         if db_track is None:
             return create_error_response(404, "Not found", 
-                "No track was found with the name {}".format(title)
+                "No track {}/{} was found on {} by {}".format(disc, track, album, artist)
             )
         
         if not request.json:
@@ -811,37 +2257,676 @@ class TrackItem(Resource):
             )
 
         try:
-            validate(request.json, Track.get_schema())
+            schemas.validate(request.json, Track)
+            # the pattern accepts times that don't exist, like 99:00:00
+            length = time.fromisoformat(request.json["length"]) if "length" in request.json else None
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
+        except ValueError as e:
+            return create_error_response(400, "Invalid JSON document", str(e))
     
-        db_chore.name = request.json["name"]
-        db_chore.description = request.json["description"]
+        old_key = _track_key(db_track)
+        db_track.title = request.json["title"]
+        db_track.disc_number = request.json["disc_number"]
+        db_track.track_number = request.json["track_number"]
+        if length is not None:
+            db_track.length = length
+        if "lyrics" in request.json:
+            db_track.lyrics = request.json["lyrics"]
         try:
             db.session.commit()
         except IntegrityError:
+            db.session.rollback()
             return create_error_response(409, "Already exists", 
-                "Track with name '{}' already exists.".format(request.json["title"])
+                "Track {}/{} already exists on {}.".format(
+                    request.json["disc_number"], request.json["track_number"], album
+                )
             )
         
+        versions.bump("track", old_key, _track_key(db_track))
+        response_cache.invalidate_prefix(_track_url(old_key))
+        response_cache.invalidate_prefix(_track_url(_track_key(db_track)))
+        response_cache.invalidate(*_track_parent_urls(old_key))
         return Response(status=204)
 
-    def delete(self, title):
-        db_track = Track.query.filter_by(title=title).first()
+    def delete(self, artist, album, disc, track):
+        db_track = _find_track(artist, album, disc, track)
         if db_track is None:
             return create_error_response(404, "Not found", 
-                "No track was found with the name {}".format(title)
+                "No track {}/{} was found on {} by {}".format(disc, track, album, artist)
             )
         
+        key = _track_key(db_track)
         db.session.delete(db_track)
         db.session.commit()
         
+        versions.bump("track", key)
+        response_cache.invalidate_prefix(_track_url(key))
+        response_cache.invalidate(*_track_parent_urls(key))
         return Response(status=204)
 
+
+class TrackLyrics(Resource):
+    """
+    The lyrics of a track, which are left out of the track itself. They are
+    changed by editing the track.
+    """
+
+    LOAD_POLICY = TrackItem.LOAD_POLICY
+
+    @cacheable(_track_dependencies)
+    def get(self, artist, album, disc, track):
+        db_track = _find_track(artist, album, disc, track, (self.LOAD_POLICY.options(("lyrics", )), ))
+        if db_track is None:
+            return create_error_response(404, "Not found", 
+                "No track {}/{} was found on {} by {}".format(disc, track, album, artist)
+            )
+
+        body = InStadiumBuilder(lyrics=db_track.lyrics)
+        body.add_namespace("stadium", LINK_RELATIONS_URL)
+        body.add_control("self", api.url_for(TrackLyrics, artist=artist, album=album, disc=disc, track=track))
+        body.add_control("up", api.url_for(TrackItem, artist=artist, album=album, disc=disc, track=track))
+        body.add_control_edit_track(artist, album, disc, track)
+        return mason_response(body)
+
+
+def _parse_import_lines(lines):
+    """
+    Parses and validates import lines. Records are checked with
+    IMPORT_CHECKS and only validated with jsonschema if that fails. Dates
+    and times are converted to Python objects here so the records can be
+    inserted as they are.
+
+    : param lines: list of (line number, text) tuples
+    : return: list of (line number, record type, record, error message)
+    """
+
+    results = []
+    for lineno, text in lines:
+        try:
+            record = json.loads(text)
+        except ValueError as e:
+            results.append((lineno, None, None, "Invalid JSON: {}".format(e)))
+            continue
+        kind = record.get("type") if isinstance(record, dict) else None
+        if not isinstance(kind, str) or kind not in IMPORT_MODELS:
+            results.append((lineno, None, None,
+                "type must be one of: {}".format(", ".join(IMPORT_MODELS))
+            ))
+            continue
+        try:
+            # jsonschema is only needed to explain the records that fail the quick check
+            if not IMPORT_CHECKS[kind](record):
+                schemas.validate(record, ("import", kind))
+            if kind == "album":
+                record["release"] = date.fromisoformat(record["release"])
+            elif kind == "track":
+                record["length"] = time.fromisoformat(record["length"])
+        except ValidationError as e:
+            results.append((lineno, kind, None, e.message))
+            continue
+        except ValueError as e:
+            results.append((lineno, kind, None, str(e)))
+            continue
+        results.append((lineno, kind, record, None))
+    return results
+
+def _lookup_ids(columns, values, key=None):
+    """
+    Finds the ids of existing rows by one of their columns. Values are looked
+    up in batches of LOOKUP_BATCH_SIZE.
+
+    : param columns: (id column, lookup column, additional columns...)
+    : param values: values of the lookup column
+    : param key: function turning a result row into the key of the returned
+        dictionary, defaults to the value of the lookup column
+    : return: dictionary from key to id
+    """
+
+    values = list(set(values))
+    found = {}
+    for i in range(0, len(values), LOOKUP_BATCH_SIZE):
+        batch = values[i:i + LOOKUP_BATCH_SIZE]
+        for row in db.session.query(*columns).filter(columns[1].in_(batch)):
+            found[key(row) if key else row[1]] = row[0]
+    return found
+
+def _bulk_insert(model, rows, existing, errors):
+    """
+    Inserts new rows of a model with executemany batches. Primary keys are
+    assigned here, continuing from the largest id in the table, so that rows
+    of the next level can refer to them without reading them back. Must be
+    run inside the transaction that the rows are committed in.
+
+    : param rows: list of (line number, natural key, column values) tuples
+    : param existing: dictionary from natural key to id of rows that already
+        exist. Rows with a key that is found in it are reported as errors,
+        and the ids of inserted rows are added to it.
+    : param errors: list that error reports are appended to
+    : return: number of inserted rows
+    """
+
+    next_id = db.session.query(func.max(model.id)).scalar() or 0
+    new = []
+    for lineno, key, values in rows:
+        if key in existing:
+            errors.append({"line": lineno, "message": "{} {} already exists".format(
+                model.__name__, key if isinstance(key, str) else "/".join(str(k) for k in key)
+            )})
+            continue
+        next_id += 1
+        values["id"] = existing[key] = next_id
+        new.append(values)
+    for i in range(0, len(new), IMPORT_BATCH_SIZE):
+        db.session.execute(model.__table__.insert(), new[i:i + IMPORT_BATCH_SIZE])
+    return len(new)
+
+
+class CatalogImport(Resource):
+    """
+    Loads a catalog from NDJSON where each line is one artist, album, track
+    or choreography record. Lines are validated one by one, references
+    between records are resolved in memory by natural keys (artist
+    unique_name, album title, choreography name) and the rows are inserted
+    in large batches in one transaction. Invalid lines are reported and
+    skipped, the rest of the catalog is imported.
+    """
+
+    def post(self):
+        if request.mimetype != NDJSON:
+            return create_error_response(415, "Unsupported media type",
+                "Requests must be {}".format(NDJSON)
+            )
+
+        try:
+            text = request.get_data().decode("utf-8")
+        except UnicodeDecodeError as e:
+            return create_error_response(400, "Invalid NDJSON document",
+                "The catalog must be encoded in UTF-8: {}".format(e)
+            )
+        lines = [(lineno, line) for lineno, line in enumerate(text.splitlines(), 1) if line.strip()]
+
+        errors = []
+        records = {kind: [] for kind in IMPORT_MODELS}
+        for lineno, kind, record, error in _parse_import_lines(lines):
+            if error is not None:
+                errors.append({"line": lineno, "message": error})
+            else:
+                records[kind].append((lineno, record))
+
+        try:
+            imported = self._import(records, errors)
+            db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            return create_error_response(409, "Import conflict",
+                "The catalog conflicts with concurrent changes: {}".format(e.orig)
+            )
+        except OperationalError as e:
+            db.session.rollback()
+            return create_error_response(503, "Import failed",
+                "The catalog could not be stored: {}".format(e.orig)
+            )
+
+        for kind in IMPORT_MODELS:
+            versions.bump(kind)
+        response_cache.clear()
+
+        errors.sort(key=lambda error: error["line"])
+        body = InStadiumBuilder(imported=imported, errors=errors)
+        body.add_namespace("stadium", LINK_RELATIONS_URL)
+        body.add_control("self", api.url_for(CatalogImport))
+        body.add_control_all_artists()
+        body.add_control_all_albums()
+        body.add_control_all_choreographies()
+        return mason_response(body)
+
+    @staticmethod
+    def _import(records, errors):
+        """
+        Resolves references and inserts the validated records level by level.
+        Returns the number of inserted rows per record type.
+        """
+
+        def missing(lineno, what, name):
+            errors.append({"line": lineno, "message": "{} {} not found".format(what, name)})
+
+        choreographies = _lookup_ids(
+            (Choreography.id, Choreography.name),
+            [r["name"] for _, r in records["choreography"]]
+            + [r["choreography"] for _, r in records["track"] if r.get("choreography")]
+        )
+        artists = _lookup_ids(
+            (Artist.id, Artist.unique_name),
+            [r["unique_name"] for _, r in records["artist"]]
+            + [r["artist"] for _, r in records["album"]]
+            + [r["artist"] for _, r in records["track"]]
+        )
+        # only albums of artists that existed before the import can exist
+        artist_names = {artist_id: name for name, artist_id in artists.items()}
+        albums = _lookup_ids(
+            (Album.id, Album.artist_id, Album.title),
+            artist_names,
+            key=lambda row: (artist_names[row.artist_id], row.title)
+        )
+        tracks = _lookup_ids(
+            (Track.id, Track.album_id, Track.disc_number, Track.track_number),
+            albums.values(),
+            key=lambda row: (row.album_id, row.disc_number, row.track_number)
+        )
+
+        imported = {}
+        imported["choreography"] = _bulk_insert(Choreography, [
+            (lineno, r["name"], {"name": r["name"], "description": r["description"]})
+            for lineno, r in records["choreography"]
+        ], choreographies, errors)
+        imported["artist"] = _bulk_insert(Artist, [
+            (lineno, r["unique_name"], {"name": r["name"], "unique_name": r["unique_name"]})
+            for lineno, r in records["artist"]
+        ], artists, errors)
+
+        genres = resolve_genres(db.session.connection(), [r.get("genre") for _, r in records["album"]])
+        rows = []
+        for lineno, r in records["album"]:
+            if r["artist"] not in artists:
+                missing(lineno, "Artist", r["artist"])
+                continue
+            rows.append((lineno, (r["artist"], r["title"]), {
+                "title": r["title"],
+                "release": r["release"],
+                "artist_id": artists[r["artist"]],
+                "genre": r.get("genre"),
+                "genre_id": genres.get(fold_genre(r.get("genre"))),
+                "discs": r.get("discs", 1),
+            }))
+        imported["album"] = _bulk_insert(Album, rows, albums, errors)
+
+        rows = []
+        for lineno, r in records["track"]:
+            album_id = albums.get((r["artist"], r["album"]))
+            if album_id is None:
+                missing(lineno, "Album", "{} by {}".format(r["album"], r["artist"]))
+                continue
+            choreography = r.get("choreography")
+            if choreography is not None and choreography not in choreographies:
+                missing(lineno, "Choreography", choreography)
+                continue
+            disc_number = r.get("disc_number", 1)
+            rows.append((lineno, (album_id, disc_number, r["track_number"]), {
+                "title": r["title"],
+                "disc_number": disc_number,
+                "track_number": r["track_number"],
+                "length": r["length"],
+                "lyrics": r["lyrics"],
+                "album_id": album_id,
+                "choreography_id": choreographies.get(choreography),
+            }))
+        imported["track"] = _bulk_insert(Track, rows, tracks, errors)
+        return imported
+
+class TracksByGenreCollection(Resource):
+    """
+    All tracks on the albums of a genre. The genre in the URL is folded like
+    stored genres, so it is case insensitive. Tracks are listed album by
+    album and the keyset of a page follows the genre -> album -> track index
+    path, so a page is read with index seeks regardless of the size of the
+    genre or how deep into it the page is.
+    """
+
+    KEYSET = (Album.id, Track.disc_number, Track.track_number)
+    FIELDS = ("title", "album", "disc_number", "track_number", "length")
+    # fields that are only selected when asked for, the others are needed
+    # for the URLs and keys
+    OPTIONAL_COLUMNS = {"title": Track.title, "length": Track.length}
+
+    @staticmethod
+    def _item(row, fields=FIELDS):
+        item = InStadiumBuilder((field, getattr(row, field)) for field in fields)
+        item.add_control("self", api.url_for(TrackItem,
+            artist=row.unique_name, album=row.album, disc=row.disc_number, track=row.track_number
+        ))
+        item.add_control("profile", TRACK_PROFILE)
+        return item
+
+    @cacheable(lambda genre: ["track", "album", "artist"])
+    def get(self, genre):
+        key = fold_genre(genre)
+        db_genre = Genre.query.filter_by(key=key).first() if key else None
+        if db_genre is None:
+            return create_error_response(404, "Not found",
+                "No genre was found with the name {}".format(genre)
+            )
+        try:
+            sortby, columns, limit, after, before = parse_page_args({"album": self.KEYSET}, "album")
+            fields = parse_fields(self.FIELDS)
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameters", str(e))
+        build_item = functools.partial(self._item, fields=fields)
+
+        body = InStadiumBuilder(genre=db_genre.name)
+        body.add_namespace("stadium", LINK_RELATIONS_URL)
+        body.add_control("self", api.url_for(TracksByGenreCollection, genre=key))
+        body.add_control_all_albums()
+
+        query = (
+            db.session.query(
+                Album.id.label("album_id"), Album.title.label("album"), Artist.unique_name,
+                Track.disc_number, Track.track_number,
+                *[column for field, column in self.OPTIONAL_COLUMNS.items() if field in fields]
+            )
+            .select_from(Album)
+            .join(Track, Track.album_id == Album.id)
+            .join(Album.artist)
+            .filter(Album.genre_id == db_genre.id)
+        )
+        if stream_requested():
+            return stream_collection(body, keyset_stream(query, columns, after), build_item)
+
+        rows, has_more = keyset_page(query, columns, limit, after, before)
+        body["items"] = [build_item(row) for row in rows]
+
+        keys = lambda row: [row.album_id, row.disc_number, row.track_number]
+        add_page_controls(body, TracksByGenreCollection, rows, keys, has_more, sortby, limit, after, before,
+            genre=key, **fields_params()
+        )
+        return mason_response(body)
+
+
+class TrackSearch(Resource):
+    """
+    Finds tracks by words in their title or lyrics using the track_fts full
+    text index. Results are ordered by relevance (bm25, with title matches
+    weighted higher) and paginated with cursors over the score and track id.
+    Every item has a snippet of the lyrics, escaped for HTML, with the
+    matched words in <mark> elements.
+
+    Ranking has to score every matching row, so the page is picked first
+    using the index alone. The joins and snippets are only made for the rows
+    of that page, which makes a large difference for common words.
+    """
+
+    FIELDS = ("title", "album", "disc_number", "track_number", "snippet")
+
+    @staticmethod
+    def _item(row, fields=FIELDS):
+        item = InStadiumBuilder(
+            (field, mark_snippet(row.snippet) if field == "snippet" else getattr(row, field))
+            for field in fields
+        )
+        item.add_control("self", api.url_for(TrackItem,
+            artist=row.unique_name, album=row.album, disc=row.disc_number, track=row.track_number
+        ))
+        item.add_control("profile", TRACK_PROFILE)
+        return item
+
+    @cacheable(lambda: ["track", "album", "artist"])
+    def get(self):
+        q = request.args.get("q", "")
+        expression = match_expression(q)
+        if expression is None:
+            return create_error_response(400, "Invalid query parameters",
+                "q must contain at least one word"
+            )
+        score = rank()
+        try:
+            sortby, columns, limit, after, before = parse_page_args(
+                {"rank": (score, track_fts.c.rowid)}, "rank"
+            )
+            fields = parse_fields(self.FIELDS)
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameters", str(e))
+
+        body = InStadiumBuilder(query=q)
+        body.add_namespace("stadium", LINK_RELATIONS_URL)
+        body.add_control("self", api.url_for(TrackSearch, q=q))
+
+        ranked = db.session.query(track_fts.c.rowid, score.label("score")).filter(matches(expression))
+        rows, has_more = keyset_page(ranked, columns, limit, after, before)
+        details = {}
+        if rows:
+            details = {row.id: row for row in (
+                db.session.query(
+                    Track.id, Track.title, Track.disc_number, Track.track_number,
+                    Album.title.label("album"), Artist.unique_name,
+                    # the snippet reads the lyrics, only make it when needed
+                    *([lyrics_snippet().label("snippet")] if "snippet" in fields else [])
+                )
+                .select_from(track_fts)
+                .join(Track, Track.id == track_fts.c.rowid)
+                .join(Track.album)
+                .join(Album.artist)
+                .filter(matches(expression), track_fts.c.rowid.in_([row.rowid for row in rows]))
+            )}
+        # tracks of albums without an artist have no URL and are left out
+        body["items"] = [self._item(details[row.rowid], fields) for row in rows if row.rowid in details]
+
+        keys = lambda row: [row.score, row.rowid]
+        add_page_controls(body, TrackSearch, rows, keys, has_more, sortby, limit, after, before,
+            q=q, **fields_params()
+        )
+        return mason_response(body)
+
+
+class CatalogExport(Resource):
+    """
+    Streams the whole catalog as NDJSON or CSV using the same records that
+    CatalogImport accepts: first all choreographies, then each artist
+    followed by its albums and their tracks. Artists are read in keyset
+    batches of EXPORT_BATCH_SIZE and their albums and tracks are loaded for
+    the whole batch with one IN query per level, so memory use does not grow
+    with the size of the catalog. Albums without an artist have no URL in
+    the API and are not exported.
+    """
+
+    CSV_FIELDS = [
+        "type", "name", "unique_name", "description", "artist", "album", "title",
+        "release", "genre", "discs", "disc_number", "track_number", "length",
+        "lyrics", "choreography",
+    ]
+
+    def get(self):
+        fmt = request.args.get("format", "ndjson")
+        if fmt == "ndjson":
+            mimetype, write = NDJSON, self._write_ndjson
+        elif fmt == "csv":
+            mimetype, write = CSV, self._write_csv
+        else:
+            return create_error_response(400, "Invalid query parameters",
+                "format must be one of: ndjson, csv"
+            )
+
+        def generate():
+            if fmt == "csv":
+                yield ",".join(self.CSV_FIELDS) + "\r\n"
+            for records in self._record_batches():
+                yield write(records)
+
+        return Response(stream_with_context(generate()), 200, mimetype=mimetype, headers={
+            "Content-Disposition": "attachment; filename=catalog.{}".format(fmt)
+        })
+
+    @staticmethod
+    def _keyset_batches(query, id_column):
+        last_id = 0
+        while True:
+            batch = query.filter(id_column > last_id).order_by(id_column).limit(EXPORT_BATCH_SIZE).all()
+            if not batch:
+                return
+            yield batch
+            last_id = batch[-1].id
+            # the objects of a batch are no longer needed
+            db.session.expunge_all()
+
+    def _record_batches(self):
+        for batch in self._keyset_batches(Choreography.query, Choreography.id):
+            yield [
+                {"type": "choreography", "name": db_chore.name, "description": db_chore.description}
+                for db_chore in batch
+            ]
+
+        tracks = selectinload(Artist.albums).selectinload(Album.tracks)
+        artists = Artist.query.options(tracks.undefer(Track.lyrics), tracks.joinedload(Track.choreography))
+        for batch in self._keyset_batches(artists, Artist.id):
+            records = []
+            for db_artist in batch:
+                records.append({
+                    "type": "artist",
+                    "name": db_artist.name,
+                    "unique_name": db_artist.unique_name
+                })
+                for db_album in db_artist.albums:
+                    records.append({
+                        "type": "album",
+                        "title": db_album.title,
+                        "release": db_album.release,
+                        "artist": db_artist.unique_name,
+                        "genre": db_album.genre,
+                        "discs": db_album.discs
+                    })
+                    for db_track in db_album.tracks:
+                        records.append({
+                            "type": "track",
+                            "title": db_track.title,
+                            "disc_number": db_track.disc_number,
+                            "track_number": db_track.track_number,
+                            "length": db_track.length,
+                            "lyrics": db_track.lyrics,
+                            "artist": db_artist.unique_name,
+                            "album": db_album.title,
+                            "choreography": db_track.choreography and db_track.choreography.name
+                        })
+            yield records
+
+    @staticmethod
+    def _write_ndjson(records):
+        return b"".join(dumps(record) + b"\n" for record in records)
+
+    def _write_csv(self, records):
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, self.CSV_FIELDS)
+        writer.writerows(records)
+        return buffer.getvalue()
+
+
+class Batch(Resource):
+    """
+    Runs several requests in one round trip. The requests are dispatched in
+    order through the URL map in this process and share the database
+    session and one transaction. Each request runs in a savepoint, so a
+    failed write leaves no partial changes behind, and the writes of the
+    successful ones are committed together at the end. With "atomic": true
+    the first failed request rolls back the whole batch and the remaining
+    ones are not run. Version bumps are deferred until the commit.
+
+    The responses are returned as items in the order of the requests, with
+    JSON bodies embedded as documents.
+    """
+
+    RESPONSE_HEADERS = ("Content-Type", "Location", "ETag")
+
+    @staticmethod
+    def _item(sub, response):
+        item = InStadiumBuilder(method=sub["method"], href=sub["href"], status=response.status_code)
+        item["headers"] = {
+            name: response.headers[name] for name in Batch.RESPONSE_HEADERS if name in response.headers
+        }
+        data = response.get_data()
+        if response.is_json and data:
+            item["body"] = json.loads(data)
+        else:
+            item["body"] = data.decode("utf-8", "replace") if data else None
+        return item
+
+    @staticmethod
+    def _not_run(sub, status, title, message):
+        return Batch._item(sub, create_error_response(status, title, message))
+
+    def _run(self, sub):
+        """
+        Runs one request in a savepoint that is released if it succeeds and
+        rolled back otherwise. Returns the response item.
+        """
+
+        session = db.session()
+        savepoint = session.begin_nested()
+        options = {"method": sub["method"]}
+        if "body" in sub:
+            options["json"] = sub["body"]
+        with current_app.test_request_context(sub["href"], **options):
+            view = current_app.view_functions.get(request.endpoint)
+            if getattr(view, "view_class", None) in (Batch, CatalogImport, CatalogExport):
+                response = create_error_response(400, "Not allowed in a batch",
+                    "Imports, exports and batches can't be part of a batch"
+                )
+            else:
+                response = current_app.full_dispatch_request()
+            item = self._item(sub, response)
+        # the resource releases the savepoint when it commits, or rolls it
+        # back after an error
+        if session.transaction is savepoint:
+            if response.status_code < 400:
+                session.commit()
+            else:
+                session.rollback()
+        return item
+
+    def post(self):
+        if not request.json:
+            return create_error_response(415, "Unsupported media type",
+                "Requests must be JSON"
+            )
+
+        try:
+            schemas.validate(request.json, "batch")
+        except ValidationError as e:
+            return create_error_response(400, "Invalid JSON document", str(e))
+
+        atomic = request.json.get("atomic", False)
+        session = db.session()
+        connection = session.connection()
+        # pysqlite only starts transactions before writes, and a savepoint
+        # made outside of one commits when it is released. Batches that
+        # write take the write lock first: a transaction that has read
+        # can't wait for it and fails with "database is locked".
+        if connection.dialect.name == "sqlite" and not connection.connection.in_transaction:
+            writes = any(sub["method"] != "GET" for sub in request.json["requests"])
+            connection.execute("BEGIN IMMEDIATE" if writes else "BEGIN")
+        versions.defer()
+        committed = False
+        try:
+            items = []
+            failed = False
+            for sub in request.json["requests"]:
+                if failed and atomic:
+                    items.append(self._not_run(sub, 424, "Not run",
+                        "An earlier request of the atomic batch failed"
+                    ))
+                    continue
+                items.append(self._run(sub))
+                failed = failed or items[-1]["status"] >= 400
+            if failed and atomic:
+                session.rollback()
+            else:
+                session.commit()
+                committed = True
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            versions.end_deferred(committed)
+
+        body = InStadiumBuilder(atomic=atomic, committed=committed)
+        body.add_namespace("stadium", LINK_RELATIONS_URL)
+        body.add_control("self", api.url_for(Batch))
+        body["items"] = items
+        return mason_response(body)
+
+
 api.add_resource(ArtistCollection, "/api/artists/")
 api.add_resource(ArtistItem, "/api/artists/<unique_name>/")
 
 api.add_resource(AlbumCollection, "/api/albums/")
+api.add_resource(AlbumsByArtistCollection, "/api/artists/<artist>/albums/")
 api.add_resource(AlbumItem, "/api/artists/<artist>/albums/<title>")
 
 api.add_resource(ChoreographyCollection, "/api/choreographies/")
@@ -849,24 +2934,201 @@ api.add_resource(ChoreographyItem, "/api/choreographies/<name>/")
 #collection_uri = api.url_for(ProductCollection)
 #product_uri = api.url_for(ProductItem)
 #api.add_resource(Product, "/api/products/add")
-api.add_resource(TrackItem, "/api/artists/<artist>/albums/<album>/<disc>/<track>/")
+api.add_resource(TrackItem, "/api/artists/<artist>/albums/<album>/<int:disc>/<int:track>/")
+api.add_resource(TrackLyrics, "/api/artists/<artist>/albums/<album>/<int:disc>/<int:track>/lyrics/")
+api.add_resource(CatalogImport, "/api/import/")
+api.add_resource(CatalogExport, "/api/export/")
+api.add_resource(Batch, "/api/batch/")
+api.add_resource(TrackSearch, "/api/search/tracks/")
+api.add_resource(TracksByGenreCollection, "/api/genres/<genre>/tracks/")
 
-@app.route("/api/")
 def entrypoint():
     body = InStadiumBuilder()
         
     body.add_namespace("stadium", LINK_RELATIONS_URL)
     #body.add_control_all_albums()
-    return Response(json.dumps(body), 200, mimetype=MASON)
+    body.add_control_batch()
+    return mason_response(body)
 
 
-@app.route(LINK_RELATIONS_URL)
 def send_link_relations():
     return "link relations"
 
-@app.route("/profiles/<profile>/")
 def send_profile(profile):
     return "you requests {} profile".format(profile)
 
+def send_metrics():
+    return Response(request_metrics.render(response_cache.stats()), 200, content_type=PROMETHEUS)
+
+def _profiles_response():
+    """
+    Returns an error response if request profiling is off or the request
+    doesn't carry an allowed profiling header, None otherwise. Without
+    PROFILE_TOKENS profiles can't be read over HTTP, sampled ones are
+    listed with the profiles command instead.
+    """
+
+    config = current_app.config
+    if not config["PROFILE_DIR"]:
+        return create_error_response(404, "Not found", "Request profiling is not enabled")
+    if not token_allowed(request.headers.get(config["PROFILE_HEADER"]), config["PROFILE_TOKENS"]):
+        return create_error_response(403, "Forbidden",
+            "Profiles can only be read with the {} header".format(config["PROFILE_HEADER"])
+        )
+    return None
+
+def list_request_profiles():
+    """
+    Lists the newest request profiles with links to their pstats and
+    collapsed stack files.
+    """
+
+    error = _profiles_response()
+    if error is not None:
+        return error
+    body = MasonBuilder(items=[])
+    body.add_control("self", url_for("list_request_profiles"))
+    for profile in list_profiles(current_app.config["PROFILE_DIR"], current_app.config["PROFILE_KEEP"]):
+        item = MasonBuilder(profile)
+        item.add_control("pstats", url_for("send_request_profile", filename=profile["name"] + ".prof"))
+        item.add_control("collapsed", url_for("send_request_profile", filename=profile["name"] + ".collapsed"))
+        body["items"].append(item)
+    return mason_response(body)
+
+def send_request_profile(filename):
+    error = _profiles_response()
+    if error is not None:
+        return error
+    return send_from_directory(current_app.config["PROFILE_DIR"], filename)
+
+
+@click.command("seed")
+@click.option("--reset", is_flag=True, help="Delete all existing rows first.")
+@with_appcontext
+def seed_command(reset):
+    """
+    Creates the tables and fills them with example data.
+    """
+
+    db.create_all()
+    if reset:
+        for table in reversed(db.metadata.sorted_tables):
+            db.session.execute(table.delete())
+        db.session.commit()
+    elif Artist.query.first() is not None:
+        raise click.ClickException("The database is not empty, use --reset to replace its contents")
+    _populate_db()
+    click.echo("Database seeded")
+
+
+@click.command("rebuild-search")
+@with_appcontext
+def rebuild_search_command():
+    """
+    Creates the track search index if it is missing and rebuilds it.
+    """
+
+    with db.engine.begin() as connection:
+        rebuild_track_fts(connection)
+    click.echo("Search index rebuilt")
+
+
+@click.command("profiles")
+@click.option("--limit", type=int, default=None, help="Only list this many profiles.")
+@with_appcontext
+def profiles_command(limit):
+    """
+    Lists the request profiles in PROFILE_DIR, newest first, with the
+    paths of their pstats files. Works for sampled
+    profiles too, which can't be read over HTTP without PROFILE_TOKENS.
+    """
+
+    directory = current_app.config["PROFILE_DIR"]
+    if not directory:
+        raise click.ClickException("Request profiling is not enabled, set PROFILE_DIR")
+    for profile in list_profiles(directory, limit or current_app.config["PROFILE_KEEP"]):
+        click.echo("{} {} {} {} {:.1f} ms {}".format(
+            profile["resource"], profile["method"], profile["path"], profile["status"],
+            profile["duration"] * 1000, os.path.join(directory, profile["name"] + PSTATS)
+        ))
+
+
+def create_app(config=None):
+    """
+    Creates and configures the application. Nothing is written to the
+    database here and the engine is only created when the first query is
+    made, so creating an application is cheap. Use the seed command to
+    create the tables and example data:
+
+        flask seed [--reset]
+
+    The application must be served by a single process, with as many
+    threads as needed: entity tags and the response cache are kept in the
+    memory of the process, see VersionCounters.
+
+    : param dict config: settings that override DEFAULT_CONFIG
+    """
+
+    app = Flask(__name__, static_folder="static")
+    app.config.from_mapping(DEFAULT_CONFIG)
+    if config is not None:
+        app.config.from_mapping(config)
+
+    if app.config["CORS_ENABLED"]:
+        from flask_cors import CORS
+        CORS(app)
+    db.init_app(app)
+    api.init_app(app)
+    if app.config["COMPRESSION_ENABLED"]:
+        app.after_request(compress_response)
+    if app.config["SLOW_QUERY_LOG"]:
+        slow_query_log = app.extensions["slow_query_log"] = SlowQueryLog(
+            app.config["SLOW_QUERY_LOG"],
+            threshold=app.config["SLOW_QUERY_THRESHOLD"],
+            max_bytes=app.config["SLOW_QUERY_LOG_MAX_BYTES"],
+            backup_count=app.config["SLOW_QUERY_LOG_BACKUPS"]
+        )
+        add_engine_hook(app, slow_query_log.install)
+    # profiled requests are recorded without the profiler's overhead
+    if app.config["METRICS_ENABLED"]:
+        install_sql_timing()
+        app.wsgi_app = MetricsMiddleware(app, request_metrics)
+    if app.config["PROFILE_DIR"]:
+        app.config["PROFILE_DIR"] = os.path.abspath(app.config["PROFILE_DIR"])
+        app.wsgi_app = ProfilingMiddleware(app,
+            app.config["PROFILE_DIR"],
+            header=app.config["PROFILE_HEADER"],
+            tokens=app.config["PROFILE_TOKENS"],
+            sample_rate=app.config["PROFILE_SAMPLE_RATE"],
+            keep=app.config["PROFILE_KEEP"]
+        )
+
+    app.add_url_rule("/api/", "entrypoint", entrypoint)
+    app.add_url_rule(LINK_RELATIONS_URL, "send_link_relations", send_link_relations)
+    app.add_url_rule("/profiles/<profile>/", "send_profile", send_profile)
+    app.add_url_rule("/admin/profiles/", "list_request_profiles", list_request_profiles)
+    if app.config["METRICS_ENABLED"]:
+        app.add_url_rule("/metrics", "metrics", send_metrics)
+    app.add_url_rule("/admin/profiles/<filename>", "send_request_profile", send_request_profile)
+    app.cli.add_command(seed_command)
+    app.cli.add_command(rebuild_search_command)
+    app.cli.add_command(profiles_command)
+    return app
+
+
+def create_asgi_app(config=None):
+    """
+    Creates the application like create_app and wraps it for ASGI servers,
+    for example:
+
+        uvicorn --factory --workers 1 app:create_asgi_app
+
+    : param dict config: settings that override DEFAULT_CONFIG
+    """
+
+    app = create_app(config)
+    return ASGIAdapter(app, workers=app.config["ASGI_WORKERS"])
+
+
 if __name__ == '__main__':
-    app.run()
\ No newline at end of file
+    create_app().run()
\ No newline at end of file
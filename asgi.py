@@ -0,0 +1,183 @@
+import asyncio
+import sys
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# request bodies larger than this are buffered in a temporary file
+SPOOL_MAX_SIZE = 1024 * 1024
+
+
+async def _send_all(send, messages):
+    for message in messages:
+        await send(message)
+
+
+def _chunks(response, written):
+    """
+    Yields the chunks of a WSGI response, each preceded by the data the
+    application passed to the write callable while producing it.
+    """
+
+    for chunk in response:
+        while written:
+            yield written.popleft()
+        yield chunk
+    while written:
+        yield written.popleft()
+
+
+class ASGIAdapter(object):
+    """
+    Serves a Flask application to an ASGI server. Connections are handled
+    by the server's event loop, and a request only takes one of the worker
+    threads once its body has been received. The thread runs the
+    application and produces the response body. The last chunk of the
+    body is sent by the event loop, so the thread is freed without waiting
+    for slow clients. Streamed responses keep their thread until the
+    chunk before the last one has been sent, which throttles them to the
+    speed of the client.
+
+    The resources, Mason builders, schemas and middleware are the ones of
+    the WSGI application. Every request runs in its own application
+    context, and so gets its own database session, just like under a
+    threaded WSGI server.
+
+    : param app: the Flask application
+    : param int workers: the number of requests handled at the same time
+    """
+
+    def __init__(self, app, workers=8):
+        self.app = app
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="asgi-worker")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            await self._http(scope, receive, send)
+        elif scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        else:
+            raise ValueError("Unsupported ASGI scope type {}".format(scope["type"]))
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await asyncio.get_running_loop().run_in_executor(None, self.executor.shutdown)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _http(self, scope, receive, send):
+        body = await self._read_body(receive)
+        if body is None:
+            return
+        loop = asyncio.get_running_loop()
+        environ = self.environ(scope, body)
+        last = await loop.run_in_executor(self.executor, self._run, environ, send, loop)
+        await asyncio.wrap_future(last)
+
+    @staticmethod
+    async def _read_body(receive):
+        """
+        Returns the request body as a file, or None if the client
+        disconnected before sending all of it.
+        """
+
+        body = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                body.close()
+                return None
+            body.write(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+        body.seek(0)
+        return body
+
+    @staticmethod
+    def environ(scope, body):
+        """
+        Returns the WSGI environ of the request described by an ASGI HTTP
+        scope. The body has been received in full, so its length is given
+        as CONTENT_LENGTH even if the client sent it chunked.
+        """
+
+        server = scope.get("server") or ("localhost", 80)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            # WSGI passes paths as bytes decoded as latin-1
+            "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+            "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+            "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+            "SERVER_NAME": server[0],
+            "SERVER_PORT": str(server[1]),
+            "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": body,
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        if scope.get("client"):
+            environ["REMOTE_ADDR"], environ["REMOTE_PORT"] = scope["client"][0], str(scope["client"][1])
+        for name, value in scope.get("headers", []):
+            key = name.decode("latin-1").upper().replace("-", "_")
+            if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                key = "HTTP_" + key
+            value = value.decode("latin-1")
+            environ[key] = environ[key] + "," + value if key in environ else value
+        # the server has already removed the chunked framing of the body
+        environ.pop("HTTP_TRANSFER_ENCODING", None)
+        body.seek(0, 2)
+        environ["CONTENT_LENGTH"] = str(body.tell())
+        body.seek(0)
+        return environ
+
+    def _run(self, environ, send, loop):
+        """
+        Runs the application in a worker thread and sends the response
+        through the event loop. Returns the future of the last message.
+        """
+
+        started = []
+        written = deque()
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and started and started[0] is None:
+                raise exc_info[1].with_traceback(exc_info[2])
+            started[:] = [{
+                "type": "http.response.start",
+                "status": int(status[:3]),
+                "headers": [(name.encode("latin-1"), value.encode("latin-1")) for name, value in headers],
+            }]
+            return written.append
+
+        def send_threadsafe(messages):
+            return asyncio.run_coroutine_threadsafe(_send_all(send, messages), loop)
+
+        response = self.app(environ, start_response)
+        try:
+            # one chunk is held back so that it can be sent as the last one
+            pending = None
+            for chunk in _chunks(response, written):
+                if not chunk:
+                    continue
+                if pending is not None:
+                    messages = [started[0]] if started[0] is not None else []
+                    messages.append({"type": "http.response.body", "body": pending, "more_body": True})
+                    # None marks the response as started
+                    started[0] = None
+                    send_threadsafe(messages).result()
+                pending = chunk
+            messages = [started[0]] if started[0] is not None else []
+            messages.append({"type": "http.response.body", "body": pending or b""})
+            return send_threadsafe(messages)
+        finally:
+            if hasattr(response, "close"):
+                response.close()
+            environ["wsgi.input"].close()
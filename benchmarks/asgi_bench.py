@@ -0,0 +1,280 @@
+"""
+Compares how many concurrent connections the WSGI and the ASGI serving
+modes sustain. For every number of connections a fresh server of each mode
+is started on the same SQLite database of choreographies, and as many
+clients as there are connections request /api/choreographies/ in a loop,
+opening a new connection for every request, for a fixed time. The
+throughput, the latency percentiles, the failed or timed out requests and
+the most threads and the peak memory of the server process are printed.
+
+Every server runs as a single process, see the Deployment section of the
+README. The WSGI mode is served by waitress or gunicorn's gthread worker
+with --wsgi-threads threads, or by Werkzeug's development server, which
+starts one thread per connection. The ASGI mode is create_asgi_app served
+by uvicorn, or by the minimal asyncio HTTP/1.1 server in this module. The
+defaults, Werkzeug and the builtin server, need no extra packages but are
+both test servers, so their numbers say nothing about a deployment. To
+compare the modes as they would be deployed run with --wsgi-server waitress
+(or gunicorn) --asgi-server uvicorn, see requirements-optional.txt. The
+clients run on asyncio in the benchmark process, so on small machines they
+compete with the server for the CPU.
+
+Run from the repository root:
+
+    python -m benchmarks.asgi_bench [--connections N ...] [--seconds S]
+        [--choreographies N] [--workers N] [--wsgi-threads N]
+        [--wsgi-server werkzeug|waitress|gunicorn] [--asgi-server builtin|uvicorn]
+"""
+
+import argparse
+import asyncio
+import http
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import unquote
+
+from benchmarks.load_bench import _free_port, _wait_for_server, summarize
+
+URL = "/api/choreographies/?limit=20"
+REQUEST_TIMEOUT = 10.0
+# the listen backlog of Werkzeug's server, also used by the other servers
+LISTEN_BACKLOG = 128
+WSGI_SERVERS = ["werkzeug", "waitress", "gunicorn"]
+ASGI_SERVERS = ["builtin", "uvicorn"]
+
+SERVER_SCRIPT = """
+import logging, sys
+from app import create_app, create_asgi_app
+config = {
+    "SQLALCHEMY_DATABASE_URI": "sqlite:///" + sys.argv[2],
+    "ASGI_WORKERS": int(sys.argv[4]),
+    "CORS_ENABLED": False,
+}
+if sys.argv[1] == "werkzeug":
+    from werkzeug.serving import run_simple
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    run_simple("127.0.0.1", int(sys.argv[3]), create_app(config), threaded=True)
+elif sys.argv[1] == "waitress":
+    import waitress
+    waitress.serve(create_app(config), host="127.0.0.1", port=int(sys.argv[3]),
+        threads=int(sys.argv[4]), backlog=int(sys.argv[5]), _quiet=True)
+elif sys.argv[1] == "gunicorn":
+    from gunicorn.app.base import BaseApplication
+
+    class Server(BaseApplication):
+        def load_config(self):
+            for name, value in [("bind", "127.0.0.1:" + sys.argv[3]), ("workers", 1),
+                                ("worker_class", "gthread"), ("threads", int(sys.argv[4])),
+                                ("backlog", int(sys.argv[5])), ("loglevel", "error")]:
+                self.cfg.set(name, value)
+
+        def load(self):
+            return create_app(config)
+
+    Server().run()
+elif sys.argv[1] == "uvicorn":
+    import uvicorn
+    uvicorn.run(create_asgi_app(config), host="127.0.0.1", port=int(sys.argv[3]),
+        log_level="error", backlog=int(sys.argv[5]))
+else:
+    from benchmarks.asgi_bench import serve
+    serve(create_asgi_app(config), "127.0.0.1", int(sys.argv[3]), int(sys.argv[5]))
+"""
+
+
+async def _handle(application, reader, writer):
+    """
+    Serves one request of a connection and closes it.
+    """
+
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+        lines = head.decode("latin-1").split("\r\n")
+        method, target, version = lines[0].split(" ", 2)
+        headers = []
+        for line in lines[1:]:
+            if line:
+                name, value = line.split(":", 1)
+                headers.append((name.strip().lower().encode("latin-1"), value.strip().encode("latin-1")))
+        length = int(dict(headers).get(b"content-length", b"0"))
+        body = await reader.readexactly(length) if length else b""
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError):
+        writer.close()
+        return
+
+    path, _, query = target.partition("?")
+    peer = writer.get_extra_info("peername") or ("", 0)
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": version[5:], "method": method,
+        "scheme": "http", "path": unquote(path), "raw_path": path.encode("latin-1"),
+        "query_string": query.encode("latin-1"), "root_path": "", "headers": headers,
+        "server": writer.get_extra_info("sockname")[:2], "client": peer[:2],
+    }
+    messages = [{"type": "http.request", "body": body}]
+
+    async def receive():
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            status = message["status"]
+            head = ["HTTP/1.1 {} {}".format(status, http.HTTPStatus(status).phrase)]
+            head += ["{}: {}".format(name.decode("latin-1"), value.decode("latin-1"))
+                     for name, value in message["headers"]]
+            head.append("Connection: close\r\n\r\n")
+            writer.write("\r\n".join(head).encode("latin-1"))
+        else:
+            writer.write(message.get("body", b""))
+            await writer.drain()
+
+    try:
+        await application(scope, receive, send)
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+def serve(application, host, port, backlog=LISTEN_BACKLOG):
+    """
+    Serves an ASGI application with one request per connection until the
+    process is terminated.
+    """
+
+    async def main():
+        server = await asyncio.start_server(
+            lambda reader, writer: _handle(application, reader, writer), host, port, backlog=backlog
+        )
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(main())
+
+
+def create_database(path, choreographies):
+    from app import create_app, db, Choreography
+
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + path})
+    with app.app_context():
+        db.create_all()
+        db.session.add_all([
+            Choreography(name="choreography-{}".format(i), description="description {}".format(i))
+            for i in range(choreographies)
+        ])
+        db.session.commit()
+        db.session.remove()
+        db.engine.dispose()
+
+
+async def _client(port, deadline, latencies, errors):
+    request = "GET {} HTTP/1.1\r\nHost: 127.0.0.1:{}\r\nConnection: close\r\n\r\n".format(URL, port)
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection("127.0.0.1", port), REQUEST_TIMEOUT
+            )
+            try:
+                writer.write(request.encode("ascii"))
+                response = await asyncio.wait_for(reader.read(), REQUEST_TIMEOUT)
+            finally:
+                writer.close()
+        except (OSError, asyncio.TimeoutError):
+            errors.append(time.perf_counter() - start)
+            continue
+        if response.startswith(b"HTTP/1.1 200") or response.startswith(b"HTTP/1.0 200"):
+            latencies.append(time.perf_counter() - start)
+        else:
+            errors.append(time.perf_counter() - start)
+
+
+def _process_status(pid):
+    """
+    Returns the number of threads and the peak resident memory in MB of a
+    process, or None for both where /proc isn't available.
+    """
+
+    try:
+        with open("/proc/{}/status".format(pid)) as f:
+            status = dict(line.split(":", 1) for line in f)
+    except OSError:
+        return None, None
+    return int(status["Threads"]), int(status["VmHWM"].split()[0]) / 1024
+
+
+async def _load(port, pid, connections, seconds):
+    """
+    Runs the clients and returns the latencies, the errors, the most
+    threads the server had at the same time and its peak memory.
+    """
+
+    latencies, errors = [], []
+    deadline = time.perf_counter() + seconds
+    clients = asyncio.gather(*[_client(port, deadline, latencies, errors) for i in range(connections)])
+    threads = None
+    while not clients.done():
+        sampled, memory = _process_status(pid)
+        if sampled is not None:
+            threads = max(threads or 0, sampled)
+        await asyncio.wait([clients], timeout=0.1)
+    await clients
+    return latencies, errors, threads, _process_status(pid)[1]
+
+
+def run(mode, db_fname, connections, args):
+    port = _free_port()
+    workers = args.workers if mode in ASGI_SERVERS else args.wsgi_threads
+    server = subprocess.Popen([
+        sys.executable, "-c", SERVER_SCRIPT, mode, db_fname, str(port), str(workers), str(LISTEN_BACKLOG)
+    ])
+    try:
+        _wait_for_server(server, port)
+        latencies, errors, threads, memory = asyncio.run(_load(port, server.pid, connections, args.seconds))
+    finally:
+        server.terminate()
+        server.wait()
+    result = summarize(latencies, len(errors), args.seconds)
+    result.update({"threads": threads, "memory": memory})
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--connections", type=int, nargs="+", default=[50, 200, 1000])
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--choreographies", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=8, help="ASGI_WORKERS of the ASGI mode")
+    parser.add_argument("--wsgi-threads", type=int, default=8, help="threads of waitress and gunicorn")
+    parser.add_argument("--wsgi-server", choices=WSGI_SERVERS, default="werkzeug")
+    parser.add_argument("--asgi-server", choices=ASGI_SERVERS, default="builtin")
+    args = parser.parse_args()
+
+    db_fd, db_fname = tempfile.mkstemp()
+    os.close(db_fd)
+    try:
+        create_database(db_fname, args.choreographies)
+        print("{:<14} {:>11} {:>9} {:>9} {:>9} {:>8} {:>8} {:>8}".format(
+            "mode", "connections", "req/s", "p50 ms", "p99 ms", "errors", "threads", "peak MB"
+        ))
+        for connections in args.connections:
+            for mode in (args.wsgi_server, args.asgi_server):
+                result = run(mode, db_fname, connections, args)
+                print("{:<14} {:>11} {:>9.1f} {:>9} {:>9} {:>8} {:>8} {:>8}".format(
+                    "{} {}".format("asgi" if mode in ASGI_SERVERS else "wsgi", mode),
+                    connections, result["throughput"],
+                    "-" if result["p50"] is None else "{:.1f}".format(result["p50"]),
+                    "-" if result["p99"] is None else "{:.1f}".format(result["p99"]),
+                    result["errors"], result["threads"] or "-",
+                    "-" if result["memory"] is None else "{:.1f}".format(result["memory"])
+                ))
+    finally:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_fname + suffix):
+                os.unlink(db_fname + suffix)
+
+
+if __name__ == "__main__":
+    main()
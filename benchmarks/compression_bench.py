@@ -0,0 +1,43 @@
+"""
+Measures how well and how fast Mason bodies compress with every available
+content coding and level, which is what COMPRESSION_LEVELS and
+COMPRESSION_MIN_SIZE are chosen from. Cached responses pay the compression
+time once, the others on every request.
+
+Run from the repository root:
+
+    python -m benchmarks.compression_bench [--items N ...] [--repeat N]
+"""
+
+import argparse
+
+from benchmarks.serialization_bench import _median, album_body
+from compression import CODINGS, compress
+from serialization import dumps
+
+LEVELS = {"gzip": [1, 6, 9], "br": [1, 5, 11]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--items", type=int, nargs="+", default=[1, 10, 100, 1000])
+    parser.add_argument("--repeat", type=int, default=7)
+    args = parser.parse_args()
+
+    print("{:<8} {:>6} {:>8} {:>10} {:>10} {:>8} {:>10}".format(
+        "coding", "level", "items", "bytes", "encoded", "ratio", "ms"
+    ))
+    for items in args.items:
+        data = dumps(album_body(items))
+        for coding in CODINGS:
+            for level in LEVELS[coding]:
+                encode = lambda: compress(data, coding, {coding: level})
+                size = len(encode())
+                elapsed = _median(encode, args.repeat)
+                print("{:<8} {:>6} {:>8} {:>10} {:>10} {:>8.1f} {:>10.3f}".format(
+                    coding, level, items, len(data), size, len(data) / size, elapsed * 1000
+                ))
+
+
+if __name__ == "__main__":
+    main()
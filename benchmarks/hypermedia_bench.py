@@ -0,0 +1,153 @@
+"""
+Microbenchmarks of the hypermedia layer: building Mason bodies with
+MasonBuilder and InStadiumBuilder, the per-item cost of collection items
+with their url_for controls, JSON encoding of the finished bodies and
+create_error_response. Every benchmark also records the memory it
+allocates, measured once with tracemalloc, in its extra info.
+
+Needs pytest-benchmark and is skipped without it. Run from the repository
+root, saving the results as a baseline:
+
+    python -m pytest benchmarks/hypermedia_bench.py --benchmark-autosave
+
+and later compare against the newest saved baseline:
+
+    python -m pytest benchmarks/hypermedia_bench.py --benchmark-compare
+        [--benchmark-compare-fail=mean:10%]
+
+Baselines are stored in .benchmarks/ under the repository root.
+"""
+
+import tracemalloc
+from datetime import date, time
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+from app import create_app, create_error_response, AlbumItem, ArtistCollection
+from app import InStadiumBuilder, MasonBuilder, Artist, Track, LINK_RELATIONS_URL
+from serialization import ENCODERS
+
+ITEM_COUNTS = [1, 10, 100, 1000]
+
+
+@pytest.fixture(scope="module")
+def request_context():
+    # the database is never touched, url_for and request.path need a request
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://", "CORS_ENABLED": False})
+    with app.test_request_context("/api/artists/testartist/albums/album1"):
+        yield
+
+
+def _record_allocations(benchmark, func, items=1):
+    """
+    Calls func once while tracing allocations and stores the peak, the
+    memory still held by its result and the number of live blocks, in total
+    and per item, in the benchmark's extra info.
+    """
+
+    tracemalloc.start()
+    try:
+        result = func()
+        retained, peak = tracemalloc.get_traced_memory()
+        blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename"))
+    finally:
+        tracemalloc.stop()
+    del result
+    benchmark.extra_info.update({
+        "peak_bytes": peak,
+        "retained_bytes": retained,
+        "retained_blocks": blocks,
+        "bytes_per_item": retained / items,
+        "blocks_per_item": blocks / items,
+    })
+
+
+def _tracks(count):
+    return [
+        Track(title="track{}".format(i), length=time(0, 3, 30), disc_number=1, track_number=i + 1)
+        for i in range(count)
+    ]
+
+def _artists(count):
+    return [Artist(name="Artist {}".format(i), unique_name="artist{}".format(i)) for i in range(count)]
+
+def _album_body(tracks):
+    body = InStadiumBuilder(title="album1", release=date(2020, 1, 1), genre="Rap", discs=1)
+    body.add_namespace("stadium", LINK_RELATIONS_URL)
+    body.add_control("self", "/api/artists/testartist/albums/album1")
+    body.add_control_delete_album("testartist", "album1")
+    body.add_control_edit_album("testartist", "album1")
+    body.add_control_add_track("testartist", "album1")
+    body["items"] = [AlbumItem._item("testartist", "album1", db_track) for db_track in tracks]
+    return body
+
+
+def test_add_namespace(benchmark):
+    def build():
+        body = MasonBuilder()
+        body.add_namespace("stadium", LINK_RELATIONS_URL)
+        return body
+
+    _record_allocations(benchmark, build)
+    benchmark(build)
+
+
+def test_add_control(benchmark):
+    def build():
+        body = MasonBuilder()
+        body.add_control("self", "/api/artists/testartist/", method="GET", title="Self")
+        return body
+
+    _record_allocations(benchmark, build)
+    benchmark(build)
+
+
+def test_builder_controls(benchmark, request_context):
+    # one url_for per control
+    def build():
+        body = InStadiumBuilder()
+        body.add_control_all_artists()
+        body.add_control_all_albums()
+        body.add_control_albums_by("testartist")
+        body.add_control_edit_album("testartist", "album1")
+        body.add_control_delete_album("testartist", "album1")
+        return body
+
+    _record_allocations(benchmark, build)
+    benchmark(build)
+
+
+@pytest.mark.parametrize("count", ITEM_COUNTS)
+def test_artist_items(benchmark, request_context, count):
+    db_artists = _artists(count)
+    build = lambda: [ArtistCollection._item(db_artist) for db_artist in db_artists]
+    benchmark.extra_info["items"] = count
+    _record_allocations(benchmark, build, count)
+    benchmark(build)
+
+
+@pytest.mark.parametrize("count", ITEM_COUNTS)
+def test_album_body(benchmark, request_context, count):
+    db_tracks = _tracks(count)
+    benchmark.extra_info["items"] = count
+    _record_allocations(benchmark, lambda: _album_body(db_tracks), count)
+    benchmark(_album_body, db_tracks)
+
+
+@pytest.mark.parametrize("encoder", sorted(ENCODERS))
+@pytest.mark.parametrize("count", ITEM_COUNTS)
+def test_encode_album_body(benchmark, request_context, count, encoder):
+    body = _album_body(_tracks(count))
+    encode = ENCODERS[encoder]
+    benchmark.extra_info["items"] = count
+    benchmark.extra_info["encoded_bytes"] = len(encode(body))
+    _record_allocations(benchmark, lambda: encode(body), count)
+    benchmark(encode, body)
+
+
+def test_create_error_response(benchmark, request_context):
+    build = lambda: create_error_response(404, "Not found", "No album was found with the name album1")
+    _record_allocations(benchmark, build)
+    benchmark(build)
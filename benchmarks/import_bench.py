@@ -0,0 +1,79 @@
+"""
+Measures the throughput of the bulk NDJSON import endpoint. A synthetic
+catalog of artists, albums, tracks and choreographies is generated and
+posted to /api/import/ against an empty SQLite database in a temporary file.
+
+Run from the repository root:
+
+    python -m benchmarks.import_bench [--artists N] [--albums N] [--tracks N]
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from app import create_app, db
+
+
+def generate_catalog(artists, albums, tracks, choreographies=100):
+    """
+    Returns the NDJSON text of a synthetic catalog and the number of records
+    in it. albums is per artist and tracks is per album.
+    """
+
+    lines = []
+    for c in range(choreographies):
+        lines.append({"type": "choreography", "name": "chore-{}".format(c), "description": "moves"})
+    for a in range(artists):
+        artist = "artist-{}".format(a)
+        lines.append({"type": "artist", "name": artist.title(), "unique_name": artist})
+        for b in range(albums):
+            album = "album-{}".format(b)
+            lines.append({
+                "type": "album", "title": album, "release": "2020-01-01",
+                "artist": artist, "genre": "Rock", "discs": 1
+            })
+            for t in range(tracks):
+                lines.append({
+                    "type": "track", "title": "track-{}".format(t),
+                    "disc_number": 1, "track_number": t + 1, "length": "00:03:30",
+                    "lyrics": "la " * 50, "artist": artist, "album": album,
+                    "choreography": "chore-{}".format(t % choreographies)
+                })
+    return "\n".join(json.dumps(line) for line in lines), len(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--artists", type=int, default=500)
+    parser.add_argument("--albums", type=int, default=10, help="albums per artist")
+    parser.add_argument("--tracks", type=int, default=12, help="tracks per album")
+    args = parser.parse_args()
+
+    data, rows = generate_catalog(args.artists, args.albums, args.tracks)
+    db_fd, db_fname = tempfile.mkstemp()
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname})
+    try:
+        app.app_context().push()
+        db.create_all()
+        client = app.test_client()
+        start = time.perf_counter()
+        resp = client.post("/api/import/", data=data, content_type="application/x-ndjson")
+        elapsed = time.perf_counter() - start
+        body = json.loads(resp.data)
+        print("status:   {}".format(resp.status_code))
+        print("imported: {}".format(body.get("imported")))
+        print("errors:   {}".format(len(body.get("errors", []))))
+        print("rows:     {}".format(rows))
+        print("time:     {:.2f} s".format(elapsed))
+        print("rate:     {:,.0f} rows/s".format(rows / elapsed))
+    finally:
+        db.session.remove()
+        os.close(db_fd)
+        os.unlink(db_fname)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,613 @@
+"""
+Load tests the API over HTTP. A synthetic catalog of the chosen scale is
+imported into a fresh SQLite database served by a local server in its own
+process, then concurrent workers send a weighted mix of reads and writes
+covering every resource for a fixed time. The latency percentiles and the
+throughput of each resource and method are printed and written to a JSON
+file.
+
+Two runs can be compared, each given as a results file or as a git revision
+that is checked out into a temporary worktree and load tested with the same
+settings. Resources whose p50 or p95 latency got worse by more than the
+threshold in runs with enough requests are reported as regressions and the
+exit status is 1.
+
+Run from the repository root:
+
+    python -m benchmarks.load_bench run [--scale 1k|100k|1m] [--mix read|mixed|write]
+        [--workers N] [--seconds S] [--output FILE]
+    python -m benchmarks.load_bench compare OLD NEW [--threshold F] [run options]
+"""
+
+import argparse
+import http.client
+import itertools
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+SCALES = {"1k": 1000, "100k": 100000, "1m": 1000000}
+# fraction of operations that write
+MIXES = {"read": 0.0, "mixed": 0.1, "write": 0.5}
+
+ALBUMS_PER_ARTIST = 10
+TRACKS_PER_ALBUM = 12
+CHOREOGRAPHIES = 100
+GENRES = ["Rock", "Pop", "Rap", "Jazz", "Metal", "Folk", "Soul", "Techno"]
+VOCABULARY_SIZE = 5000
+WORDS_PER_TRACK = 20
+IMPORT_CHUNK_LINES = 50000
+SERVER_START_TIMEOUT = 60
+
+SERVER_SCRIPT = """
+import logging, sys
+from werkzeug.serving import run_simple
+from app import create_app, db
+app = create_app({
+    "SQLALCHEMY_DATABASE_URI": "sqlite:///" + sys.argv[1],
+    "SQLITE_PROFILE": sys.argv[3],
+})
+with app.app_context():
+    db.create_all()
+logging.getLogger("werkzeug").setLevel(logging.ERROR)
+run_simple("127.0.0.1", int(sys.argv[2]), app, threaded=True)
+"""
+
+
+class Catalog(object):
+    """
+    The shape of the synthetic catalog. Track t is track t % 12 + 1 on disc
+    1 of album t // 12, and every artist has 10 albums, so the URL of any
+    seeded row can be computed from its index without asking the server.
+    """
+
+    def __init__(self, tracks, seed=1):
+        self.tracks = tracks
+        self.albums = (tracks + TRACKS_PER_ALBUM - 1) // TRACKS_PER_ALBUM
+        self.artists = (self.albums + ALBUMS_PER_ARTIST - 1) // ALBUMS_PER_ARTIST
+        self.seed = seed
+        self.vocabulary = ["word{}".format(i) for i in range(VOCABULARY_SIZE)]
+        self.cum_weights = list(itertools.accumulate(1.0 / (rank + 1) for rank in range(VOCABULARY_SIZE)))
+
+    @staticmethod
+    def artist(a):
+        return "artist-{}".format(a)
+
+    @staticmethod
+    def album(a):
+        return "album-{}".format(a % ALBUMS_PER_ARTIST)
+
+    def records(self):
+        """
+        Yields the catalog as import records, every artist followed by its
+        albums and their tracks.
+        """
+
+        rng = random.Random(self.seed)
+        for c in range(CHOREOGRAPHIES):
+            yield {"type": "choreography", "name": "chore-{}".format(c), "description": "moves"}
+        for a in range(self.albums):
+            artist = self.artist(a // ALBUMS_PER_ARTIST)
+            if a % ALBUMS_PER_ARTIST == 0:
+                yield {"type": "artist", "name": artist.title(), "unique_name": artist}
+            yield {
+                "type": "album", "title": self.album(a), "release": "2020-01-01",
+                "artist": artist, "genre": GENRES[a % len(GENRES)], "discs": 1
+            }
+            for t in range(a * TRACKS_PER_ALBUM, min((a + 1) * TRACKS_PER_ALBUM, self.tracks)):
+                yield {
+                    "type": "track", "title": "track-{}".format(t),
+                    "disc_number": 1, "track_number": t % TRACKS_PER_ALBUM + 1, "length": "00:03:30",
+                    "lyrics": " ".join(rng.choices(self.vocabulary, cum_weights=self.cum_weights, k=WORDS_PER_TRACK)),
+                    "artist": artist, "album": self.album(a),
+                    "choreography": "chore-{}".format(t % CHOREOGRAPHIES)
+                }
+
+    def track_url(self, t):
+        a = t // TRACKS_PER_ALBUM
+        return "/api/artists/{}/albums/{}/1/{}/".format(
+            self.artist(a // ALBUMS_PER_ARTIST), self.album(a), t % TRACKS_PER_ALBUM + 1
+        )
+
+    def album_url(self, a):
+        return "/api/artists/{}/albums/{}".format(self.artist(a // ALBUMS_PER_ARTIST), self.album(a))
+
+
+# Operations are (label, weight, function). A function gets the worker and
+# returns the requests to send in order as (method, url, body, content
+# type, expected statuses). Labels name the resource class and the method
+# so that runs of different revisions can be compared.
+
+def _get(url):
+    return ("GET", url, None, None, (200, ))
+
+def _json(method, url, document, expected):
+    return (method, url, json.dumps(document), "application/json", expected)
+
+READS = [
+    ("GET ArtistCollection", 5, lambda w: [_get("/api/artists/?limit=20")]),
+    ("GET ArtistItem", 10, lambda w: [_get("/api/artists/{}/".format(w.catalog.artist(w.rng.randrange(w.catalog.artists))))]),
+    ("GET AlbumCollection", 5, lambda w: [_get("/api/albums/?limit=20&sortby=" + w.rng.choice(["title", "artist", "release"]))]),
+    ("GET AlbumsByArtistCollection", 10, lambda w: [_get(
+        "/api/artists/{}/albums/?tracks=true".format(w.catalog.artist(w.rng.randrange(w.catalog.artists)))
+    )]),
+    ("GET AlbumItem", 15, lambda w: [_get(w.catalog.album_url(w.rng.randrange(w.catalog.albums)))]),
+    ("GET TrackItem", 20, lambda w: [_get(w.catalog.track_url(w.rng.randrange(w.catalog.tracks)))]),
+    ("GET TrackLyrics", 5, lambda w: [_get(w.catalog.track_url(w.rng.randrange(w.catalog.tracks)) + "lyrics/")]),
+    ("GET ChoreographyCollection", 5, lambda w: [_get("/api/choreographies/?limit=20")]),
+    ("GET ChoreographyItem", 5, lambda w: [_get("/api/choreographies/chore-{}/".format(w.rng.randrange(CHOREOGRAPHIES)))]),
+    ("GET TrackSearch", 10, lambda w: [_get("/api/search/tracks/?limit=20&q=" + w.rng.choice(w.catalog.vocabulary))]),
+    ("GET TracksByGenreCollection", 5, lambda w: [_get("/api/genres/{}/tracks/?limit=20".format(w.rng.choice(GENRES).lower()))]),
+    # reads the whole catalog, which takes long at the larger scales
+    ("GET CatalogExport", 0.05, lambda w: [_get("/api/export/?format=" + w.rng.choice(["ndjson", "csv"]))]),
+]
+
+def _rename_track(w):
+    t = w.rng.randrange(w.catalog.tracks)
+    return [_json("PUT", w.catalog.track_url(t), {
+        "title": "track-{}-{}".format(t, w.rng.random()), "disc_number": 1,
+        "track_number": t % TRACKS_PER_ALBUM + 1
+    }, (204, ))]
+
+def _retag_album(w):
+    a = w.rng.randrange(w.catalog.albums)
+    return [_json("PUT", w.catalog.album_url(a), {
+        "title": w.catalog.album(a), "genre": w.rng.choice(GENRES)
+    }, (204, ))]
+
+def _rename_artist(w):
+    artist = w.catalog.artist(w.rng.randrange(w.catalog.artists))
+    return [_json("PUT", "/api/artists/{}/".format(artist), {
+        "name": "{} {}".format(artist, w.rng.random()), "unique_name": artist
+    }, (204, ))]
+
+def _describe_choreography(w):
+    name = "chore-{}".format(w.rng.randrange(CHOREOGRAPHIES))
+    return [_json("PUT", "/api/choreographies/{}/".format(name), {
+        "name": name, "description": "moves {}".format(w.rng.random())
+    }, (204, ))]
+
+def _batch(w):
+    name = "chore-{}".format(w.rng.randrange(CHOREOGRAPHIES))
+    return [_json("POST", "/api/batch/", {"requests": [
+        {"method": "PUT", "href": "/api/choreographies/{}/".format(name), "body": {
+            "name": name, "description": "moves {}".format(w.rng.random())
+        }},
+        {"method": "GET", "href": "/api/choreographies/{}/".format(name)},
+        {"method": "GET", "href": w.catalog.track_url(w.rng.randrange(w.catalog.tracks))},
+    ]}, (200, ))]
+
+def _artist_lifecycle(w):
+    # names are unique per worker and operation, so workers never conflict
+    artist = "load-{}-{}".format(w.number, next(w.counter))
+    album = "/api/artists/{}/albums/album".format(artist)
+    tracks = "\n".join(json.dumps(record) for record in [
+        {"type": "album", "title": "album", "release": "2021-01-01", "artist": artist, "genre": "Rock", "discs": 1},
+        {"type": "track", "title": "one", "disc_number": 1, "track_number": 1, "length": "00:03:00",
+         "lyrics": "la la", "artist": artist, "album": "album"},
+    ])
+    return [
+        _json("POST", "/api/artists/", {"name": artist, "unique_name": artist}, (201, )),
+        ("POST", "/api/import/", tracks, "application/x-ndjson", (200, )),
+        _json("POST", album, {
+            "title": "two", "disc_number": 1, "track_number": 2, "length": "00:03:00", "lyrics": "la la"
+        }, (201, )),
+        ("DELETE", album + "/1/2/", None, None, (204, )),
+        ("DELETE", album, None, None, (204, )),
+        ("DELETE", "/api/artists/{}/".format(artist), None, None, (204, )),
+    ]
+
+def _choreography_lifecycle(w):
+    name = "load-{}-{}".format(w.number, next(w.counter))
+    return [
+        _json("POST", "/api/choreographies/", {"name": name, "description": "moves"}, (201, )),
+        ("DELETE", "/api/choreographies/{}/".format(name), None, None, (204, )),
+    ]
+
+def _sample(w, count, size=20):
+    return w.rng.sample(range(count), min(size, count))
+
+def _describe_choreographies(w):
+    return [_json("PATCH", "/api/choreographies/", {"items": [
+        {"key": "chore-{}".format(c), "changes": {"description": "moves {}".format(w.rng.random())}}
+        for c in _sample(w, CHOREOGRAPHIES)
+    ]}, (200, ))]
+
+def _retag_albums(w):
+    return [_json("PATCH", "/api/albums/", {"items": [
+        {"key": {"artist": w.catalog.artist(a // ALBUMS_PER_ARTIST), "title": w.catalog.album(a)},
+         "changes": {"genre": w.rng.choice(GENRES)}}
+        for a in _sample(w, w.catalog.albums)
+    ]}, (200, ))]
+
+def _rename_artists(w):
+    return [_json("PATCH", "/api/artists/", {"items": [
+        {"key": w.catalog.artist(a), "changes": {"name": "{} {}".format(w.catalog.artist(a), w.rng.random())}}
+        for a in _sample(w, w.catalog.artists)
+    ]}, (200, ))]
+
+def _bulk_lifecycle(w):
+    names = ["load-{}-{}".format(w.number, next(w.counter)) for i in range(2)]
+    albums = "\n".join(json.dumps({
+        "type": "album", "title": "album", "release": "2021-01-01", "artist": name, "genre": "Rock", "discs": 1
+    }) for name in names)
+    requests = [
+        _json("POST", "/api/choreographies/", {"name": name, "description": "moves"}, (201, ))
+        for name in names
+    ] + [
+        _json("POST", "/api/artists/", {"name": name, "unique_name": name}, (201, ))
+        for name in names
+    ]
+    return requests + [
+        ("POST", "/api/import/", albums, "application/x-ndjson", (200, )),
+        _json("DELETE", "/api/choreographies/", {"items": [{"key": name} for name in names]}, (200, )),
+        _json("DELETE", "/api/albums/", {"items": [
+            {"key": {"artist": name, "title": "album"}} for name in names
+        ]}, (200, )),
+        _json("DELETE", "/api/artists/", {"items": [{"key": name} for name in names]}, (200, )),
+    ]
+
+WRITES = [
+    ("PUT TrackItem", 40, _rename_track),
+    ("PUT AlbumItem", 15, _retag_album),
+    ("PUT ArtistItem", 10, _rename_artist),
+    ("PUT ChoreographyItem", 10, _describe_choreography),
+    ("POST Batch", 5, _batch),
+    ("PATCH ChoreographyCollection", 3, _describe_choreographies),
+    ("PATCH AlbumCollection", 3, _retag_albums),
+    ("PATCH ArtistCollection", 3, _rename_artists),
+    ("lifecycle Artist", 15, _artist_lifecycle),
+    ("lifecycle Choreography", 10, _choreography_lifecycle),
+    ("lifecycle Bulk", 3, _bulk_lifecycle),
+]
+
+# label of each request sent by the lifecycle operations, by method and a
+# regular expression matching the url
+LIFECYCLE_LABELS = [
+    ("POST", r"/albums/[^/]+$", "POST AlbumItem"),
+    ("POST", r"^/api/artists/$", "POST ArtistCollection"),
+    ("POST", r"^/api/import/$", "POST CatalogImport"),
+    ("POST", r"^/api/choreographies/$", "POST ChoreographyCollection"),
+    ("DELETE", r"^/api/choreographies/$", "DELETE ChoreographyCollection"),
+    ("DELETE", r"^/api/choreographies/[^/]+/$", "DELETE ChoreographyItem"),
+    ("DELETE", r"/1/2/$", "DELETE TrackItem"),
+    ("DELETE", r"/albums/[^/]+$", "DELETE AlbumItem"),
+    ("DELETE", r"^/api/albums/$", "DELETE AlbumCollection"),
+    ("DELETE", r"^/api/artists/$", "DELETE ArtistCollection"),
+    ("DELETE", r"^/api/artists/[^/]+/$", "DELETE ArtistItem"),
+]
+
+
+def _label(operation, method, url):
+    if not operation.startswith("lifecycle"):
+        return operation
+    for lifecycle_method, pattern, label in LIFECYCLE_LABELS:
+        if method == lifecycle_method and re.search(pattern, url):
+            return label
+    raise ValueError("No label for {} {}".format(method, url))
+
+
+def check_coverage():
+    """
+    Checks that the operations send every method of every resource added
+    with api.add_resource in the current tree.
+    """
+
+    from app import api
+
+    labels = {label for label, weight, operation in READS + WRITES}
+    labels.update(label for method, part, label in LIFECYCLE_LABELS)
+    missing = []
+    for resource, urls, kwargs in api.resources:
+        for method in sorted(resource.methods or ()):
+            if method in ("HEAD", "OPTIONS"):
+                continue
+            if "{} {}".format(method, resource.__name__) not in labels:
+                missing.append("{} {}".format(method, resource.__name__))
+    if missing:
+        raise SystemExit("No load test operation for: " + ", ".join(missing))
+
+
+class Worker(threading.Thread):
+    """
+    Sends operations to the server over a connection of its own until the
+    deadline and records the latency of every request sent after the
+    warmup.
+    """
+
+    def __init__(self, number, port, catalog, write_ratio, warmup_end, deadline):
+        super().__init__()
+        self.number = number
+        self.port = port
+        self.catalog = catalog
+        self.write_ratio = write_ratio
+        self.warmup_end = warmup_end
+        self.deadline = deadline
+        self.rng = random.Random(catalog.seed * 1000 + number)
+        self.counter = itertools.count()
+        self.latencies = {}
+        self.errors = {}
+
+    def _choose(self):
+        operations = WRITES if self.rng.random() < self.write_ratio else READS
+        label, weight, operation = self.rng.choices(operations, weights=[op[1] for op in operations])[0]
+        return label, operation(self)
+
+    def run(self):
+        connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=600)
+        while time.perf_counter() < self.deadline:
+            operation, requests = self._choose()
+            for method, url, body, content_type, expected in requests:
+                headers = {"Content-Type": content_type} if content_type else {}
+                start = time.perf_counter()
+                try:
+                    connection.request(method, url, body=body, headers=headers)
+                    resp = connection.getresponse()
+                    resp.read()
+                    ok = resp.status in expected
+                except (http.client.HTTPException, OSError):
+                    connection.close()
+                    ok = False
+                end = time.perf_counter()
+                if start < self.warmup_end:
+                    continue
+                label = _label(operation, method, url)
+                if ok:
+                    self.latencies.setdefault(label, []).append(end - start)
+                else:
+                    self.errors[label] = self.errors.get(label, 0) + 1
+        connection.close()
+
+
+def _percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(latencies, errors, seconds):
+    """
+    Returns count, errors, throughput and p50/p95/p99 in milliseconds.
+    """
+
+    ordered = sorted(latencies)
+    summary = {"count": len(ordered), "errors": errors, "throughput": len(ordered) / seconds}
+    for name, fraction in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99)):
+        summary[name] = _percentile(ordered, fraction) * 1000 if ordered else None
+    return summary
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for_server(process, port):
+    deadline = time.perf_counter() + SERVER_START_TIMEOUT
+    while time.perf_counter() < deadline:
+        if process.poll() is not None:
+            raise SystemExit("The server exited with status {}".format(process.returncode))
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            connection.request("GET", "/api/")
+            if connection.getresponse().status == 200:
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise SystemExit("The server didn't start in {} s".format(SERVER_START_TIMEOUT))
+
+
+def seed(port, catalog):
+    """
+    Imports the catalog through the import endpoint in chunks. Using the
+    API instead of the models lets any revision with the endpoint be seeded
+    with the same data.
+    """
+
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=3600)
+    records = catalog.records()
+    while True:
+        chunk = "\n".join(json.dumps(record) for record in itertools.islice(records, IMPORT_CHUNK_LINES))
+        if not chunk:
+            break
+        connection.request("POST", "/api/import/", body=chunk.encode("utf-8"),
+            headers={"Content-Type": "application/x-ndjson"}
+        )
+        resp = connection.getresponse()
+        body = json.loads(resp.read())
+        if resp.status != 200 or body["errors"]:
+            raise SystemExit("Seeding failed: {} {}".format(resp.status, body.get("errors", body)[:5]))
+    connection.close()
+
+
+def _revision(cwd):
+    return subprocess.run(
+        ["git", "describe", "--always", "--dirty"], cwd=cwd,
+        check=True, stdout=subprocess.PIPE, universal_newlines=True
+    ).stdout.strip()
+
+
+def run(args, cwd=None):
+    """
+    Load tests the tree in cwd, the current directory by default, and
+    returns the results.
+    """
+
+    catalog = Catalog(SCALES.get(args.scale) or int(args.scale), args.seed)
+    db_fd, db_fname = tempfile.mkstemp()
+    os.close(db_fd)
+    port = _free_port()
+    server = subprocess.Popen(
+        [sys.executable, "-c", SERVER_SCRIPT, db_fname, str(port), args.profile], cwd=cwd
+    )
+    try:
+        _wait_for_server(server, port)
+        start = time.perf_counter()
+        seed(port, catalog)
+        print("seeded {:,} tracks in {:.1f} s".format(catalog.tracks, time.perf_counter() - start))
+
+        warmup_end = time.perf_counter() + args.warmup
+        deadline = warmup_end + args.seconds
+        workers = [
+            Worker(number, port, catalog, MIXES[args.mix], warmup_end, deadline)
+            for number in range(args.workers)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    finally:
+        server.terminate()
+        server.wait()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_fname + suffix):
+                os.unlink(db_fname + suffix)
+
+    latencies, errors = {}, {}
+    for worker in workers:
+        for label, values in worker.latencies.items():
+            latencies.setdefault(label, []).extend(values)
+        for label, count in worker.errors.items():
+            errors[label] = errors.get(label, 0) + count
+    labels = sorted(set(latencies) | set(errors))
+    return {
+        "revision": _revision(cwd),
+        "settings": {
+            "scale": args.scale, "tracks": catalog.tracks, "mix": args.mix, "workers": args.workers,
+            "seconds": args.seconds, "warmup": args.warmup, "profile": args.profile, "seed": args.seed,
+        },
+        "resources": {
+            label: summarize(latencies.get(label, []), errors.get(label, 0), args.seconds)
+            for label in labels
+        },
+        "total": summarize(
+            [value for values in latencies.values() for value in values],
+            sum(errors.values()), args.seconds
+        ),
+    }
+
+
+def run_revision(args, revision):
+    """
+    Checks out a git revision into a temporary worktree and load tests it.
+    """
+
+    worktree = tempfile.mkdtemp()
+    subprocess.run(["git", "worktree", "add", "--detach", worktree, revision], check=True)
+    try:
+        return run(args, cwd=worktree)
+    finally:
+        subprocess.run(["git", "worktree", "remove", "--force", worktree], check=True)
+        shutil.rmtree(worktree, ignore_errors=True)
+
+
+def print_results(results):
+    print("revision {}, {:,} tracks, {} mix".format(
+        results["revision"], results["settings"]["tracks"], results["settings"]["mix"]
+    ))
+    print("{:<32} {:>8} {:>7} {:>9} {:>9} {:>9} {:>9}".format(
+        "resource", "count", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms"
+    ))
+    rows = sorted(results["resources"].items()) + [("total", results["total"])]
+    for label, summary in rows:
+        print("{:<32} {:>8} {:>7} {:>9.1f} {:>9} {:>9} {:>9}".format(
+            label, summary["count"], summary["errors"], summary["throughput"],
+            *["-" if summary[p] is None else "{:.2f}".format(summary[p]) for p in ("p50", "p95", "p99")]
+        ))
+
+
+def compare(old, new, threshold, min_count):
+    """
+    Prints the change of each resource's latency and returns the labels of
+    the resources whose p50 or p95 grew by more than threshold. Resources
+    with fewer than min_count requests in either run are not flagged.
+    """
+
+    regressions = []
+    print("{:<32} {:>10} {:>10} {:>8}   {:>10} {:>10} {:>8}".format(
+        "resource", "old p50", "new p50", "change", "old p95", "new p95", "change"
+    ))
+    for label in sorted(set(old["resources"]) & set(new["resources"])):
+        before, after = old["resources"][label], new["resources"][label]
+        cells, regressed = [], False
+        enough = min(before["count"], after["count"]) >= min_count
+        for p in ("p50", "p95"):
+            if before[p] is None or after[p] is None:
+                cells += ["-", "-", "-"]
+                continue
+            change = after[p] / before[p] - 1
+            regressed = regressed or (enough and change > threshold)
+            cells += ["{:.2f}".format(before[p]), "{:.2f}".format(after[p]), "{:+.0%}".format(change)]
+        print("{:<32} {:>10} {:>10} {:>8}   {:>10} {:>10} {:>8}{}".format(
+            label, *cells, "  REGRESSION" if regressed else ""
+        ))
+        if regressed:
+            regressions.append(label)
+    for label in sorted(set(old["resources"]) ^ set(new["resources"])):
+        print("{:<32} only in {}".format(label, "old" if label in old["resources"] else "new"))
+    return regressions
+
+
+def _load(args, which):
+    if os.path.isfile(which):
+        with open(which) as f:
+            return json.load(f)
+    results = run_revision(args, which)
+    print_results(results)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+    run_parser = commands.add_parser("run", help="load test the working tree")
+    compare_parser = commands.add_parser("compare", help="compare two results files or git revisions")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=0.1,
+        help="relative latency increase reported as a regression"
+    )
+    compare_parser.add_argument("--min-count", type=int, default=50,
+        help="requests a resource needs in both runs to be flagged"
+    )
+    for sub in (run_parser, compare_parser):
+        sub.add_argument("--scale", default="1k", help="one of {} or a number of tracks".format(", ".join(SCALES)))
+        sub.add_argument("--mix", choices=MIXES, default="mixed")
+        sub.add_argument("--workers", type=int, default=8)
+        sub.add_argument("--seconds", type=float, default=30.0)
+        sub.add_argument("--warmup", type=float, default=5.0)
+        sub.add_argument("--profile", default="production", help="SQLite storage profile of the server")
+        sub.add_argument("--seed", type=int, default=1)
+        sub.add_argument("--output", help="file the results are written to")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        check_coverage()
+        results = run(args)
+        print_results(results)
+        output = args.output or "load-{}-{}.json".format(args.scale, args.mix)
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+        return
+
+    old, new = _load(args, args.old), _load(args, args.new)
+    if old["settings"] != new["settings"]:
+        print("warning: the runs used different settings")
+    regressions = compare(old, new, args.threshold, args.min_count)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"old": old, "new": new, "regressions": regressions}, f, indent=2)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
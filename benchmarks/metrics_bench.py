@@ -0,0 +1,59 @@
+"""
+Measures what recording metrics adds to every request: the work
+MetricsMiddleware does around the application, including the lookup of
+the resource name and the update of all histograms, and the SQL statement
+hooks. Fails if recording a request costs more than the budget.
+
+Run from the repository root:
+
+    python -m benchmarks.metrics_bench [--number N]
+"""
+
+import argparse
+import timeit
+from types import SimpleNamespace
+
+from app import AlbumItem
+from metrics import MetricsMiddleware, RequestMetrics, _after_cursor_execute, _before_cursor_execute
+
+REQUEST_BUDGET = 5e-6
+
+HEADERS = [("Content-Type", "application/vnd.mason+json"), ("Content-Length", "2048"), ("ETag", '"1"')]
+
+
+def _wsgi_app(environ, start_response):
+    start_response("200 OK", HEADERS)
+    return [b""]
+
+
+def _per_call(func, number):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--number", type=int, default=100000)
+    args = parser.parse_args()
+
+    # what Flask leaves in the environ of a request routed to AlbumItem
+    rule = SimpleNamespace(endpoint="albumitem")
+    environ = {"REQUEST_METHOD": "GET", "werkzeug.request": SimpleNamespace(url_rule=rule)}
+    app = SimpleNamespace(wsgi_app=_wsgi_app, view_functions={"albumitem": AlbumItem.as_view("albumitem")})
+    middleware = MetricsMiddleware(app, RequestMetrics())
+    start_response = lambda status, headers, exc_info=None: None
+
+    bare = _per_call(lambda: _wsgi_app(environ, start_response), args.number)
+    recorded = _per_call(lambda: middleware(environ, start_response), args.number)
+    statement = _per_call(lambda: (
+        _before_cursor_execute(None, None, "", (), None, False),
+        _after_cursor_execute(None, None, "", (), None, False)
+    ), args.number)
+
+    print("{:<24} {:>8.2f} us".format("per request", (recorded - bare) * 1e6))
+    print("{:<24} {:>8.2f} us".format("per SQL statement", statement * 1e6))
+    if recorded - bare > REQUEST_BUDGET:
+        raise SystemExit("Recording a request takes more than {:.0f} us".format(REQUEST_BUDGET * 1e6))
+
+
+if __name__ == "__main__":
+    main()
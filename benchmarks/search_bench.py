@@ -0,0 +1,129 @@
+"""
+Compares the track search endpoint, which uses the FTS5 index, with finding
+tracks by a LIKE '%word%' scan over the lyrics. A synthetic corpus of tracks
+whose lyrics are drawn from a Zipf distributed vocabulary is written to a
+fresh SQLite database, then common, medium and rare words are searched for.
+
+Run from the repository root:
+
+    python -m benchmarks.search_bench [--tracks N] [--repeat N]
+"""
+
+import argparse
+import itertools
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import date, time as dtime
+
+from app import create_app, db, response_cache, Album, Artist, Track
+
+VOCABULARY_SIZE = 20000
+WORDS_PER_TRACK = 40
+TRACKS_PER_ALBUM = 12
+CHUNK_SIZE = 50000
+SYLLABLES = ["ka", "ri", "mo", "lu", "se", "ta", "no", "vi", "da", "ko", "mi", "ra", "zu", "pe"]
+
+
+def _vocabulary(rng):
+    words = set()
+    while len(words) < VOCABULARY_SIZE:
+        words.add("".join(rng.choice(SYLLABLES) for i in range(rng.randint(2, 4))))
+    return sorted(words, key=lambda word: rng.random())
+
+
+def build_corpus(tracks, rng):
+    """
+    Fills the current application's database with tracks and returns the
+    vocabulary ordered from the most to the least frequent word.
+    """
+
+    vocabulary = _vocabulary(rng)
+    cum_weights = list(itertools.accumulate(1.0 / (rank + 1) for rank in range(len(vocabulary))))
+    albums = (tracks + TRACKS_PER_ALBUM - 1) // TRACKS_PER_ALBUM
+    db.session.execute(Artist.__table__.insert(), {"id": 1, "name": "Synthetic", "unique_name": "synthetic"})
+    db.session.execute(Album.__table__.insert(), [
+        {"id": a + 1, "title": "album-{}".format(a), "release": date(2020, 1, 1), "artist_id": 1, "discs": 1}
+        for a in range(albums)
+    ])
+    for start in range(0, tracks, CHUNK_SIZE):
+        rows = []
+        for t in range(start, min(start + CHUNK_SIZE, tracks)):
+            rows.append({
+                "title": "track-{}".format(t),
+                "disc_number": 1,
+                "track_number": t % TRACKS_PER_ALBUM + 1,
+                "length": dtime(0, 3, 30),
+                "lyrics": " ".join(rng.choices(vocabulary, cum_weights=cum_weights, k=WORDS_PER_TRACK)),
+                "album_id": t // TRACKS_PER_ALBUM + 1,
+            })
+        db.session.execute(Track.__table__.insert(), rows)
+    db.session.commit()
+    return vocabulary
+
+
+def _median_ms(func, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--tracks", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    db_fd, db_fname = tempfile.mkstemp()
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname, "SQLITE_PROFILE": "bulk-load"})
+    try:
+        with app.app_context():
+            db.create_all()
+            start = time.perf_counter()
+            vocabulary = build_corpus(args.tracks, random.Random(1))
+            print("built {:,} tracks in {:.1f} s".format(args.tracks, time.perf_counter() - start))
+
+            client = app.test_client()
+
+            def search(word):
+                response_cache.clear()
+                resp = client.get("/api/search/tracks/?limit=20&q=" + word)
+                assert resp.status_code == 200
+
+            def like_page(word):
+                db.session.execute(
+                    "SELECT id FROM track WHERE lyrics LIKE :p LIMIT 20", {"p": "%" + word + "%"}
+                ).fetchall()
+
+            def like_all(word):
+                db.session.execute(
+                    "SELECT count(*) FROM track WHERE lyrics LIKE :p", {"p": "%" + word + "%"}
+                ).scalar()
+
+            print("{:<8} {:>12} {:>14} {:>16} {:>14}".format(
+                "word", "frequency", "LIKE page ms", "LIKE count ms", "search ms"
+            ))
+            for rank in (0, 100, 5000, VOCABULARY_SIZE - 1):
+                word = vocabulary[rank]
+                print("{:<8} {:>12} {:>14.2f} {:>16.2f} {:>14.2f}".format(
+                    word, "rank {}".format(rank + 1),
+                    _median_ms(lambda: like_page(word), args.repeat),
+                    _median_ms(lambda: like_all(word), args.repeat),
+                    _median_ms(lambda: search(word), args.repeat),
+                ))
+            db.session.remove()
+            db.engine.dispose()
+    finally:
+        os.close(db_fd)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_fname + suffix):
+                os.unlink(db_fname + suffix)
+
+
+if __name__ == "__main__":
+    main()
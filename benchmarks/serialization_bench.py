@@ -0,0 +1,74 @@
+"""
+Measures the encode throughput of the serialization layer for large
+collections. Album bodies with many tracks, whose items contain dates and
+times, are encoded with every available encoder and, for reference, the
+way responses were encoded before: dates turned into strings by the
+resources and the body passed to json.dumps and encoded to UTF-8.
+
+Run from the repository root:
+
+    python -m benchmarks.serialization_bench [--items N ...] [--repeat N]
+"""
+
+import argparse
+import json
+import statistics
+import time as timer
+from datetime import date, time
+
+from serialization import ENCODERS
+
+
+def album_body(items, as_strings=False):
+    """
+    Returns a Mason album body with items tracks shaped like the ones
+    AlbumItem builds.
+    """
+
+    convert = (lambda value: value.isoformat()) if as_strings else (lambda value: value)
+    body = {
+        "title": "album", "release": convert(date(2020, 1, 1)), "genre": "Rock", "discs": 1,
+        "@namespaces": {"stadium": {"name": "/api/link-relations/"}},
+        "@controls": {"self": {"href": "/api/artists/artist/albums/album"}},
+    }
+    body["items"] = [{
+        "title": "track-{}".format(i), "length": convert(time(0, 3, 30)),
+        "disc_number": 1, "track_number": i + 1,
+        "@controls": {
+            "self": {"href": "/api/artists/artist/albums/album/1/{}/".format(i + 1)},
+            "profile": {"href": "/profiles/track/"},
+        },
+    } for i in range(items)]
+    return body
+
+
+def _median(func, repeat):
+    times = []
+    for i in range(repeat):
+        start = timer.perf_counter()
+        func()
+        times.append(timer.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--items", type=int, nargs="+", default=[100, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=7)
+    args = parser.parse_args()
+
+    print("{:<16} {:>8} {:>10} {:>12} {:>12}".format("encoder", "items", "ms", "items/s", "MB/s"))
+    for items in args.items:
+        body, strings = album_body(items), album_body(items, as_strings=True)
+        encoders = [("json.dumps", lambda: json.dumps(strings).encode("utf-8"))]
+        encoders += [(name, lambda encode=encode: encode(body)) for name, encode in ENCODERS.items()]
+        for name, encode in encoders:
+            size = len(encode())
+            elapsed = _median(encode, args.repeat)
+            print("{:<16} {:>8} {:>10.2f} {:>12,.0f} {:>12.1f}".format(
+                name, items, elapsed * 1000, items / elapsed, size / elapsed / 1e6
+            ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Measures how long it takes to import the application module and to answer
+the first request, each in a fresh interpreter, and fails if either goes
+over its budget. Also checks that importing the module has no side effects:
+it must not import jsonschema or flask_cors and must not create any files.
+
+Run from the repository root:
+
+    python -m benchmarks.startup_bench [--repeat N]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+IMPORT_BUDGET = 1.0
+FIRST_REQUEST_BUDGET = 0.25
+
+IMPORT_SCRIPT = """
+import json, os, sys, time
+before = set(os.listdir("."))
+start = time.perf_counter()
+import app
+elapsed = time.perf_counter() - start
+print(json.dumps({
+    "time": elapsed,
+    "modules": sorted(m for m in ("jsonschema", "flask_cors") if m in sys.modules),
+    "files": sorted(set(os.listdir(".")) - before),
+}))
+"""
+
+REQUEST_SCRIPT = """
+import json, sys, time
+from app import create_app
+start = time.perf_counter()
+app = create_app({"SQLALCHEMY_DATABASE_URI": sys.argv[1]})
+resp = app.test_client().get("/api/choreographies/")
+elapsed = time.perf_counter() - start
+assert resp.status_code == 200, resp.status_code
+print(json.dumps({"time": elapsed}))
+"""
+
+
+def _run(script, *args):
+    out = subprocess.run(
+        [sys.executable, "-c", script] + list(args),
+        check=True, stdout=subprocess.PIPE, universal_newlines=True
+    ).stdout
+    return json.loads(out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    failures = []
+    imports = [_run(IMPORT_SCRIPT) for i in range(args.repeat)]
+    if imports[0]["modules"]:
+        failures.append("importing app imported {}".format(", ".join(imports[0]["modules"])))
+    if imports[0]["files"]:
+        failures.append("importing app created {}".format(", ".join(imports[0]["files"])))
+
+    db_fd, db_fname = tempfile.mkstemp()
+    uri = "sqlite:///" + db_fname
+    try:
+        subprocess.run(
+            [sys.executable, "-m", "flask", "seed"], check=True, stdout=subprocess.DEVNULL,
+            env=dict(os.environ, FLASK_APP="app:create_app({{'SQLALCHEMY_DATABASE_URI': '{}'}})".format(uri))
+        )
+        requests = [_run(REQUEST_SCRIPT, uri) for i in range(args.repeat)]
+    finally:
+        os.close(db_fd)
+        os.unlink(db_fname)
+
+    for name, runs, budget in [
+        ("cold import", imports, IMPORT_BUDGET),
+        ("first request", requests, FIRST_REQUEST_BUDGET),
+    ]:
+        median = statistics.median(run["time"] for run in runs)
+        print("{:<14} {:>8.1f} ms  (budget {:.0f} ms)".format(name, median * 1000, budget * 1000))
+        if median > budget:
+            failures.append("{} took {:.0f} ms".format(name, median * 1000))
+
+    for failure in failures:
+        print("FAIL: " + failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Compares the SQLite storage profiles under a mixed read/write load. For each
+profile a synthetic catalog is imported into a fresh database, then a number
+of threads run for a fixed time, each either reading the tracks of a random
+album or renaming a random track and committing. Reports reads and writes
+per second and how many operations failed with "database is locked".
+
+Run from the repository root:
+
+    python -m benchmarks.storage_bench [--threads N] [--seconds S] [--writes F]
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+
+from sqlalchemy.exc import OperationalError
+
+from app import create_app, db, Track
+from benchmarks.import_bench import generate_catalog
+from storage import PROFILES
+
+
+def _worker(app, deadline, write_ratio, counts, lock):
+    rng = random.Random()
+    reads = writes = locked = 0
+    with app.app_context():
+        albums = db.session.query(db.func.max(Track.album_id)).scalar()
+        tracks = db.session.query(db.func.max(Track.id)).scalar()
+        while time.perf_counter() < deadline:
+            try:
+                if rng.random() < write_ratio:
+                    db.session.query(Track).filter(Track.id == rng.randint(1, tracks)).update(
+                        {"title": "renamed-{}".format(rng.random())}, synchronize_session=False
+                    )
+                    db.session.commit()
+                    writes += 1
+                else:
+                    Track.query.filter_by(album_id=rng.randint(1, albums)).all()
+                    db.session.commit()
+                    reads += 1
+            except OperationalError as e:
+                db.session.rollback()
+                if "locked" not in str(e):
+                    raise
+                locked += 1
+        db.session.remove()
+    with lock:
+        counts["reads"] += reads
+        counts["writes"] += writes
+        counts["locked"] += locked
+
+
+def run_profile(profile, data, threads, seconds, write_ratio):
+    db_fd, db_fname = tempfile.mkstemp()
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "SQLITE_PROFILE": profile
+    })
+    try:
+        with app.app_context():
+            db.create_all()
+            resp = app.test_client().post(
+                "/api/import/", data=data, content_type="application/x-ndjson"
+            )
+            assert resp.status_code == 200, resp.status_code
+
+        counts = {"reads": 0, "writes": 0, "locked": 0}
+        lock = threading.Lock()
+        deadline = time.perf_counter() + seconds
+        workers = [
+            threading.Thread(target=_worker, args=(app, deadline, write_ratio, counts, lock))
+            for i in range(threads)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        with app.app_context():
+            db.engine.dispose()
+        return counts
+    finally:
+        os.close(db_fd)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_fname + suffix):
+                os.unlink(db_fname + suffix)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--writes", type=float, default=0.1, help="fraction of writes")
+    parser.add_argument("--artists", type=int, default=200)
+    args = parser.parse_args()
+
+    data, rows = generate_catalog(args.artists, 10, 12)
+    print("{:<10} {:>10} {:>10} {:>8}".format("profile", "reads/s", "writes/s", "locked"))
+    for profile in PROFILES:
+        counts = run_profile(profile, data, args.threads, args.seconds, args.writes)
+        print("{:<10} {:>10,.0f} {:>10,.0f} {:>8}".format(
+            profile,
+            counts["reads"] / args.seconds,
+            counts["writes"] / args.seconds,
+            counts["locked"]
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Compares the cost of validating one request document the old way, with
+jsonschema.validate and a freshly built schema, to validating it with the
+compiled validators of the schema registry.
+
+Run from the repository root:
+
+    python -m benchmarks.validation_bench [--number N]
+"""
+
+import argparse
+import timeit
+
+import jsonschema
+from jsonschema import validate
+
+from app import schemas, Album, Artist, Choreography, Track
+from schemas import ValidationError
+
+DOCUMENTS = [
+    (Artist, {"name": "testartist", "unique_name": "testartist"}),
+    (Album, {"title": "title1"}),
+    (Choreography, {"name": "chore", "description": "descchore"}),
+    (Track, {"disc_number": 1, "track_number": 8, "album_id": 1}),
+    (Choreography, {"name": "chore"}),
+]
+
+
+def _per_request(func, number):
+    """
+    Returns the average time of one call to func in microseconds. Errors
+    raised for invalid documents are part of the measured cost.
+    """
+
+    def call():
+        try:
+            func()
+        except (ValidationError, jsonschema.ValidationError):
+            pass
+
+    return min(timeit.repeat(call, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--number", type=int, default=2000,
+        help="validations per measurement"
+    )
+    args = parser.parse_args()
+
+    print("{:<14} {:>8} {:>12} {:>12} {:>8}".format(
+        "model", "valid", "before (us)", "after (us)", "speedup"
+    ))
+    for model, document in DOCUMENTS:
+        before = _per_request(lambda: validate(document, model.get_schema()), args.number)
+        after = _per_request(lambda: schemas.validate(document, model), args.number)
+        try:
+            schemas.validate(document, model)
+            valid = "yes"
+        except ValidationError:
+            valid = "no"
+        print("{:<14} {:>8} {:>12.2f} {:>12.2f} {:>7.1f}x".format(
+            model.__name__, valid, before, after, before / after
+        ))
+
+
+if __name__ == "__main__":
+    main()
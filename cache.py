@@ -0,0 +1,145 @@
+import threading
+from collections import OrderedDict, namedtuple
+
+# variants holds compressed copies of data by content coding
+CacheEntry = namedtuple("CacheEntry", ["path", "data", "mimetype", "etag", "variants"])
+
+
+class ResponseCache(object):
+    """
+    An in-process cache of serialized response bodies. Entries are kept in
+    least recently used order and evicted when either the number of entries
+    or their total size goes over its limit. Every entry remembers the path
+    it was stored for so that write handlers can invalidate all the cached
+    variants (query strings, representations) of a resource at once.
+    Compressed copies of a body are stored with its entry, count towards its
+    size and are dropped with it.
+
+    Hit, miss and eviction counts are kept for sizing the cache.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=32 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = 0
+        self._entries = OrderedDict()
+        self._paths = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the entry stored with key, or None. A hit makes the entry the
+        most recently used one.
+
+        : param key: a hashable identifying the URL and representation
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, path, data, mimetype, etag=None):
+        """
+        Stores a response body. Bodies that are larger than the whole cache
+        are not stored at all.
+
+        : param key: a hashable identifying the URL and representation
+        : param str path: path of the resource, used for invalidation
+        : param bytes data: the serialized body
+        : param str mimetype: media type of the body
+        : param str etag: entity tag of the body, if any
+        """
+
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = CacheEntry(path, data, mimetype, etag, {})
+            self._paths.setdefault(path, set()).add(key)
+            self._size += len(data)
+            self._evict()
+
+    def put_variant(self, key, etag, coding, data):
+        """
+        Stores the body of an entry compressed with a content coding. It is
+        not stored if the entry has been replaced or removed since it was
+        read, which is detected by comparing etag.
+
+        : param key: the key of the entry
+        : param str etag: entity tag of the entry that was compressed
+        : param str coding: the content coding, such as gzip
+        : param bytes data: the compressed body
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.etag != etag or coding in entry.variants:
+                return
+            entry.variants[coding] = data
+            self._size += len(data)
+            self._evict()
+
+    def invalidate(self, *paths):
+        """
+        Drops every entry stored for the given paths regardless of their
+        query string or representation.
+        """
+
+        with self._lock:
+            for path in paths:
+                for key in list(self._paths.get(path, ())):
+                    self._remove(key)
+
+    def invalidate_prefix(self, prefix):
+        """
+        Drops every entry whose path is prefix or a sub path of it. Used when
+        a resource that appears in the URLs of other resources is modified.
+        """
+
+        prefix = prefix.rstrip("/")
+        with self._lock:
+            for path in [p for p in self._paths if p == prefix or p.startswith(prefix + "/")]:
+                for key in list(self._paths[path]):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._paths.clear()
+            self._size = 0
+
+    def stats(self):
+        """
+        Returns the counters and current size of the cache as a dictionary.
+        """
+
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry.data) + sum(len(data) for data in entry.variants.values())
+            keys = self._paths[entry.path]
+            keys.discard(key)
+            if not keys:
+                del self._paths[entry.path]
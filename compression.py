@@ -0,0 +1,75 @@
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# media types of the responses that are compressed
+COMPRESSIBLE = frozenset([
+    "application/vnd.mason+json",
+    "application/json",
+    "application/x-ndjson",
+    "text/csv",
+    "text/plain",
+])
+
+
+def compress_gzip(data, level=6):
+    # a fixed modification time makes the output depend only on data
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def compress_brotli(data, level=5):
+    return brotli.compress(data, quality=level)
+
+
+# the available content codings by name, in order of preference
+CODINGS = {}
+if brotli is not None:
+    CODINGS["br"] = compress_brotli
+CODINGS["gzip"] = compress_gzip
+
+
+def negotiate(accept_encodings):
+    """
+    Returns the content coding to use for a client, or None if it accepts
+    none of the available ones. When the client accepts several codings
+    equally, the one listed first in CODINGS is used.
+
+    : param accept_encodings: the request's werkzeug Accept-Encoding header
+    """
+
+    return accept_encodings.best_match(CODINGS)
+
+
+def compress(data, coding, levels=None):
+    """
+    Compresses data with a content coding from CODINGS.
+
+    : param dict levels: compression level by coding, the coding's default
+        when missing
+    """
+
+    level = (levels or {}).get(coding)
+    if level is None:
+        return CODINGS[coding](data)
+    return CODINGS[coding](data, level)
+
+
+def coding_etag(etag, coding):
+    """
+    Returns the entity tag of the representation with the given coding.
+    Every coding has its own tag because the bodies differ byte by byte.
+    """
+
+    return "{}-{}".format(etag, coding)
+
+
+def etag_variants(etag):
+    """
+    Returns the entity tag of the uncompressed representation and those of
+    every coding.
+    """
+
+    return [etag] + [coding_etag(etag, coding) for coding in CODINGS]
@@ -0,0 +1,299 @@
+import threading
+from time import perf_counter
+from bisect import bisect_left
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+PROMETHEUS = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+SQL_TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+
+class _RequestState(object):
+    """
+    What is recorded about the request running in one thread. Every thread
+    has one instance that is reused for all its requests, and it is also
+    the start_response that MetricsMiddleware passes to the application,
+    so recording a request doesn't allocate anything.
+    """
+
+    __slots__ = ("started", "statements", "sql_time", "statement_started",
+                 "environ", "start_response", "status", "headers", "rule")
+
+    def __init__(self):
+        self.started = 0.0
+        self.statements = 0
+        self.sql_time = 0.0
+        self.statement_started = 0.0
+        self.environ = self.start_response = self.status = self.headers = self.rule = None
+
+    def __call__(self, status, headers, exc_info=None):
+        # Werkzeug keeps the request object in the environ until Flask
+        # pops the request context, which happens after the response
+        # has been started
+        flask_request = self.environ.get("werkzeug.request")
+        self.rule = flask_request.url_rule if flask_request is not None else None
+        self.status = status
+        self.headers = headers
+        return self.start_response(status, headers, exc_info)
+
+
+class _Local(threading.local):
+
+    def __init__(self):
+        self.state = _RequestState()
+
+_local = _Local()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    _local.state.statement_started = perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    state = _local.state
+    state.statements += 1
+    state.sql_time += perf_counter() - state.statement_started
+
+def install_sql_timing():
+    """
+    Counts and times the SQL statements executed by every engine in the
+    thread that runs them. Installing more than once has no effect.
+    """
+
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+
+
+class Histogram(object):
+    """
+    A histogram with fixed bucket upper bounds. Counts are kept per bucket
+    and made cumulative only when rendered.
+    """
+
+    __slots__ = ("buckets", "counts", "sum")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+# name and bucket bounds of the histograms of every series, and where
+# their counts start in _Series.counts
+HISTOGRAMS = (
+    ("duration", LATENCY_BUCKETS),
+    ("size", SIZE_BUCKETS),
+    ("statements", STATEMENT_BUCKETS),
+    ("sql_time", SQL_TIME_BUCKETS),
+)
+_OFFSETS = [0]
+for _name, _buckets in HISTOGRAMS[:-1]:
+    _OFFSETS.append(_OFFSETS[-1] + len(_buckets) + 1)
+_DURATION, _SIZE, _STATEMENTS, _SQL_TIME = _OFFSETS
+
+
+class _Series(object):
+    """
+    The metrics of one resource and method. The bucket counts of all
+    histograms are kept in one flat list, and their sums in another, so
+    that recording a request touches as few objects as possible. Histogram
+    objects are only built when the metrics are rendered.
+    """
+
+    __slots__ = ("statuses", "counts", "sums")
+
+    def __init__(self):
+        self.statuses = {}
+        self.counts = [0] * sum(len(buckets) + 1 for name, buckets in HISTOGRAMS)
+        self.sums = [0] * len(HISTOGRAMS)
+
+    def histograms(self):
+        """
+        Returns copies of the histograms by name.
+        """
+
+        histograms = {}
+        for i, ((name, buckets), offset) in enumerate(zip(HISTOGRAMS, _OFFSETS)):
+            histogram = histograms[name] = Histogram(buckets)
+            histogram.counts = self.counts[offset:offset + len(buckets) + 1]
+            histogram.sum = self.sums[i]
+        return histograms
+
+
+def _labels(**labels):
+    return ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in labels.items()
+    )
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class RequestMetrics(object):
+    """
+    Request metrics per resource and HTTP method: the number of requests by
+    status, and histograms of the latency, the response size and the count
+    and total time of the SQL statements run for the request. finish is
+    called after every request by MetricsMiddleware.
+    Everything recorded for one request is stored with a single lock
+    acquisition, and the per thread request state is reset instead of
+    allocated.
+    """
+
+    def __init__(self):
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def finish(self, resource, method, status, size, state):
+        """
+        Records a request. size is None for responses whose length isn't
+        known, such as streamed ones. state is the _RequestState of the
+        thread, reset by MetricsMiddleware when the request started.
+        """
+
+        duration = perf_counter() - state.started
+        statements, sql_time = state.statements, state.sql_time
+        # the bucket indexes are found before taking the lock
+        duration_bucket = _DURATION + bisect_left(LATENCY_BUCKETS, duration)
+        statements_bucket = _STATEMENTS + bisect_left(STATEMENT_BUCKETS, statements)
+        sql_time_bucket = _SQL_TIME + bisect_left(SQL_TIME_BUCKETS, sql_time)
+        size_bucket = _SIZE + bisect_left(SIZE_BUCKETS, size) if size is not None else None
+        with self._lock:
+            series = self._series.get((resource, method))
+            if series is None:
+                series = self._series[resource, method] = _Series()
+            statuses = series.statuses
+            statuses[status] = statuses.get(status, 0) + 1
+            counts, sums = series.counts, series.sums
+            counts[duration_bucket] += 1
+            counts[statements_bucket] += 1
+            counts[sql_time_bucket] += 1
+            sums[0] += duration
+            sums[2] += statements
+            sums[3] += sql_time
+            if size_bucket is not None:
+                counts[size_bucket] += 1
+                sums[1] += size
+
+    def render(self, cache_stats=None):
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        cache_stats are the statistics of the response cache.
+        """
+
+        with self._lock:
+            requests = {
+                (resource, method, status): count
+                for (resource, method), value in self._series.items()
+                for status, count in value.statuses.items()
+            }
+            series = {key: value.histograms() for key, value in self._series.items()}
+
+        lines = [
+            "# HELP http_requests_total Requests by resource, method and status.",
+            "# TYPE http_requests_total counter",
+        ]
+        for (resource, method, status), count in sorted(requests.items()):
+            lines.append("http_requests_total{{{}}} {}".format(
+                _labels(resource=resource, method=method, status=status), count
+            ))
+        for name, attribute, description in [
+            ("http_request_duration_seconds", "duration", "Request latency."),
+            ("http_response_size_bytes", "size", "Response body size of requests with a known length."),
+            ("db_statements_per_request", "statements", "SQL statements executed per request."),
+            ("db_seconds_per_request", "sql_time", "Time spent executing SQL statements per request."),
+        ]:
+            lines.append("# HELP {} {}".format(name, description))
+            lines.append("# TYPE {} histogram".format(name))
+            for (resource, method), histograms in sorted(series.items()):
+                histogram = histograms[attribute]
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ("+Inf", ), histogram.counts):
+                    cumulative += count
+                    lines.append("{}_bucket{{{}}} {}".format(
+                        name, _labels(resource=resource, method=method, le=bound), cumulative
+                    ))
+                labels = _labels(resource=resource, method=method)
+                lines.append("{}_sum{{{}}} {}".format(name, labels, _number(histogram.sum)))
+                lines.append("{}_count{{{}}} {}".format(name, labels, cumulative))
+
+        if cache_stats is not None:
+            for stat, kind in [("hits", "counter"), ("misses", "counter"), ("evictions", "counter"),
+                               ("entries", "gauge"), ("bytes", "gauge")]:
+                name = "response_cache_{}{}".format(stat, "_total" if kind == "counter" else "")
+                lines.append("# TYPE {} {}".format(name, kind))
+                lines.append("{} {}".format(name, cache_stats[stat]))
+        return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware(object):
+    """
+    WSGI middleware that records every request of a Flask application in
+    RequestMetrics. It only reads the WSGI environ and the arguments of
+    start_response, which is much cheaper than going through Flask's
+    request proxies. The latency is measured until the response starts,
+    so for streamed responses it doesn't include sending the body.
+
+    : param app: the Flask application, whose wsgi_app is wrapped
+    """
+
+    def __init__(self, app, metrics):
+        self.wsgi_app = app.wsgi_app
+        self.view_functions = app.view_functions
+        self.metrics = metrics
+        self._resources = {}
+
+    def _resource(self, endpoint):
+        """
+        Returns the name of the Flask-RESTful resource class, or of the view
+        function, of an endpoint and keeps it for the next requests.
+        """
+
+        view = self.view_functions[endpoint]
+        resource = self._resources[endpoint] = getattr(view, "view_class", view).__name__
+        return resource
+
+    def __call__(self, environ, start_response):
+        # the state is reset here rather than in a RequestMetrics method
+        # to save a call on every request
+        state = _local.state
+        state.statements = 0
+        state.sql_time = 0.0
+        state.started = perf_counter()
+        state.environ = environ
+        state.start_response = start_response
+        state.status = None
+        try:
+            response = self.wsgi_app(environ, state)
+        finally:
+            state.environ = state.start_response = None
+        status = state.status
+        if status is not None:
+            headers = state.headers
+            state.headers = None
+            # Werkzeug sends Content-Length right after Content-Type when
+            # it's known, the other headers are only searched otherwise
+            if len(headers) > 1 and headers[1][0] == "Content-Length":
+                size = int(headers[1][1])
+            else:
+                size = None
+                for name, value in headers:
+                    if name == "Content-Length":
+                        size = int(value)
+                        break
+            rule = state.rule
+            if rule is None:
+                resource = "unrouted"
+            else:
+                resource = self._resources.get(rule.endpoint) or self._resource(rule.endpoint)
+            self.metrics.finish(resource, environ["REQUEST_METHOD"], int(status[:3]), size, state)
+        return response
@@ -0,0 +1,249 @@
+import cProfile
+import hmac
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+# suffixes of the files written for one profiled request
+PSTATS = ".prof"
+COLLAPSED = ".collapsed"
+METADATA = ".json"
+
+
+def token_allowed(token, tokens):
+    """
+    Checks a profiling token against the allowed ones in constant time, so
+    the time taken doesn't tell how much of a token was right.
+    """
+
+    if token is None:
+        return False
+    token = token.encode("utf-8")
+    allowed = False
+    for candidate in tokens:
+        allowed |= hmac.compare_digest(token, candidate.encode("utf-8"))
+    return allowed
+
+
+class StackSampler(threading.Thread):
+    """
+    Samples the stack of one thread at a fixed interval and counts the
+    stacks in the collapsed format of flamegraph.pl and speedscope: frames
+    from the outermost to the innermost, separated by semicolons.
+    """
+
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            if frames:
+                self.stacks[";".join(reversed(frames))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def collapsed(self):
+        return "".join("{} {}\n".format(stack, count) for stack, count in self.stacks.most_common())
+
+
+class ProfilingMiddleware(object):
+    """
+    WSGI middleware that runs selected requests under cProfile while a
+    StackSampler samples the request thread. A request is profiled when it
+    carries the profiling header with one of the allowed values, or at
+    random with the sample rate. Streamed responses are profiled until the
+    last chunk has been sent.
+
+    For every profiled request the pstats file, the collapsed stacks and a
+    JSON file with the resource class, HTTP method, path, status and
+    duration are written to the directory. File names start with the time
+    of the request, the resource and the method. Only the newest keep
+    profiles are kept.
+
+    : param app: the Flask application, whose wsgi_app is wrapped
+    """
+
+    def __init__(self, app, directory, header="X-Profile", tokens=(), sample_rate=0.0,
+                 keep=50, interval=0.001):
+        self.app = app
+        self.wsgi_app = app.wsgi_app
+        self.directory = directory
+        self.environ_key = "HTTP_" + header.upper().replace("-", "_")
+        self.tokens = frozenset(tokens)
+        self.sample_rate = sample_rate
+        self.keep = keep
+        self.interval = interval
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _selected(self, environ):
+        if self.tokens and token_allowed(environ.get(self.environ_key), self.tokens):
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def _resource(self, environ):
+        """
+        Returns the name of the Flask-RESTful resource class (or the view
+        function) that the request is routed to.
+        """
+
+        try:
+            endpoint, args = self.app.url_map.bind_to_environ(environ).match()
+        except Exception:
+            return "unrouted"
+        view = self.app.view_functions.get(endpoint)
+        return getattr(view, "view_class", view).__name__
+
+    def __call__(self, environ, start_response):
+        if not self._selected(environ):
+            return self.wsgi_app(environ, start_response)
+
+        status = []
+
+        def recording_start_response(status_line, headers, exc_info=None):
+            status.append(int(status_line.split(" ", 1)[0]))
+            return start_response(status_line, headers, exc_info)
+
+        profile = ProfiledRequest(self, environ)
+        profile.enable()
+        try:
+            response = self.wsgi_app(environ, recording_start_response)
+        except Exception:
+            profile.disable()
+            profile.finish(500)
+            raise
+        profile.disable()
+        return ProfiledResponse(response, profile, status)
+
+    def write(self, profile, status):
+        """
+        Writes the files of a finished profile and removes the oldest ones.
+        """
+
+        name = "{}{:06d}-{}-{}-{}".format(
+            time.strftime("%Y%m%dT%H%M%S", time.gmtime(profile.started)),
+            int(profile.started * 1000000) % 1000000,
+            profile.resource, profile.method, uuid.uuid4().hex[:8]
+        )
+        base = os.path.join(self.directory, name)
+        profile.profiler.dump_stats(base + PSTATS)
+        with open(base + COLLAPSED, "w") as f:
+            f.write(profile.sampler.collapsed())
+        with open(base + METADATA, "w") as f:
+            json.dump({
+                "name": name,
+                "resource": profile.resource,
+                "method": profile.method,
+                "path": profile.path,
+                "status": status,
+                "started": profile.started,
+                "duration": profile.duration,
+                "samples": sum(profile.sampler.stacks.values()),
+            }, f)
+        with self._lock:
+            for old in list_profiles(self.directory)[self.keep:]:
+                for suffix in (PSTATS, COLLAPSED, METADATA):
+                    try:
+                        os.unlink(os.path.join(self.directory, old["name"] + suffix))
+                    except FileNotFoundError:
+                        pass
+
+
+class ProfiledRequest(object):
+    """
+    The profiler and stack sampler of one request. Profiling can be switched
+    on and off, so that only the time spent in the application is measured
+    while a streamed response is sent.
+    """
+
+    def __init__(self, middleware, environ):
+        self.middleware = middleware
+        self.resource = middleware._resource(environ)
+        self.method = environ.get("REQUEST_METHOD", "GET")
+        self.path = environ.get("PATH_INFO", "")
+        self.started = time.time()
+        self.duration = 0.0
+        self.profiler = cProfile.Profile()
+        self.sampler = StackSampler(threading.get_ident(), middleware.interval)
+        self.sampler.start()
+        self._enabled_at = None
+
+    def enable(self):
+        self._enabled_at = time.perf_counter()
+        self.profiler.enable()
+
+    def disable(self):
+        self.profiler.disable()
+        self.duration += time.perf_counter() - self._enabled_at
+
+    def finish(self, status):
+        self.sampler.stop()
+        self.middleware.write(self, status)
+
+
+class ProfiledResponse(object):
+    """
+    Wraps the response iterable of a profiled request and profiles the
+    generation of every chunk. The profile is written when the server
+    closes the response.
+    """
+
+    def __init__(self, response, profile, status):
+        self.response = response
+        self.profile = profile
+        self.status = status
+
+    def __iter__(self):
+        iterator = iter(self.response)
+        while True:
+            self.profile.enable()
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.profile.disable()
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.response, "close"):
+                self.response.close()
+        finally:
+            self.profile.finish(self.status[0] if self.status else 500)
+
+
+def list_profiles(directory, limit=None):
+    """
+    Returns the metadata of the profiles in directory, newest first.
+    """
+
+    try:
+        names = [name for name in os.listdir(directory) if name.endswith(METADATA)]
+    except FileNotFoundError:
+        return []
+    profiles = []
+    for name in sorted(names, reverse=True)[:limit]:
+        try:
+            with open(os.path.join(directory, name)) as f:
+                profiles.append(json.load(f))
+        except (FileNotFoundError, ValueError):
+            continue
+    return profiles
@@ -0,0 +1,97 @@
+class ValidationError(ValueError):
+    """
+    Raised when a document doesn't match its schema. Wraps the most relevant
+    jsonschema error so that handlers can catch it without importing
+    jsonschema, which is only loaded when the first document is validated.
+    """
+
+    def __init__(self, error):
+        super().__init__(str(error))
+        self.message = error.message
+        self.error = error
+
+
+class SchemaRegistry(object):
+    """
+    Keeps the JSON schema of each model together with a ready to use
+    validator for it. Models are registered once when the application starts
+    so that request handlers don't need to rebuild the schema dictionary,
+    check it against the metaschema and create a new validator every time a
+    document is validated. The same schema objects are used in the controls
+    of the responses.
+
+    jsonschema validators are only built, and the schema checked against its
+    metaschema, the first time they are needed so that starting the
+    application doesn't import jsonschema.
+    """
+
+    def __init__(self):
+        self._schemas = {}
+        self._validators = {}
+
+    def register(self, *models):
+        """
+        Builds the schema of each model. Models must have a static
+        get_schema method.
+
+        : param models: model classes to register
+        """
+
+        for model in models:
+            self.add(model, model.get_schema())
+
+    def add(self, key, schema):
+        """
+        Registers a schema. Used for schemas that don't belong to a single
+        model, like those of bulk operations.
+
+        : param key: a hashable used to look up the schema later
+        : param dict schema: the JSON schema
+        """
+
+        self._schemas[key] = schema
+        self._validators.pop(key, None)
+
+    def validator(self, key):
+        """
+        Returns the jsonschema validator of a registered schema, checking the
+        schema and creating the validator on first use.
+
+        : param key: a registered model class or schema key
+        """
+
+        validator = self._validators.get(key)
+        if validator is None:
+            from jsonschema.validators import validator_for
+
+            schema = self._schemas[key]
+            cls = validator_for(schema)
+            cls.check_schema(schema)
+            validator = self._validators[key] = cls(schema)
+        return validator
+
+    def schema(self, model):
+        """
+        Returns the registered schema of a model. The same dictionary is
+        returned every time so it must not be modified.
+
+        : param model: a registered model class or schema key
+        """
+
+        return self._schemas[model]
+
+    def validate(self, instance, model):
+        """
+        Validates a document against the schema of a model. Works like
+        jsonschema.validate: the most relevant error is raised wrapped in a
+        ValidationError.
+
+        : param instance: the document to validate
+        : param model: a registered model class or schema key
+        """
+
+        from jsonschema.exceptions import best_match
+
+        error = best_match(self.validator(model).iter_errors(instance))
+        if error is not None:
+            raise ValidationError(error)
@@ -0,0 +1,116 @@
+import html
+
+from sqlalchemy import Column, DDL, Float, Integer, MetaData, String, Table, event, func, literal_column
+
+# FTS5 external content table: it stores only the full text index and reads
+# the indexed values from the track table, which is kept in sync with
+# triggers so that bulk inserts made with Core are indexed too. It isn't
+# part of db.metadata because create_all can't create virtual tables.
+TRACK_FTS_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS track_fts USING fts5("
+    "title, lyrics, content='track', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS track_fts_insert AFTER INSERT ON track BEGIN "
+    "INSERT INTO track_fts(rowid, title, lyrics) VALUES (new.id, new.title, new.lyrics); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS track_fts_delete AFTER DELETE ON track BEGIN "
+    "INSERT INTO track_fts(track_fts, rowid, title, lyrics) "
+    "VALUES ('delete', old.id, old.title, old.lyrics); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS track_fts_update AFTER UPDATE OF title, lyrics ON track BEGIN "
+    "INSERT INTO track_fts(track_fts, rowid, title, lyrics) "
+    "VALUES ('delete', old.id, old.title, old.lyrics); "
+    "INSERT INTO track_fts(rowid, title, lyrics) VALUES (new.id, new.title, new.lyrics); "
+    "END",
+]
+
+track_fts = Table(
+    "track_fts", MetaData(),
+    Column("rowid", Integer, primary_key=True),
+    Column("title", String),
+    Column("lyrics", String),
+)
+
+# a match in the title counts this many times as much as one in the lyrics
+TITLE_WEIGHT = 2.0
+SNIPPET_TOKENS = 12
+# snippet() wraps matched words in these private use characters, which are
+# only turned into markup after the text has been escaped
+MATCH_START = "\ue000"
+MATCH_END = "\ue001"
+
+
+def install_track_fts(track_table):
+    """
+    Makes creating and dropping track_table also create and drop the full
+    text index and its triggers. Only done for SQLite.
+    """
+
+    for statement in TRACK_FTS_DDL:
+        event.listen(track_table, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+    event.listen(
+        track_table, "before_drop",
+        DDL("DROP TABLE IF EXISTS track_fts").execute_if(dialect="sqlite")
+    )
+
+
+def rebuild_track_fts(connection):
+    """
+    Creates the full text index and triggers if they are missing and rebuilds
+    the index from the track table. Needed for databases that were created
+    before the index existed.
+    """
+
+    for statement in TRACK_FTS_DDL:
+        connection.execute(statement)
+    connection.execute("INSERT INTO track_fts(track_fts) VALUES ('rebuild')")
+
+
+def match_expression(text):
+    """
+    Turns user input into an FTS5 query that matches rows containing all of
+    its words. Every word is quoted, so the input can't use (or break) the
+    FTS5 query syntax. Returns None if there are no words.
+    """
+
+    terms = ['"{}"'.format(word.replace('"', '""')) for word in text.split()]
+    return " ".join(terms) or None
+
+
+def matches(expression):
+    """
+    Returns the filter that selects the rows of track_fts matching an FTS5
+    query made with match_expression.
+    """
+
+    return literal_column("track_fts").match(expression)
+
+
+def rank():
+    """
+    Returns the bm25 score of the current match. Lower is better.
+    """
+
+    return func.bm25(literal_column("track_fts"), TITLE_WEIGHT, 1.0, type_=Float)
+
+
+def lyrics_snippet():
+    """
+    Returns a fragment of the lyrics around the matched words with the words
+    wrapped in MATCH_START and MATCH_END. The lyrics aren't escaped, so the
+    fragment must go through mark_snippet before it is sent.
+    """
+
+    return func.snippet(literal_column("track_fts"), 1, MATCH_START, MATCH_END, "…", SNIPPET_TOKENS)
+
+
+def mark_snippet(snippet, start="<mark>", end="</mark>"):
+    """
+    Escapes a fragment made by lyrics_snippet for HTML and wraps the matched
+    words in start and end instead of the markers. Only the markers become
+    markup, anything in the lyrics is text.
+    """
+
+    if snippet is None:
+        return None
+    return html.escape(snippet).replace(MATCH_START, start).replace(MATCH_END, end)
@@ -0,0 +1,141 @@
+import atexit
+import logging
+import queue
+import re
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from time import perf_counter
+
+from flask import current_app, has_request_context, request
+from sqlalchemy import event
+
+from serialization import dumps
+
+# statements that EXPLAIN QUERY PLAN is run for
+EXPLAINABLE = re.compile(r"\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b", re.I)
+# a plan line that reads a whole table without an index
+FULL_SCAN = re.compile(r"SCAN \w+$")
+# longer parameter values are cut to this many characters
+MAX_PARAMETER_LENGTH = 200
+
+
+class _NDJSONFormatter(logging.Formatter):
+
+    def format(self, record):
+        return dumps(record.msg).decode("utf-8")
+
+
+class _RecordQueueHandler(QueueHandler):
+
+    def prepare(self, record):
+        # the listener runs in this process, so the record doesn't need to
+        # be made picklable, and the dict is formatted by its handler
+        return record
+
+
+def _short(value):
+    if isinstance(value, bytes):
+        value = repr(value)
+    if isinstance(value, str) and len(value) > MAX_PARAMETER_LENGTH:
+        return value[:MAX_PARAMETER_LENGTH] + "…"
+    return value
+
+def _parameters(parameters):
+    if isinstance(parameters, dict):
+        return {key: _short(value) for key, value in parameters.items()}
+    return [_short(value) for value in parameters]
+
+
+class SlowQueryLog(object):
+    """
+    Logs every SQL statement that takes longer than threshold seconds as one
+    NDJSON line with its duration, bound parameters, the resource class,
+    method and path of the request it was run for and, on SQLite, the
+    output of EXPLAIN QUERY PLAN. The plan is read on the same connection
+    right after the statement, everything else happens off the request
+    thread: records are put on a queue and written to a rotating log file by
+    a QueueListener thread.
+
+    Only the two cursor listeners run for fast statements.
+    """
+
+    def __init__(self, path, threshold=0.1, max_bytes=10 * 1024 * 1024, backup_count=5):
+        self.threshold = threshold
+        # not registered with logging, every log has its own file
+        self.logger = logging.Logger("stadium.slow_queries", logging.INFO)
+        records = queue.SimpleQueue()
+        self.logger.addHandler(_RecordQueueHandler(records))
+        handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+        handler.setFormatter(_NDJSONFormatter())
+        self.listener = QueueListener(records, handler)
+        self.listener.start()
+        self._closed = False
+        atexit.register(self.close)
+
+    def close(self):
+        """
+        Writes the queued records and stops the writer thread.
+        """
+
+        if not self._closed:
+            self._closed = True
+            self.listener.stop()
+            for handler in self.listener.handlers:
+                handler.close()
+
+    def install(self, engine):
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+
+    @staticmethod
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # kept on the execution context, which is dropped with the statement
+        # even when it fails and the after listener never runs
+        if context is not None:
+            context.slow_query_started = perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "slow_query_started", None)
+        if started is None:
+            return
+        elapsed = perf_counter() - started
+        if elapsed < self.threshold:
+            return
+
+        record = {
+            "time": datetime.now(timezone.utc),
+            "duration_ms": round(elapsed * 1000, 3),
+            "statement": statement,
+            "executemany": executemany,
+        }
+        if executemany:
+            record["rows"] = len(parameters)
+            parameters = parameters[0] if parameters else ()
+        record["parameters"] = _parameters(parameters)
+        if has_request_context():
+            view = current_app.view_functions.get(request.endpoint)
+            record["resource"] = getattr(view, "view_class", view).__name__ if view else None
+            record["method"] = request.method
+            record["path"] = request.full_path.rstrip("?")
+        if conn.dialect.name == "sqlite" and EXPLAINABLE.match(statement):
+            record["plan"] = self._plan(cursor, statement, parameters, conn.dialect.dbapi.Error)
+            record["full_scan"] = any(FULL_SCAN.search(line) for line in record["plan"])
+        self.logger.info(record)
+
+    @staticmethod
+    def _plan(cursor, statement, parameters, dbapi_error):
+        """
+        Returns the lines of EXPLAIN QUERY PLAN for a statement, indented by
+        their depth in the plan tree.
+        """
+
+        try:
+            rows = cursor.connection.execute("EXPLAIN QUERY PLAN " + statement, parameters).fetchall()
+        except dbapi_error as e:
+            return ["EXPLAIN QUERY PLAN failed: {}".format(e)]
+        depths = {0: -1}
+        lines = []
+        for node, parent, unused, detail in rows:
+            depths[node] = depths.get(parent, -1) + 1
+            lines.append("  " * depths[node] + detail)
+        return lines
@@ -1,41 +1,50 @@
 
+import asyncio
+import gzip
 import json
 import os
+import re
 import pytest
 import tempfile
 import time
 from datetime import date, time
+from flask import request
 from jsonschema import validate
 from sqlalchemy.engine import Engine
 from sqlalchemy.engine import Engine
 from sqlalchemy import event
 from sqlalchemy.exc import IntegrityError, StatementError
 
-from app import app, db
-from app import Track, Choreography, Album, Artist
+from app import create_app, db
+from asgi import ASGIAdapter
+from app import Track, Choreography, Album, Artist, InStadiumBuilder
+from app import IMPORT_CHECKS, encode_cursor, response_cache, schemas
+from cache import ResponseCache
+from compression import CODINGS, negotiate
+from schemas import SchemaRegistry, ValidationError
+from serialization import ENCODERS, dumps
 
 
 
-@event.listens_for(Engine, "connect")
-def set_sqlite_pragma(dbapi_connection, connection_record):
-    cursor = dbapi_connection.cursor()
-    cursor.execute("PRAGMA foreign_keys=ON")
-    cursor.close()
-
 # based on http://flask.pocoo.org/docs/1.0/testing/
 # we don't need a client for database testing, just the db handle
 @pytest.fixture
 def client():
     db_fd, db_fname = tempfile.mkstemp()
-    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + db_fname
-    app.config["TESTING"] = True
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True
+    })
 
-    db.create_all()
-    _populate_db()
+    with app.app_context():
+        db.create_all()
+        _populate_db()
+        response_cache.clear()
 
-    yield app.test_client()
+        yield app.test_client()
 
-    db.session.remove()
+        db.session.remove()
+        db.engine.dispose()
     os.close(db_fd)
     os.unlink(db_fname)
 
@@ -122,7 +131,7 @@ def _get_artist_json2():
 
     
 def _get_track_json():
-    return {"title": "title1", "disc_number": "1", "track_number": "8"}
+    return {"title": "title1", "disc_number": 1, "track_number": 8}
 
 
 def _get_album_json():
@@ -232,9 +241,8 @@ def _check_control_put_method_track(ctrl, client, obj):
     schema = ctrl_obj["schema"]
     assert method == "put"
     assert encoding == "json"
-    body = _get_artist_json()
+    body = _get_track_json()
     body["title"] = obj["title"]
-    body["description"] = obj["description"]
     validate(body, schema)
     resp = client.put(href, json=body)
     assert resp.status_code == 204
@@ -288,6 +296,27 @@ def _check_control_post_method_artist(ctrl, client, obj):
 
 
 
+def _check_control_post_method_track(ctrl, client, obj):
+    """
+    Checks the POST control that adds a track to an album like the other
+    POST control checks, and that the new track can be found from the
+    Location of the response.
+    """
+
+    ctrl_obj = obj["@controls"][ctrl]
+    href = ctrl_obj["href"]
+    method = ctrl_obj["method"].lower()
+    encoding = ctrl_obj["encoding"].lower()
+    schema = ctrl_obj["schema"]
+    assert method == "post"
+    assert encoding == "json"
+    body = {"title": "posttrack", "disc_number": 1, "track_number": 9, "length": "00:02:00", "lyrics": "la"}
+    validate(body, schema)
+    resp = client.post(href, json=body)
+    assert resp.status_code == 201
+    assert client.get(resp.headers["Location"]).status_code == 200
+
+
 def _check_control_post_method_choreography(ctrl, client, obj):
     """
     Checks a POST type control from a JSON object be it root document or an item
@@ -310,6 +339,874 @@ def _check_control_post_method_choreography(ctrl, client, obj):
     resp = client.post(href, json=body)
     assert resp.status_code == 201
 
+def _full_scans(client, requests):
+    """
+    Sends each (method, url) request and runs EXPLAIN QUERY PLAN for every
+    SELECT, UPDATE and DELETE statement that was executed while handling
+    them. Returns the statements whose plan reads a whole table without an
+    index, together with the offending plan line.
+    """
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and re.match(r"\s*(SELECT|UPDATE|DELETE)", statement, re.I):
+            statements.append((statement, parameters))
+
+    event.listen(db.engine, "before_cursor_execute", record)
+    try:
+        for method, url in requests:
+            resp = client.open(url, method=method)
+            assert resp.status_code < 400, (method, url, resp.status_code)
+            resp.get_data()
+    finally:
+        event.remove(db.engine, "before_cursor_execute", record)
+
+    scans = []
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        for statement, parameters in statements:
+            cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+            for row in cursor.fetchall():
+                if re.match(r"SCAN \w+$", row[-1]):
+                    scans.append((row[-1], statement))
+    finally:
+        connection.close()
+    return scans
+
+
+class TestQueryPlans(object):
+    """
+    Tests that every query made by the resources can use an index.
+    """
+
+    def test_no_full_scans(self, client):
+        scans = _full_scans(client, [
+            ("GET", "/api/artists/"),
+            ("GET", "/api/artists/?sortby=unique_name"),
+            ("GET", "/api/artists/testartist/"),
+            ("GET", "/api/albums/"),
+            ("GET", "/api/albums/?sortby=artist"),
+            ("GET", "/api/albums/?sortby=release"),
+            ("GET", "/api/artists/testartist/albums/"),
+            ("GET", "/api/artists/testartist/albums/?sortby=title&tracks=true"),
+            ("GET", "/api/artists/testartist/albums/album1"),
+            ("GET", "/api/artists/testartist/albums/album1/1/8/"),
+            ("GET", "/api/choreographies/"),
+            ("GET", "/api/choreographies/chore/"),
+            ("GET", "/api/export/"),
+            ("GET", "/api/search/tracks/?q=tttttttttttttttttttt"),
+            ("GET", "/api/genres/rap/tracks/"),
+            ("GET", "/api/genres/rap/tracks/?stream=true"),
+            ("DELETE", "/api/choreographies/chore/"),
+            ("DELETE", "/api/artists/testartist/albums/album1/1/8/"),
+            ("DELETE", "/api/artists/testartist/albums/album1"),
+            ("DELETE", "/api/artists/testartist/"),
+        ])
+        assert scans == []
+
+
+def _record_queries(client, url):
+    """
+    Sends a GET request with an empty response cache and returns the SQL
+    statements that were executed to answer it.
+    """
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    response_cache.clear()
+    event.listen(db.engine, "before_cursor_execute", record)
+    try:
+        resp = client.get(url)
+        assert resp.status_code == 200, (url, resp.status_code)
+        resp.get_data()
+    finally:
+        event.remove(db.engine, "before_cursor_execute", record)
+    return statements
+
+def _count_queries(client, url):
+    return len(_record_queries(client, url))
+
+
+class TestQueryCounts(object):
+    """
+    Tests that the number of queries made by each resource doesn't depend on
+    the number of rows in its representation.
+    """
+
+    URLS = [
+        "/api/artists/",
+        "/api/artists/?stream=true",
+        "/api/artists/testartist/",
+        "/api/albums/",
+        "/api/albums/?sortby=artist",
+        "/api/albums/?stream=true",
+        "/api/artists/testartist/albums/",
+        "/api/artists/testartist/albums/?tracks=true",
+        "/api/artists/testartist/albums/album1",
+        "/api/artists/testartist/albums/album1/1/8/",
+        "/api/artists/testartist/albums/album1/1/8/lyrics/",
+        "/api/choreographies/",
+        "/api/choreographies/chore/",
+        "/api/export/",
+        "/api/search/tracks/?q=track",
+        "/api/genres/rap/tracks/",
+    ]
+
+    def test_query_counts(self, client):
+        before = {url: _count_queries(client, url) for url in self.URLS}
+
+        db_artist = Artist.query.filter_by(unique_name="testartist").first()
+        db_chore = Choreography.query.filter_by(name="chore").first()
+        for i in range(5):
+            db_album = _get_album("more-{}".format(i))
+            db_album.artist = Artist(name="more", unique_name="more-{}".format(i))
+            db_artist.albums.append(_get_album("other-{}".format(i)))
+            for db_target in (db_album, db_artist.albums[0]):
+                db_track = _get_track("more-{}".format(i))
+                db_track.track_number = i + 10
+                db_track.choreography = db_chore
+                db_track.album = db_target
+            db.session.add(db_album)
+            db.session.add(_get_choreography("more-{}".format(i)))
+        db.session.commit()
+
+        after = {url: _count_queries(client, url) for url in self.URLS}
+        assert after == before
+
+
+class TestApplicationFactory(object):
+    """
+    Tests that creating an application doesn't touch the database and that
+    the seed command fills it.
+    """
+
+    def test_seed(self):
+        db_fd, db_fname = tempfile.mkstemp()
+        app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname})
+        with app.app_context():
+            assert db.engine.table_names() == []
+
+            runner = app.test_cli_runner()
+            result = runner.invoke(args=["seed"])
+            assert result.exit_code == 0
+            assert Artist.query.count() == 4
+            assert Track.query.count() == 1
+
+            result = runner.invoke(args=["seed"])
+            assert result.exit_code == 1
+            assert "--reset" in result.output
+            result = runner.invoke(args=["seed", "--reset"])
+            assert result.exit_code == 0
+            assert Artist.query.count() == 4
+            db.session.remove()
+        os.close(db_fd)
+        os.unlink(db_fname)
+
+
+class TestStorageProfile(object):
+    """
+    Tests that the pragmas of the selected storage profile are applied to
+    every connection.
+    """
+
+    def test_profiles(self):
+        db_fd, db_fname = tempfile.mkstemp()
+        for profile, journal_mode, synchronous in [
+            ("dev", "delete", 2), ("production", "wal", 1), ("bulk-load", "wal", 0)
+        ]:
+            app = create_app({
+                "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+                "SQLITE_PROFILE": profile,
+                "SQLITE_PRAGMAS": {"cache_size": -1000}
+            })
+            with app.app_context():
+                assert db.session.execute("PRAGMA journal_mode").scalar() == journal_mode
+                assert db.session.execute("PRAGMA synchronous").scalar() == synchronous
+                assert db.session.execute("PRAGMA foreign_keys").scalar() == 1
+                assert db.session.execute("PRAGMA cache_size").scalar() == -1000
+                db.session.remove()
+                db.engine.dispose()
+        os.close(db_fd)
+        os.unlink(db_fname)
+
+        app = create_app({"SQLITE_PROFILE": "fast"})
+        with app.app_context():
+            with pytest.raises(ValueError):
+                db.engine
+
+
+def _metric(client, line):
+    """
+    Returns the value of the metric whose name and labels are line, or 0.
+    """
+
+    for text in client.get("/metrics").data.decode("utf-8").splitlines():
+        if text.startswith(line + " "):
+            return float(text.rsplit(" ", 1)[1])
+    return 0
+
+
+class TestMetrics(object):
+    """
+    Tests that requests are counted per resource, method and status with
+    their latency, size and SQL statements.
+    """
+
+    def test_metrics(self, client):
+        labels = 'resource="AlbumItem",method="GET"'
+        requests = _metric(client, 'http_requests_total{%s,status="200"}' % labels)
+        statements = _metric(client, "db_statements_per_request_sum{%s}" % labels)
+        response_cache.clear()
+        resp = client.get("/api/artists/testartist/albums/album1")
+        assert resp.status_code == 200
+        client.get("/api/artists/testartist/albums/no-such-album")
+
+        resp = client.get("/metrics")
+        assert resp.status_code == 200
+        assert resp.mimetype == "text/plain"
+        assert _metric(client, 'http_requests_total{%s,status="200"}' % labels) == requests + 1
+        assert _metric(client, 'http_requests_total{%s,status="404"}' % labels) >= 1
+        assert _metric(client, "db_statements_per_request_sum{%s}" % labels) > statements + 1
+        assert _metric(client, 'http_request_duration_seconds_bucket{%s,le="+Inf"}' % labels) >= 2
+        assert _metric(client, "http_response_size_bytes_sum{%s}" % labels) > 0
+        assert _metric(client, "response_cache_misses_total") > 0
+
+        app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://", "METRICS_ENABLED": False})
+        assert app.test_client().get("/metrics").status_code == 404
+
+
+def _asgi_request(adapter, method, path, query_string=b"", headers=(), body=b""):
+    """
+    Sends one request through an ASGI application and returns the messages
+    it sent.
+    """
+
+    scope = {
+        "type": "http", "http_version": "1.1", "method": method, "scheme": "http",
+        "path": path, "query_string": query_string, "root_path": "",
+        "headers": list(headers), "server": ("localhost", 80), "client": ("127.0.0.1", 5000),
+    }
+    received = [{"type": "http.request", "body": body[:1], "more_body": True},
+                {"type": "http.request", "body": body[1:]}]
+    sent = []
+
+    async def receive():
+        return received.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(adapter(scope, receive, send))
+    return sent
+
+
+class TestASGI(object):
+    """
+    Tests that the ASGI mode serves the same responses as the WSGI
+    application.
+    """
+
+    def test_get(self, client):
+        adapter = ASGIAdapter(client.application, workers=2)
+        sent = _asgi_request(adapter, "GET", "/api/artists/", b"limit=1")
+        assert [message["type"] for message in sent] == ["http.response.start", "http.response.body"]
+        assert sent[0]["status"] == 200
+        assert (b"Content-Type", b"application/vnd.mason+json") in sent[0]["headers"]
+        assert not sent[1].get("more_body", False)
+        assert sent[1]["body"] == client.get("/api/artists/?limit=1").data
+
+        sent = _asgi_request(adapter, "GET", "/api/artists/nobody/")
+        assert sent[0]["status"] == 404
+        assert json.loads(sent[1]["body"].decode("utf-8"))["@error"]
+        adapter.executor.shutdown()
+
+    def test_post(self, client):
+        adapter = ASGIAdapter(client.application, workers=2)
+        body = json.dumps(_get_choreography_json3()).encode("utf-8")
+        sent = _asgi_request(adapter, "POST", "/api/choreographies/", headers=[
+            (b"content-type", b"application/json"), (b"content-length", str(len(body)).encode("ascii"))
+        ], body=body)
+        assert sent[0]["status"] == 201
+        assert dict(sent[0]["headers"])[b"Location"].endswith(b"/api/choreographies/postchore/")
+        assert client.get("/api/choreographies/postchore/").status_code == 200
+        adapter.executor.shutdown()
+
+    def test_post_chunked(self, client):
+        """
+        Tests that a body sent chunked, without a Content-Length header, is
+        passed to the application in full.
+        """
+
+        adapter = ASGIAdapter(client.application, workers=2)
+        body = json.dumps(_get_choreography_json3()).encode("utf-8")
+        sent = _asgi_request(adapter, "POST", "/api/choreographies/", headers=[
+            (b"content-type", b"application/json"), (b"transfer-encoding", b"chunked")
+        ], body=body)
+        assert sent[0]["status"] == 201
+        assert client.get("/api/choreographies/postchore/").status_code == 200
+
+        body = json.dumps({"type": "choreography", "name": "chunked", "description": "d"}).encode("utf-8")
+        sent = _asgi_request(adapter, "POST", "/api/import/", headers=[
+            (b"content-type", b"application/x-ndjson"), (b"transfer-encoding", b"chunked")
+        ], body=body)
+        assert sent[0]["status"] == 200
+        assert client.get("/api/choreographies/chunked/").status_code == 200
+        adapter.executor.shutdown()
+
+    def test_write(self):
+        """
+        Tests that data passed to the write callable is sent before the
+        chunks of the returned iterable.
+        """
+
+        def application(environ, start_response):
+            write = start_response("200 OK", [("Content-Type", "text/plain")])
+            write(b"a")
+            write(b"b")
+            return [b"c", b"d"]
+
+        adapter = ASGIAdapter(application, workers=1)
+        sent = _asgi_request(adapter, "GET", "/")
+        assert sent[0]["status"] == 200
+        assert b"".join(message["body"] for message in sent[1:]) == b"abcd"
+        assert not sent[-1].get("more_body", False)
+        adapter.executor.shutdown()
+
+    def test_streamed(self, client, monkeypatch):
+        """
+        Tests that a streamed response is sent in several chunks.
+        """
+
+        monkeypatch.setattr("app.EXPORT_BATCH_SIZE", 1)
+        adapter = ASGIAdapter(client.application, workers=2)
+        sent = _asgi_request(adapter, "GET", "/api/export/")
+        assert sent[0]["status"] == 200
+        chunks = sent[1:]
+        assert len(chunks) > 1
+        assert all(chunk["more_body"] for chunk in chunks[:-1])
+        assert not chunks[-1].get("more_body", False)
+        assert b"".join(chunk["body"] for chunk in chunks) == client.get("/api/export/").data
+        adapter.executor.shutdown()
+
+
+class TestCompression(object):
+    """
+    Tests content negotiated compression and the compressed variants kept
+    in the response cache.
+    """
+
+    RESOURCE_URL = "/api/choreographies/"
+
+    def test_variant_size(self):
+        cache = ResponseCache(max_entries=10, max_bytes=10)
+        cache.put("a", "/a/", b"1234", "text/plain", '"1"')
+        cache.put_variant("a", '"1"', "gzip", b"12")
+        cache.put_variant("a", '"2"', "br", b"1")
+        assert cache.get("a").variants == {"gzip": b"12"}
+        assert cache.stats()["bytes"] == 6
+        cache.put_variant("a", '"1"', "br", b"12345")
+        assert cache.get("a") is None
+        assert cache.stats()["bytes"] == 0
+
+    def test_negotiate(self, client):
+        with client.application.test_request_context(headers={"Accept-Encoding": "gzip, br"}):
+            assert negotiate(request.accept_encodings) == list(CODINGS)[0]
+        with client.application.test_request_context(headers={"Accept-Encoding": "br;q=0.5, gzip"}):
+            assert negotiate(request.accept_encodings) == "gzip"
+        with client.application.test_request_context(headers={"Accept-Encoding": "identity"}):
+            assert negotiate(request.accept_encodings) is None
+
+    def test_get(self, client):
+        client.application.config["COMPRESSION_MIN_SIZE"] = 0
+        plain = client.get(self.RESOURCE_URL)
+        assert "Content-Encoding" not in plain.headers
+        assert "Accept-Encoding" in plain.headers["Vary"]
+
+        for i in range(2):
+            resp = client.get(self.RESOURCE_URL, headers={"Accept-Encoding": "gzip"})
+            assert resp.status_code == 200
+            assert resp.headers["Content-Encoding"] == "gzip"
+            assert "Accept-Encoding" in resp.headers["Vary"]
+            assert gzip.decompress(resp.data) == plain.data
+            assert resp.headers["ETag"] == plain.headers["ETag"][:-1] + '-gzip"'
+        assert response_cache.get((self.RESOURCE_URL, b"")).variants["gzip"] == resp.data
+
+        resp = client.get(self.RESOURCE_URL, headers={
+            "Accept-Encoding": "gzip", "If-None-Match": resp.headers["ETag"]
+        })
+        assert resp.status_code == 304
+        assert resp.headers["ETag"].endswith('-gzip"')
+
+        # not cacheable responses are compressed after the request
+        resp = client.get("/api/choreographies/nothing/", headers={"Accept-Encoding": "gzip"})
+        assert resp.status_code == 404
+        assert json.loads(gzip.decompress(resp.data).decode("utf-8"))["@error"]
+
+    def test_threshold(self, client):
+        client.application.config["COMPRESSION_MIN_SIZE"] = 1000000
+        resp = client.get(self.RESOURCE_URL, headers={"Accept-Encoding": "gzip"})
+        assert "Content-Encoding" not in resp.headers
+        assert json.loads(resp.data.decode("utf-8"))["items"]
+
+
+class TestSparseFields(object):
+    """
+    Tests ?fields= sparse fieldsets, that unselected columns are not read
+    and that lyrics are only read when they are asked for.
+    """
+
+    TRACK_URL = "/api/artists/testartist/albums/album1/1/8/"
+
+    def test_collections(self, client):
+        resp = client.get("/api/choreographies/?fields=name&limit=1")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [set(item) for item in body["items"]] == [{"name", "@controls"}]
+        assert "fields=name" in body["@controls"]["next"]["href"]
+        body = json.loads(client.get(body["@controls"]["next"]["href"]).data)
+        assert list(body["items"][0]) == ["name", "@controls"]
+
+        body = json.loads(client.get("/api/artists/?fields=unique_name,name").data)
+        assert list(body["items"][0]) == ["name", "unique_name", "@controls"]
+        body = json.loads(client.get("/api/albums/?fields=&sortby=release").data)
+        assert list(body["items"][0]) == ["@controls"]
+        body = json.loads(client.get("/api/artists/testartist/albums/?fields=artist").data)
+        assert body["items"][0]["artist"] == "testartist"
+        assert "title" not in body["items"][0]
+        body = json.loads(client.get("/api/search/tracks/?q=track1&fields=title").data)
+        assert list(body["items"][0]) == ["title", "@controls"]
+
+        statements = _record_queries(client, "/api/choreographies/?fields=name")
+        assert "description" not in statements[0]
+        resp = client.get("/api/choreographies/?fields=name,colour")
+        assert resp.status_code == 400
+
+    def test_items(self, client):
+        body = json.loads(client.get("/api/artists/testartist/albums/album1?fields=title&fields[track]=length").data)
+        assert body["title"] == "album1"
+        assert "release" not in body
+        assert [set(item) for item in body["items"]] == [{"length", "@controls"}]
+        body = json.loads(client.get("/api/choreographies/chore/?fields=description").data)
+        assert body["description"] == "descchore"
+        assert "name" not in body
+        assert client.get("/api/artists/testartist/?fields=id").status_code == 400
+
+    def test_lyrics(self, client):
+        statements = _record_queries(client, self.TRACK_URL)
+        assert "lyrics" not in statements[0]
+        body = json.loads(client.get(self.TRACK_URL).data)
+        assert "lyrics" not in body
+        assert body["@controls"]["stadium:lyrics"]["href"] == self.TRACK_URL + "lyrics/"
+
+        body = json.loads(client.get(self.TRACK_URL + "?fields=title,lyrics").data)
+        assert body["lyrics"] == "tttttttttttttttttttt"
+        assert "length" not in body
+        for url in ["/api/artists/testartist/", "/api/artists/testartist/albums/album1"]:
+            assert all("lyrics" not in statement for statement in _record_queries(client, url))
+
+        resp = client.get(self.TRACK_URL + "lyrics/")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["lyrics"] == "tttttttttttttttttttt"
+        assert body["@controls"]["up"]["href"] == self.TRACK_URL
+        assert body["@controls"]["edit"]["href"] == self.TRACK_URL
+        assert client.get("/api/artists/testartist/albums/album1/1/9/lyrics/").status_code == 404
+
+        # edits without lyrics keep them, edits with lyrics show up
+        resp = client.put(self.TRACK_URL, json=_get_track_json())
+        assert resp.status_code == 204
+        assert json.loads(client.get(self.TRACK_URL + "lyrics/").data)["lyrics"] == "tttttttttttttttttttt"
+        valid = _get_track_json()
+        valid["lyrics"] = "new words"
+        client.put(self.TRACK_URL, json=valid)
+        assert json.loads(client.get(self.TRACK_URL + "lyrics/").data)["lyrics"] == "new words"
+
+        records = [json.loads(line) for line in client.get("/api/export/").data.decode("utf-8").splitlines()]
+        assert records[-1]["lyrics"] == "new words"
+
+
+class TestBatch(object):
+    """
+    Tests running several requests in one batch with a shared transaction.
+    """
+
+    RESOURCE_URL = "/api/batch/"
+
+    def test_post(self, client):
+        etag = client.get("/api/choreographies/").headers["ETag"]
+        track = _get_track_json()
+        track["title"] = "batched"
+        resp = client.post(self.RESOURCE_URL, json={"requests": [
+            {"method": "GET", "href": "/api/artists/testartist/?fields=name"},
+            {"method": "POST", "href": "/api/choreographies/", "body": _get_choreography_json3()},
+            {"method": "PUT", "href": "/api/artists/testartist/albums/album1/1/8/", "body": track},
+            {"method": "GET", "href": "/api/choreographies/postchore/"},
+            {"method": "DELETE", "href": "/api/choreographies/nothing/"},
+            {"method": "POST", "href": "/api/artists/", "body": _get_artist_json()},
+            {"method": "GET", "href": "/api/batch/"},
+        ]})
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["committed"] is True
+        items = body["items"]
+        assert [item["status"] for item in items] == [200, 201, 204, 200, 404, 409, 405]
+        assert items[0]["body"]["name"] == "testartist"
+        assert items[0]["headers"]["Content-Type"] == "application/vnd.mason+json"
+        assert items[1]["headers"]["Location"].endswith("/api/choreographies/postchore/")
+        assert items[3]["body"]["description"] == "postdescchore"
+        assert items[4]["body"]["@error"]
+
+        assert client.get("/api/choreographies/postchore/").status_code == 200
+        assert json.loads(client.get("/api/artists/testartist/albums/album1/1/8/").data)["title"] == "batched"
+        assert client.get("/api/choreographies/").headers["ETag"] != etag
+
+    def test_atomic(self, client):
+        etag = client.get("/api/choreographies/").headers["ETag"]
+        resp = client.post(self.RESOURCE_URL, json={"atomic": True, "requests": [
+            {"method": "POST", "href": "/api/choreographies/", "body": _get_choreography_json3()},
+            {"method": "GET", "href": "/api/choreographies/"},
+            {"method": "POST", "href": "/api/choreographies/", "body": _get_choreography_json()},
+            {"method": "DELETE", "href": "/api/choreographies/chore/"},
+        ]})
+        body = json.loads(resp.data)
+        assert body["committed"] is False
+        assert [item["status"] for item in body["items"]] == [201, 200, 409, 424]
+        assert len(body["items"][1]["body"]["items"]) == 3
+        assert "ETag" not in body["items"][1]["headers"]
+
+        assert client.get("/api/choreographies/postchore/").status_code == 404
+        resp = client.get("/api/choreographies/")
+        assert resp.headers["ETag"] == etag
+        assert len(json.loads(resp.data)["items"]) == 2
+
+    def test_invalid(self, client):
+        resp = client.post(self.RESOURCE_URL, data="requests")
+        assert resp.status_code == 415
+        for document in [
+            {"requests": []},
+            {"requests": [{"method": "TRACE", "href": "/api/"}]},
+            {"requests": [{"method": "GET", "href": "http://example.com/api/"}]},
+        ]:
+            resp = client.post(self.RESOURCE_URL, json=document)
+            assert resp.status_code == 400
+        resp = client.post(self.RESOURCE_URL, json={"requests": [
+            {"method": "POST", "href": self.RESOURCE_URL, "body": {"requests": []}},
+            {"method": "GET", "href": "/api/export/"},
+        ]})
+        assert [item["status"] for item in json.loads(resp.data)["items"]] == [400, 400]
+
+        body = json.loads(client.get("/api/").data)
+        assert body["@controls"]["stadium:batch"]["href"] == self.RESOURCE_URL
+
+
+class TestBulkCollections(object):
+    """
+    Tests bulk updates and deletes of the choreography, artist and album
+    collections.
+    """
+
+    def test_patch(self, client):
+        etag = client.get("/api/choreographies/chore/").headers["ETag"]
+        resp = client.patch("/api/choreographies/", json={"items": [
+            {"key": "chore", "changes": {"description": "bulk"}},
+            {"key": "namemodified", "changes": {"name": "renamed"}},
+            {"key": "nothing", "changes": {"description": "bulk"}},
+            {"key": "chore", "changes": {"name": "twice"}},
+            {"key": "renamed", "changes": {"description": 1}},
+            {"key": "postchore", "changes": {}},
+        ]})
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["updated"] == 2
+        assert [item["status"] for item in body["items"]] == [204, 204, 404, 409, 400, 400]
+        assert body["items"][1]["@controls"]["self"]["href"] == "/api/choreographies/renamed/"
+
+        resp = client.get("/api/choreographies/chore/")
+        assert resp.headers["ETag"] != etag
+        assert json.loads(resp.data)["description"] == "bulk"
+        assert client.get("/api/choreographies/namemodified/").status_code == 404
+        assert client.get("/api/choreographies/renamed/").status_code == 200
+
+        resp = client.patch("/api/artists/", json={"items": [
+            {"key": "testartist", "changes": {"name": "bulk artist"}},
+        ]})
+        assert json.loads(resp.data)["items"][0]["status"] == 204
+        assert json.loads(client.get("/api/artists/testartist/").data)["name"] == "bulk artist"
+
+    def test_patch_albums(self, client):
+        client.get("/api/genres/rap/tracks/")
+        key = {"artist": "testartist", "title": "album1"}
+        resp = client.patch("/api/albums/", json={"items": [
+            {"key": key, "changes": {"title": "album2", "genre": "Jazz", "release": "2020-01-02"}},
+            {"key": {"artist": "testartist"}, "changes": {"title": "album3"}},
+            {"key": key, "changes": {"artist_id": 2}},
+            {"key": key, "changes": {"genre_id": 1}},
+            {"key": key, "changes": {"tracks": []}},
+        ]})
+        body = json.loads(resp.data)
+        assert [item["status"] for item in body["items"]] == [204, 400, 400, 400, 400]
+        assert body["items"][0]["key"] == key
+
+        body = json.loads(client.get("/api/artists/testartist/albums/album2").data)
+        assert body["genre"] == "Jazz"
+        assert body["release"] == "2020-01-02"
+        assert body["@controls"]["stadium:tracks-by-genre"]["href"] == "/api/genres/jazz/tracks/"
+        assert len(json.loads(client.get("/api/genres/jazz/tracks/").data)["items"]) == 1
+        assert len(json.loads(client.get("/api/genres/rap/tracks/").data)["items"]) == 0
+
+        # the new title is taken by the album that is renamed
+        album = _get_album()
+        album.artist = Artist.query.first()
+        db.session.add(album)
+        db.session.commit()
+        resp = client.patch("/api/albums/", json={"items": [
+            {"key": {"artist": "testartist", "title": "album1"}, "changes": {"title": "album2"}},
+            {"key": {"artist": "testartist", "title": "album2"}, "changes": {"release": "2021-13-01"}},
+        ]})
+        body = json.loads(resp.data)
+        assert body["updated"] == 0
+        assert [item["status"] for item in body["items"]] == [409, 400]
+
+    def test_delete(self, client):
+        resp = client.delete("/api/choreographies/", json={"items": [{"key": "chore"}, {"key": "nothing"}]})
+        body = json.loads(resp.data)
+        assert body["deleted"] == 1
+        assert [item["status"] for item in body["items"]] == [204, 404]
+        assert client.get("/api/choreographies/chore/").status_code == 404
+        # the tracks of a deleted choreography are kept
+        assert client.get("/api/artists/testartist/albums/album1/1/8/").status_code == 200
+
+        client.get("/api/albums/")
+        resp = client.delete("/api/artists/", json={"items": [{"key": "testartist"}]})
+        assert json.loads(resp.data)["deleted"] == 1
+        assert json.loads(client.get("/api/albums/").data)["items"] == []
+        assert client.get("/api/artists/testartist/albums/album1/1/8/").status_code == 404
+
+    def test_invalid(self, client):
+        resp = client.patch("/api/artists/", data="items")
+        assert resp.status_code == 415
+        for document in [{"items": []}, {"items": {}}, {"keys": ["chore"]}]:
+            resp = client.delete("/api/choreographies/", json=document)
+            assert resp.status_code == 400
+        resp = client.patch("/api/choreographies/", json={"items": [{"key": "chore"}]})
+        assert json.loads(resp.data)["items"][0]["status"] == 400
+
+        body = json.loads(client.get("/api/albums/").data)
+        assert body["@controls"]["stadium:bulk-edit"]["method"] == "PATCH"
+        assert body["@controls"]["stadium:bulk-delete"]["method"] == "DELETE"
+        validate({"items": [{"key": {"artist": "a", "title": "b"}, "changes": {"discs": 2}}]},
+            body["@controls"]["stadium:bulk-edit"]["schema"]
+        )
+
+    def test_batch(self, client):
+        resp = client.post("/api/batch/", json={"atomic": True, "requests": [
+            {"method": "PATCH", "href": "/api/choreographies/", "body": {"items": [
+                {"key": "chore", "changes": {"description": "batched"}},
+            ]}},
+            {"method": "GET", "href": "/api/choreographies/chore/"},
+        ]})
+        body = json.loads(resp.data)
+        assert body["committed"] is True
+        assert body["items"][1]["body"]["description"] == "batched"
+
+
+class TestSlowQueryLog(object):
+    """
+    Tests that statements over the threshold are logged with their
+    parameters, request and query plan, and that others are not.
+    """
+
+    def test_log(self, tmpdir):
+        for threshold, logged in [(0, True), (60, False)]:
+            log = tmpdir.join("slow-{}.ndjson".format(threshold))
+            app = create_app({
+                "SQLALCHEMY_DATABASE_URI": "sqlite:///" + str(tmpdir.join("db-{}".format(threshold))),
+                "SLOW_QUERY_LOG": str(log),
+                "SLOW_QUERY_THRESHOLD": threshold
+            })
+            with app.app_context():
+                db.create_all()
+                _populate_db()
+                db.session.remove()
+                response_cache.clear()
+                resp = app.test_client().get("/api/artists/testartist/albums/album1")
+                assert resp.status_code == 200
+                db.session.remove()
+                db.engine.dispose()
+            app.extensions["slow_query_log"].close()
+
+            records = [json.loads(line) for line in log.readlines()]
+            assert bool(records) == logged
+            if logged:
+                record = [r for r in records if r.get("resource") == "AlbumItem"][0]
+                assert record["method"] == "GET"
+                assert record["path"] == "/api/artists/testartist/albums/album1"
+                assert record["parameters"][:2] == ["testartist", "album1"]
+                assert record["duration_ms"] >= 0
+                assert any("USING INDEX" in line for line in record["plan"])
+                assert record["full_scan"] is False
+
+
+class TestRequestProfiling(object):
+    """
+    Tests that only requests with an allowed profiling header are profiled,
+    that the profiles are tagged and pruned, that the listing is
+    protected by the same header and that sampled profiles can be listed
+    with the profiles command.
+    """
+
+    def test_profiling(self, tmpdir):
+        app = create_app({
+            "SQLALCHEMY_DATABASE_URI": "sqlite://",
+            "PROFILE_DIR": str(tmpdir),
+            "PROFILE_TOKENS": ["secret"],
+            "PROFILE_KEEP": 2
+        })
+        with app.app_context():
+            db.create_all()
+            client = app.test_client()
+            with client.get("/api/artists/", headers={"X-Profile": "wrong"}):
+                pass
+            assert tmpdir.listdir() == []
+            for url in ["/api/artists/", "/api/choreographies/", "/api/albums/?stream=true"]:
+                with client.get(url, headers={"X-Profile": "secret"}) as resp:
+                    assert resp.status_code == 200
+            assert len(tmpdir.listdir()) == 6
+
+            resp = client.get("/admin/profiles/")
+            assert resp.status_code == 403
+            resp = client.get("/admin/profiles/", headers={"X-Profile": "secret"})
+            items = json.loads(resp.data)["items"]
+            assert [(item["resource"], item["method"]) for item in items] == [
+                ("AlbumCollection", "GET"), ("ChoreographyCollection", "GET")
+            ]
+            assert items[0]["path"] == "/api/albums/"
+            href = items[0]["@controls"]["collapsed"]["href"]
+            with client.get(href, headers={"X-Profile": "secret"}) as resp:
+                assert resp.status_code == 200
+                assert b";" in resp.data or resp.data == b""
+            with client.get(items[0]["@controls"]["pstats"]["href"], headers={"X-Profile": "secret"}) as resp:
+                assert resp.status_code == 200
+            db.session.remove()
+
+        app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://"})
+        assert app.test_client().get("/admin/profiles/").status_code == 404
+
+    def test_sampled_profiles_command(self, tmpdir):
+        app = create_app({
+            "SQLALCHEMY_DATABASE_URI": "sqlite://",
+            "PROFILE_DIR": str(tmpdir),
+            "PROFILE_SAMPLE_RATE": 1.0
+        })
+        with app.app_context():
+            db.create_all()
+            client = app.test_client()
+            with client.get("/api/artists/") as resp:
+                assert resp.status_code == 200
+            assert client.get("/admin/profiles/", headers={"X-Profile": ""}).status_code == 403
+            db.session.remove()
+
+        result = app.test_cli_runner().invoke(args=["profiles"])
+        assert result.exit_code == 0
+        assert "ArtistCollection GET /api/artists/ 200" in result.output
+        assert ".prof" in result.output
+
+        app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://"})
+        result = app.test_cli_runner().invoke(args=["profiles"])
+        assert result.exit_code != 0
+
+
+class TestSchemaRegistry(object):
+    """
+    Tests that the registry serves the same schemas as the models and
+    validates documents like jsonschema.validate does.
+    """
+
+    def test_validate(self):
+        registry = SchemaRegistry()
+        registry.register(Choreography, Artist)
+        assert registry.schema(Artist) == Artist.get_schema()
+        assert registry.schema(Artist) is registry.schema(Artist)
+        registry.validate(_get_choreography_json(), Choreography)
+        with pytest.raises(ValidationError) as e:
+            registry.validate({"name": "chore"}, Choreography)
+        assert "description" in str(e.value)
+
+
+class TestSerialization(object):
+    """
+    Tests that every available encoder writes dates and times and produces
+    the same bytes, and that responses use it.
+    """
+
+    DOCUMENT = InStadiumBuilder(
+        release=date(2020, 1, 2),
+        length=time(0, 3, 30),
+        items=[{"title": "\u00e9t\u00e9", "discs": 1, "genre": None}],
+    )
+
+    def test_encoders(self):
+        expected = b'{"release":"2020-01-02","length":"00:03:30","items":[{"title":"\xc3\xa9t\xc3\xa9","discs":1,"genre":null}]}'
+        for name, encode in ENCODERS.items():
+            assert encode(self.DOCUMENT) == expected, name
+            with pytest.raises(TypeError):
+                encode({"value": object()})
+        assert json.loads(dumps(self.DOCUMENT)) == json.loads(expected)
+
+    def test_response(self, client):
+        resp = client.get("/api/artists/testartist/albums/album1")
+        assert resp.status_code == 200
+        assert resp.data == dumps(json.loads(resp.data))
+        body = json.loads(resp.data)
+        assert body["release"] == "2021-11-12"
+        assert body["items"][0]["length"] == "00:03:40"
+
+
+class TestResponseCache(object):
+    """
+    Tests eviction and invalidation of the response cache.
+    """
+
+    def test_eviction(self):
+        cache = ResponseCache(max_entries=2, max_bytes=10)
+        cache.put("a", "/a/", b"1234", "text/plain")
+        cache.put("b", "/b/", b"1234", "text/plain")
+        assert cache.get("a").data == b"1234"
+        cache.put("c", "/c/", b"1234", "text/plain")
+        assert cache.get("b") is None
+        assert cache.get("a") is not None
+        cache.put("d", "/d/", b"123456789", "text/plain")
+        assert cache.get("a") is None
+        assert cache.get("c") is None
+        cache.put("e", "/e/", b"12345678901", "text/plain")
+        assert cache.get("e") is None
+        stats = cache.stats()
+        assert stats["entries"] == 1
+        assert stats["bytes"] == 9
+        assert stats["evictions"] == 3
+        assert stats["hits"] == 2
+        assert stats["misses"] == 4
+
+    def test_invalidate(self):
+        cache = ResponseCache()
+        cache.put(("/api/artists/x/", b""), "/api/artists/x/", b"1", "text/plain")
+        cache.put(("/api/artists/x/", b"limit=1"), "/api/artists/x/", b"1", "text/plain")
+        cache.put("album", "/api/artists/x/albums/y", b"1", "text/plain")
+        cache.put("other", "/api/artists/xy/", b"1", "text/plain")
+        cache.invalidate("/api/artists/x/")
+        assert cache.get(("/api/artists/x/", b"limit=1")) is None
+        assert cache.get("album") is not None
+        cache.invalidate_prefix("/api/artists/x/")
+        assert cache.get("album") is None
+        assert cache.get("other") is not None
+        assert cache.stats()["entries"] == 1
+
+
 class TestChoreographyCollection(object):
     """
     This class implements tests for each HTTP method in sensor collection
@@ -369,6 +1266,57 @@ class TestChoreographyCollection(object):
         valid.pop("description")
         resp = client.post(self.RESOURCE_URL, json=valid)
         assert resp.status_code == 400 
+
+    def test_get_paginated(self, client):
+        """
+        Tests keyset pagination. Walks the collection one item at a time by
+        following the next control, then walks back with the prev control.
+        Also checks that invalid query parameters result in 400.
+        """
+
+        resp = client.get(self.RESOURCE_URL + "?limit=1")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["name"] for item in body["items"]] == ["chore"]
+        assert "prev" not in body["@controls"]
+
+        resp = client.get(body["@controls"]["next"]["href"])
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["name"] for item in body["items"]] == ["namemodified"]
+        assert "next" not in body["@controls"]
+
+        resp = client.get(body["@controls"]["prev"]["href"])
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["name"] for item in body["items"]] == ["chore"]
+        assert "prev" not in body["@controls"]
+        assert "next" in body["@controls"]
+
+        resp = client.get(self.RESOURCE_URL + "?sortby=description")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?limit=0")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?after=notacursor")
+        assert resp.status_code == 400
+
+    def test_get_streamed(self, client, monkeypatch):
+        """
+        Tests the streaming mode. Uses a batch size of one so that the items
+        are written in several chunks, and checks that the chunks still form
+        one valid Mason document with all the controls and items.
+        """
+
+        monkeypatch.setattr("app.STREAM_BATCH_SIZE", 1)
+        resp = client.get(self.RESOURCE_URL + "?stream=true")
+        assert resp.status_code == 200
+        assert resp.is_streamed
+        body = json.loads(resp.data)
+        _check_namespace(client, body)
+        assert "stadium:add-choreography" in body["@controls"]
+        assert [item["name"] for item in body["items"]] == ["chore", "namemodified"]
+        for item in body["items"]:
+            _check_control_get_method("self", client, item)
         
         
 class TestChoreographyItem(object):
@@ -457,6 +1405,62 @@ class TestChoreographyItem(object):
 
 
 
+    def test_get_conditional(self, client):
+        """
+        Tests conditional GET. Checks that a matching If-None-Match, weak or
+        *, results in 304, that * doesn't hide a missing item and that a
+        write to the item changes the entity tag.
+        """
+
+        resp = client.get(self.RESOURCE_URL)
+        etag = resp.headers["ETag"]
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+        assert resp.headers["ETag"] == etag
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": "W/" + etag})
+        assert resp.status_code == 304
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": "*"})
+        assert resp.status_code == 304
+        resp = client.get(self.INVALID_URL, headers={"If-None-Match": "*"})
+        assert resp.status_code == 404
+        resp = client.get(self.MODIFIED_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+
+        resp = client.put(self.RESOURCE_URL, json={"name": "chore", "description": "new"})
+        assert resp.status_code == 204
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert resp.headers["ETag"] != etag
+        assert json.loads(resp.data)["description"] == "new"
+
+        resp = client.delete(self.RESOURCE_URL)
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 404
+
+    def test_get_cached(self, client):
+        """
+        Tests that repeated GETs are served from the response cache and that
+        writing to the item invalidates both the item and its collection.
+        """
+
+        collection_url = TestChoreographyCollection.RESOURCE_URL
+        client.get(self.RESOURCE_URL)
+        client.get(collection_url)
+        hits = response_cache.stats()["hits"]
+        resp = client.get(self.RESOURCE_URL)
+        assert json.loads(resp.data)["description"] == "descchore"
+        client.get(collection_url)
+        assert response_cache.stats()["hits"] == hits + 2
+
+        resp = client.put(self.RESOURCE_URL, json={"name": "chore", "description": "new"})
+        assert resp.status_code == 204
+        assert response_cache.stats()["entries"] == 0
+        resp = client.get(self.RESOURCE_URL)
+        assert json.loads(resp.data)["description"] == "new"
+        resp = client.get(collection_url)
+        assert "new" in [item["description"] for item in json.loads(resp.data)["items"]]
+
+
 class TestArtistCollection(object):
     """
     This class implements tests for each HTTP method in sensor collection
@@ -517,6 +1521,24 @@ class TestArtistCollection(object):
         resp = client.post(self.RESOURCE_URL, json=valid)
         assert resp.status_code == 400
        
+    def test_get_conditional(self, client):
+        """
+        Tests conditional GET on the collection. Adding an artist must change
+        the entity tag of the collection.
+        """
+
+        resp = client.get(self.RESOURCE_URL)
+        etag = resp.headers["ETag"]
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+        assert resp.data == b""
+
+        resp = client.post(self.RESOURCE_URL, json=_get_artist_json2())
+        assert resp.status_code == 201
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert len(json.loads(resp.data)["items"]) == 2
+
 class TestArtistItem(object):
     
     RESOURCE_URL = "/api/artists/testartist/"
@@ -600,38 +1622,134 @@ class TestArtistItem(object):
         
 
 
-""" class TestAlbumItem(object):
+class TestAlbumCollection(object):
+    """
+    Tests the collection of all albums.
+    """
+
+    RESOURCE_URL = "/api/albums/"
+
+    def test_get_paginated(self, client):
+        """
+        Tests the GET method with keyset pagination. Checks that albums
+        without an artist are left out and that cursors with values of the
+        wrong type result in 400.
+        """
+
+        album = _get_album("album2")
+        db.session.add(album)
+        db.session.add(_get_album("orphan"))
+        album.artist = Artist.query.first()
+        db.session.commit()
+
+        for sortby in ("title", "artist", "release"):
+            resp = client.get(self.RESOURCE_URL + "?limit=1&sortby=" + sortby)
+            assert resp.status_code == 200
+            body = json.loads(resp.data)
+            titles = [item["title"] for item in body["items"]]
+            resp = client.get(body["@controls"]["next"]["href"])
+            body = json.loads(resp.data)
+            titles += [item["title"] for item in body["items"]]
+            assert "next" not in body["@controls"]
+            assert sorted(titles) == ["album1", "album2"]
+
+        for sortby, values in [
+            ("release", [123, 1]), ("release", ["2021-02-31", 1]), ("release", ["2021-01-01", "1"]),
+            ("title", [{"a": 1}, 1]), ("title", ["album1", True]), ("artist", [None, 1]),
+        ]:
+            resp = client.get(self.RESOURCE_URL + "?sortby={}&after={}".format(sortby, encode_cursor(values)))
+            assert resp.status_code == 400
+
+    def test_get_streamed(self, client, monkeypatch):
+        """
+        Tests the streaming mode. Checks that dates are written in the
+        streamed items and that streams can't go backwards with ?before=.
+        """
+
+        monkeypatch.setattr("app.STREAM_BATCH_SIZE", 1)
+        album = _get_album("album2")
+        album.artist = Artist.query.first()
+        db.session.add(album)
+        db.session.commit()
+
+        resp = client.get(self.RESOURCE_URL + "?stream=true&sortby=release")
+        assert resp.status_code == 200
+        assert resp.is_streamed
+        body = json.loads(resp.data)
+        assert [(item["title"], item["release"]) for item in body["items"]] == [
+            ("album1", "2021-11-12"), ("album2", "2021-11-12")
+        ]
+        assert "stadium:add-album" in body["@controls"]
+
+        after = encode_cursor(["2021-11-12", Album.query.filter_by(title="album1").first().id])
+        body = json.loads(client.get(self.RESOURCE_URL + "?stream=true&sortby=release&after=" + after).data)
+        assert [item["title"] for item in body["items"]] == ["album2"]
+        resp = client.get(self.RESOURCE_URL + "?stream=true&sortby=release&before=" + after)
+        assert resp.status_code == 400
+
+
+class TestAlbumItem(object):
     
     RESOURCE_URL = "/api/artists/testartist/albums/album1"
     INVALID_URL = "/api/artists/non-name/albums/arist-none"
-    MODIFIED_URL = "/api/artists/testartist/albums/album2"
+    MODIFIED_URL = "/api/artists/testartist/albums/title2"
     
     def test_get(self, client):
-        
+        """
         Tests the GET method. Checks that the response status code is 200, and
         then checks that all of the expected attributes and controls are
         present, and the controls work. Also checks that all of the items from
         the DB popluation are present, and their controls.
-        
+        """
 
         resp = client.get(self.RESOURCE_URL)
         assert resp.status_code == 200
         body = json.loads(resp.data)
         assert body["title"] == "album1"
+        assert body["release"] == "2021-11-12"
         _check_namespace(client, body)
         _check_control_get_method("profile", client, body)
         _check_control_get_method("collection", client, body)
+        _check_control_get_method("author", client, body)
         _check_control_put_method_album("edit", client, body)
+        _check_control_post_method_track("stadium:add-track", client, body)
         _check_control_delete_method("stadium:delete", client, body)
         resp = client.get(self.INVALID_URL)
         assert resp.status_code == 404
 
+    def test_post(self, client):
+        """
+        Tests adding a track to the album with POST. Checks the error codes
+        and that the track is listed in the album afterwards.
+        """
+
+        valid = {"title": "new", "disc_number": 1, "track_number": 2, "length": "00:03:00", "lyrics": "..."}
+        resp = client.post(self.RESOURCE_URL, data=json.dumps(valid))
+        assert resp.status_code == 415
+        resp = client.post(self.INVALID_URL, json=valid)
+        assert resp.status_code == 404
+        for field, value in [("length", "99:00:00"), ("track_number", "2"), ("lyrics", None)]:
+            invalid = dict(valid, **{field: value})
+            if value is None:
+                del invalid[field]
+            resp = client.post(self.RESOURCE_URL, json=invalid)
+            assert resp.status_code == 400
+
+        client.get(self.RESOURCE_URL)
+        resp = client.post(self.RESOURCE_URL, json=valid)
+        assert resp.status_code == 201
+        assert resp.headers["Location"].endswith(self.RESOURCE_URL + "/1/2/")
+        body = json.loads(client.get(self.RESOURCE_URL).data)
+        assert [item["title"] for item in body["items"]] == ["new", "track1"]
+        resp = client.post(self.RESOURCE_URL, json=valid)
+        assert resp.status_code == 409
+
     def test_put(self, client):
-        
+        """
         Tests the PUT method. Checks all of the possible erroe codes, and also
         checks that a valid request receives a 204 response. Also tests that
-        when name is changed, the sensor can be found from a its new URI. 
-        
+        when title is changed, the album can be found from a its new URI. 
+        """
         
         valid = _get_album_json()
         
@@ -642,50 +1760,384 @@ class TestArtistItem(object):
         resp = client.put(self.INVALID_URL, json=valid)
         assert resp.status_code == 404
         
-    
-        
-        # test with valid (only change model)
-        valid["title"] = "title"
-        resp = client.put(self.RESOURCE_URL, json=valid)
-        assert resp.status_code == 204
-        
         # remove field for 400
         valid.pop("title")
+        valid["genre"] = "Rock"
         resp = client.put(self.RESOURCE_URL, json=valid)
         assert resp.status_code == 400
         
+        # dates that match the pattern but don't exist
+        resp = client.put(self.RESOURCE_URL, json={"title": "album1", "release": "2020-02-31"})
+        assert resp.status_code == 400
+
         valid = _get_album_json2()
+        valid["release"] = "2020-01-31"
         resp = client.put(self.RESOURCE_URL, json=valid)
+        assert resp.status_code == 204
         resp = client.get(self.MODIFIED_URL)
         assert resp.status_code == 200
         body = json.loads(resp.data)
         assert body["title"] == valid["title"]
+        assert body["release"] == valid["release"]
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 404
         
     def test_delete(self, client):
-        
+        """
         Tests the DELETE method. Checks that a valid request reveives 204
-        response and that trying to GET the sensor afterwards results in 404.
-        Also checks that trying to delete a sensor that doesn't exist results
+        response and that trying to GET the album afterwards results in 404.
+        Also checks that trying to delete an album that doesn't exist results
         in 404.
-    
+        """
         
         resp = client.delete(self.RESOURCE_URL)
         assert resp.status_code == 204
         resp = client.get(self.RESOURCE_URL)
         assert resp.status_code == 404
+        resp = client.get(self.RESOURCE_URL + "/1/8/")
+        assert resp.status_code == 404
         resp = client.delete(self.INVALID_URL)
         assert resp.status_code == 404
-         """
-          
-    
 
-    
 
-        
+class TestCatalogImport(object):
+
+    RESOURCE_URL = "/api/import/"
+
+    def test_record_check(self):
+        """
+        Tests that the quick check of import records never accepts a record
+        that jsonschema rejects, and accepts the usual valid records.
+        """
+
+        track = {"type": "track", "title": "t", "track_number": 1, "length": "00:03:00",
+                 "lyrics": "", "artist": "a", "album": "b", "choreography": None}
+        records = [
+            ("track", track),
+            ("track", dict(track, track_number=0)),
+            ("track", dict(track, track_number=True)),
+            ("track", dict(track, track_number="1")),
+            ("track", dict(track, length="3 minutes")),
+            ("track", dict(track, choreography=1)),
+            ("track", {key: value for key, value in track.items() if key != "lyrics"}),
+            ("album", {"type": "album", "title": "b", "release": "2020-01-01", "artist": "a"}),
+            ("album", {"type": "album", "title": "b", "release": "2020-01-01", "artist": "a", "discs": 1.5}),
+            ("choreography", {"type": "choreography", "name": "c", "description": "d"}),
+            ("choreography", {"type": "choreography", "name": "c"}),
+            ("artist", {"type": "artist", "name": "a", "unique_name": "a"}),
+        ]
+        accepted = []
+        for kind, record in records:
+            try:
+                schemas.validate(record, ("import", kind))
+                valid = True
+            except ValidationError:
+                valid = False
+            quick = IMPORT_CHECKS[kind](record)
+            assert valid or not quick
+            accepted.append(quick)
+        assert accepted == [True] + [False] * 6 + [True, False, True, False, True]
+
+    def test_post(self, client):
+        """
+        Tests the bulk import. Checks that valid records are imported and can
+        refer to each other and to existing rows, and that every invalid line
+        is reported with its line number.
+        """
+
+        lines = [
+            {"type": "choreography", "name": "wave", "description": "arms up"},
+            {"type": "artist", "name": "Scandal", "unique_name": "scandal"},
+            {"type": "album", "title": "Hello World", "release": "2014-12-03",
+                "artist": "scandal", "genre": "Rock"},
+            {"type": "track", "title": "Image", "track_number": 1, "length": "00:04:02",
+                "lyrics": "...", "artist": "scandal", "album": "Hello World",
+                "choreography": "wave"},
+            {"type": "track", "title": "Existing album", "disc_number": 2, "track_number": 1,
+                "length": "00:03:00", "lyrics": "...", "artist": "testartist", "album": "album1"},
+            {"type": "artist", "name": "dup", "unique_name": "testartist"},
+            {"type": "album", "title": "Nowhere", "release": "2014-12-03", "artist": "nobody"},
+            {"type": "track", "title": "Bad", "track_number": 1, "length": "4 minutes",
+                "lyrics": "", "artist": "scandal", "album": "Hello World"},
+            {"type": "track", "title": "Duplicate", "track_number": 8, "length": "00:03:00",
+                "lyrics": "", "artist": "testartist", "album": "album1"},
+            {"type": "genre", "name": "Rock"},
+            {"type": []},
+        ]
+        data = "\n".join(json.dumps(line) for line in lines) + "\nnot json\n"
+
+        resp = client.post(self.RESOURCE_URL, json=lines)
+        assert resp.status_code == 415
+
+        resp = client.post(self.RESOURCE_URL, data=data, content_type="application/x-ndjson")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["imported"] == {"choreography": 1, "artist": 1, "album": 1, "track": 2}
+        assert [error["line"] for error in body["errors"]] == [6, 7, 8, 9, 10, 11, 12]
+
+        resp = client.get("/api/artists/scandal/")
+        assert resp.status_code == 200
+        album = Album.query.filter_by(title="Hello World").first()
+        assert album.artist.unique_name == "scandal"
+        assert album.release == date(2014, 12, 3)
+        assert [track.title for track in album.tracks] == ["Image"]
+        assert album.tracks[0].choreography.name == "wave"
+        assert Track.query.filter_by(title="Existing album").first().album.title == "album1"
+
+        resp = client.post(self.RESOURCE_URL, data=b'{"type": "artist", "name": "\xff"}',
+            content_type="application/x-ndjson"
+        )
+        assert resp.status_code == 400
+
+
+class TestAlbumsByArtistCollection(object):
+
+    RESOURCE_URL = "/api/artists/testartist/albums/"
+
+    def test_get(self, client):
+        """
+        Tests that only the albums of the artist are listed, ordered by their
+        release and paginated, that track counts are embedded on request and
+        that only unknown artists are not found.
+        """
+
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["title"] for item in body["items"]] == ["album1"]
+        assert "track_count" not in body["items"][0]
+        _check_namespace(client, body)
+        _check_control_get_method("author", client, body)
+        _check_control_get_method("self", client, body["items"][0])
+
+        resp = client.get("/api/artists/testartist/")
+        href = json.loads(resp.data)["@controls"]["stadium:albums-by"]["href"]
+        assert href == self.RESOURCE_URL
+
+        db_artist = Artist.query.filter_by(unique_name="testartist").first()
+        for title, release in [("album2", date(1999, 1, 1)), ("album3", date(2030, 1, 1))]:
+            db_album = _get_album(title)
+            db_album.release = release
+            db_album.artist = db_artist
+            db.session.add(db_album)
+        db_other = _get_album("other")
+        db_other.artist = Artist(name="other", unique_name="other")
+        db.session.add(db_other)
+        db.session.commit()
+        response_cache.clear()
+
+        resp = client.get(self.RESOURCE_URL + "?limit=2&tracks=true")
+        body = json.loads(resp.data)
+        assert [item["title"] for item in body["items"]] == ["album2", "album1"]
+        assert [item["track_count"] for item in body["items"]] == [0, 1]
+        resp = client.get(body["@controls"]["next"]["href"])
+        body = json.loads(resp.data)
+        assert [item["title"] for item in body["items"]] == ["album3"]
+        assert body["items"][0]["track_count"] == 0
+        assert "next" not in body["@controls"]
+        resp = client.get(body["@controls"]["prev"]["href"])
+        body = json.loads(resp.data)
+        assert [item["title"] for item in body["items"]] == ["album2", "album1"]
+
+        resp = client.get(self.RESOURCE_URL + "?sortby=title&after=" + encode_cursor(["album3"]))
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["items"] == []
+
+        db.session.add(Artist(name="lonely", unique_name="lonely"))
+        db.session.commit()
+        resp = client.get("/api/artists/lonely/albums/")
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["items"] == []
+        resp = client.get("/api/artists/no-such-artist/albums/")
+        assert resp.status_code == 404
+
+
+class TestTracksByGenreCollection(object):
+
+    RESOURCE_URL = "/api/genres/rap/tracks/"
+
+    def test_get(self, client):
+        """
+        Tests that genres are matched regardless of case and spacing, that
+        the tracks are paginated album by album and that changing the genre
+        of an album moves its tracks.
+        """
+
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["genre"] == "Rap"
+        assert [item["title"] for item in body["items"]] == ["track1"]
+        _check_namespace(client, body)
+        _check_control_get_method("self", client, body["items"][0])
+        resp = client.get("/api/genres/no-such-genre/tracks/")
+        assert resp.status_code == 404
+
+        resp = client.get("/api/artists/testartist/albums/album1")
+        href = json.loads(resp.data)["@controls"]["stadium:tracks-by-genre"]["href"]
+        assert href == self.RESOURCE_URL
+
+        db_artist = Artist.query.first()
+        for title, genre in [("album2", " RAP "), ("album3", "rock")]:
+            db_album = _get_album(title)
+            db_album.genre = genre
+            db_album.artist = db_artist
+            db_album.tracks.append(_get_track(title + " track"))
+            db.session.add(db_album)
+        db.session.commit()
+        response_cache.clear()
+
+        resp = client.get("/api/genres/%20Rap/tracks/?limit=1")
+        body = json.loads(resp.data)
+        assert [item["title"] for item in body["items"]] == ["track1"]
+        resp = client.get(body["@controls"]["next"]["href"])
+        body = json.loads(resp.data)
+        assert [item["title"] for item in body["items"]] == ["album2 track"]
+        assert "next" not in body["@controls"]
+
+        valid = _get_album_json2()
+        valid["genre"] = "Rock"
+        resp = client.put("/api/artists/testartist/albums/album1", json=valid)
+        assert resp.status_code == 204
+        resp = client.get("/api/genres/rock/tracks/")
+        body = json.loads(resp.data)
+        assert body["genre"] == "rock"
+        assert [item["title"] for item in body["items"]] == ["track1", "album3 track"]
+
+
+class TestTrackSearch(object):
+
+    RESOURCE_URL = "/api/search/tracks/"
+
+    def test_snippet_escaped(self, client):
+        """
+        Tests that the lyrics in snippets are escaped for HTML and only the
+        marks of the matched words are markup.
+        """
+
+        db_track = _get_track("xss")
+        db_track.track_number = 2
+        db_track.lyrics = "<script>alert('boom')</script> & boom"
+        db_track.album = Album.query.first()
+        db.session.add(db_track)
+        db.session.commit()
+
+        body = json.loads(client.get(self.RESOURCE_URL + "?q=boom").data)
+        assert body["items"][0]["snippet"] == (
+            "&lt;script&gt;alert(&#x27;<mark>boom</mark>&#x27;)&lt;/script&gt; &amp; <mark>boom</mark>"
+        )
+
+    def test_get(self, client):
+        """
+        Tests that the search finds tracks by their lyrics and titles, ranks
+        and paginates the results, and that the index follows changes made
+        to the tracks.
+        """
+
+        resp = client.get(self.RESOURCE_URL + "?q=tttttttttttttttttttt")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert len(body["items"]) == 1
+        assert body["items"][0]["snippet"] == "<mark>tttttttttttttttttttt</mark>"
+        _check_namespace(client, body)
+        _check_control_get_method("self", client, body["items"][0])
+
+        db_album = Album.query.first()
+        for number, lyrics in enumerate(["la la la", "la di da", "da da da da"]):
+            db_track = _get_track("song {}".format(number))
+            db_track.track_number = number + 1
+            db_track.lyrics = lyrics
+            db_track.album = db_album
+            db.session.add(db_track)
+        db.session.commit()
+        response_cache.clear()
+
+        resp = client.get(self.RESOURCE_URL + "?q=da&limit=1")
+        body = json.loads(resp.data)
+        assert [item["title"] for item in body["items"]] == ["song 2"]
+        resp = client.get(body["@controls"]["next"]["href"])
+        body = json.loads(resp.data)
+        assert [item["title"] for item in body["items"]] == ["song 1"]
+        assert "next" not in body["@controls"]
+        resp = client.get(body["@controls"]["prev"]["href"])
+        body = json.loads(resp.data)
+        assert [item["title"] for item in body["items"]] == ["song 2"]
+
+        # all words must match, and the titles are indexed too
+        resp = client.get(self.RESOURCE_URL + "?q=la+da")
+        assert [item["title"] for item in json.loads(resp.data)["items"]] == ["song 1"]
+        resp = client.get(self.RESOURCE_URL + "?q=song+0")
+        assert [item["title"] for item in json.loads(resp.data)["items"]] == ["song 0"]
+
+        # the index follows updates and deletes
+        valid = _get_track_json()
+        valid["lyrics"] = "something else"
+        resp = client.put("/api/artists/testartist/albums/album1/1/8/", json=valid)
+        assert resp.status_code == 204
+        resp = client.get(self.RESOURCE_URL + "?q=tttttttttttttttttttt")
+        assert json.loads(resp.data)["items"] == []
+        resp = client.get(self.RESOURCE_URL + "?q=something")
+        assert len(json.loads(resp.data)["items"]) == 1
+        resp = client.delete("/api/artists/testartist/albums/album1/1/8/")
+        resp = client.get(self.RESOURCE_URL + "?q=something")
+        assert json.loads(resp.data)["items"] == []
+
+        # FTS5 syntax is treated as text
+        resp = client.get(self.RESOURCE_URL + '?q="la+OR+NEAR(')
+        assert resp.status_code == 200
+        resp = client.get(self.RESOURCE_URL + "?q=+")
+        assert resp.status_code == 400
+
+
+class TestCatalogExport(object):
+
+    RESOURCE_URL = "/api/export/"
+
+    def test_get(self, client, monkeypatch):
+        """
+        Tests the export in both formats. Uses a batch size of one so that
+        several batches are read, and checks that the exported records can be
+        imported back into an empty database.
+        """
+
+        monkeypatch.setattr("app.EXPORT_BATCH_SIZE", 1)
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        assert resp.is_streamed
+        assert resp.mimetype == "application/x-ndjson"
+        records = [json.loads(line) for line in resp.data.decode("utf-8").splitlines()]
+        assert [record["type"] for record in records] == [
+            "choreography", "choreography", "artist", "album", "track"
+        ]
+        assert records[3]["release"] == "2021-11-12"
+        assert records[4]["album"] == "album1"
+        assert records[4]["length"] == "00:03:40"
+        assert records[4]["choreography"] == "chore"
+
+        resp = client.get(self.RESOURCE_URL + "?format=csv")
+        assert resp.status_code == 200
+        rows = resp.data.decode("utf-8").splitlines()
+        assert rows[0].startswith("type,name,unique_name")
+        assert len(rows) == 6
+        assert rows[5].startswith("track,")
+
+        resp = client.get(self.RESOURCE_URL + "?format=xml")
+        assert resp.status_code == 400
+
+        for table in reversed(db.metadata.sorted_tables):
+            db.session.execute(table.delete())
+        db.session.commit()
+        data = "\n".join(json.dumps(record) for record in records)
+        resp = client.post("/api/import/", data=data, content_type="application/x-ndjson")
+        body = json.loads(resp.data)
+        assert body["errors"] == []
+        assert body["imported"] == {"choreography": 2, "artist": 1, "album": 1, "track": 1}
+
+
 class TestTrackItem(object):
 
     RESOURCE_URL = "/api/artists/testartist/albums/album1/1/8/"
-    INVALID_URL = "//api/artists/testartist/albums/album3/2/3/"
+    INVALID_URL = "/api/artists/testartist/albums/album3/2/3/"
     MODIFIED_URL = "/api/artists/testartist/albums/album1/1/2/"
 
     def test_get(self, client):
@@ -700,7 +2152,8 @@ class TestTrackItem(object):
         assert resp.status_code == 200
         body = json.loads(resp.data)
         assert body["title"] == "track1"
-        assert body["track_number"] == "8"
+        assert body["track_number"] == 8
+        assert body["length"] == "00:03:40"
         _check_namespace(client, body)
         _check_control_get_method("profile", client, body)
         _check_control_get_method("collection", client, body)
@@ -708,12 +2161,15 @@ class TestTrackItem(object):
         _check_control_delete_method("stadium:delete", client, body)
         resp = client.get(self.INVALID_URL)
         assert resp.status_code == 404
+        resp = client.get("/api/artists/testartist/albums/album1/1/x/")
+        assert resp.status_code == 404
 
     def test_put(self, client):
         """
         Tests the PUT method. Checks all of the possible erroe codes, and also
         checks that a valid request receives a 204 response. Also tests that
-        when name is changed, the sensor can be found from a its new URI.
+        when the track number is changed, the track can be found from its new
+        URI.
         """
 
         valid = _get_track_json()
@@ -725,29 +2181,31 @@ class TestTrackItem(object):
         resp = client.put(self.INVALID_URL, json=valid)
         assert resp.status_code == 404
 
-        # test with another choreography's name
-        valid["name"] = "chore"
-        resp = client.put(self.RESOURCE_URL, json=valid)
-        assert resp.status_code == 409
-
-        # test with valid (only change model)
-        valid["title"] = "titlechange"
-        valid["disc_number"] = "2"
+        # track numbers are integers
+        valid["track_number"] = "2"
         resp = client.put(self.RESOURCE_URL, json=valid)
-        assert resp.status_code == 204
+        assert resp.status_code == 400
 
         # remove field for 400
-        #valid.pop("name")
-        valid.pop("description")
+        valid.pop("track_number")
         resp = client.put(self.RESOURCE_URL, json=valid)
         assert resp.status_code == 400
 
-        valid = _get_choreography_json2()
+        # times that match the pattern but don't exist
+        resp = client.put(self.RESOURCE_URL, json=dict(_get_track_json(), length="99:00:00"))
+        assert resp.status_code == 400
+
+        valid = _get_track_json()
+        valid["title"] = "titlechange"
+        valid["track_number"] = 2
         resp = client.put(self.RESOURCE_URL, json=valid)
+        assert resp.status_code == 204
         resp = client.get(self.MODIFIED_URL)
         assert resp.status_code == 200
         body = json.loads(resp.data)
         assert body["title"] == valid["title"]
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 404
 
     def test_delete(self, client):
         """
@@ -762,5 +2220,20 @@ class TestTrackItem(object):
         assert resp.status_code == 404
         resp = client.delete(self.INVALID_URL)
         assert resp.status_code == 404
-             
-    
\ No newline at end of file
+
+    def test_parents_invalidated(self, client):
+        """
+        Tests that writing to a track drops the cached album, which embeds
+        the tracks, and the cached albums of the artist, which count them.
+        """
+
+        parent_urls = ["/api/artists/testartist/albums/album1", "/api/artists/testartist/albums/?tracks=true"]
+        for method, kwargs in [("put", {"json": dict(_get_track_json(), track_number=2)}), ("delete", {})]:
+            for url in parent_urls:
+                assert client.get(url).status_code == 200
+            entries = response_cache.stats()["entries"]
+            url = self.MODIFIED_URL if method == "delete" else self.RESOURCE_URL
+            resp = getattr(client, method)(url, **kwargs)
+            assert resp.status_code == 204
+            assert response_cache.stats()["entries"] == entries - len(parent_urls)
+
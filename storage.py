@@ -0,0 +1,113 @@
+import functools
+from collections import namedtuple
+
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+StorageProfile = namedtuple("StorageProfile", ["pragmas", "pool_size"])
+
+# key of the app.extensions entry holding the engine hooks of an application
+ENGINE_HOOKS = "storage_engine_hooks"
+
+# busy_timeout comes first because switching the journal mode needs a lock
+PROFILES = {
+    # close to SQLite's defaults, one connection per session
+    "dev": StorageProfile({
+        "busy_timeout": 5000,
+        "foreign_keys": "ON",
+    }, 0),
+    # readers don't block the writer, and connections are pooled so that
+    # their page cache survives between requests
+    "production": StorageProfile({
+        "busy_timeout": 5000,
+        "foreign_keys": "ON",
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -64 * 1024,
+        "mmap_size": 256 * 1024 * 1024,
+        "temp_store": "MEMORY",
+    }, 8),
+    # large imports where losing the last transactions on power failure is
+    # acceptable because the import can be run again
+    "bulk-load": StorageProfile({
+        "busy_timeout": 30000,
+        "foreign_keys": "ON",
+        "journal_mode": "WAL",
+        "synchronous": "OFF",
+        "cache_size": -256 * 1024,
+        "mmap_size": 1024 * 1024 * 1024,
+        "temp_store": "MEMORY",
+    }, 2),
+}
+
+
+def storage_profile(config):
+    """
+    Returns the storage profile selected by the SQLITE_PROFILE setting with
+    the individual pragmas of SQLITE_PRAGMAS applied on top of it. A
+    negative cache_size is in KiB, mmap_size is in bytes.
+
+    : param config: the application's configuration
+    """
+
+    name = config.get("SQLITE_PROFILE", "dev")
+    try:
+        profile = PROFILES[name]
+    except KeyError:
+        raise ValueError("Unknown SQLite storage profile {!r}, use one of: {}".format(
+            name, ", ".join(PROFILES)
+        ))
+    pragmas = dict(profile.pragmas)
+    pragmas.update(config.get("SQLITE_PRAGMAS") or {})
+    return profile._replace(pragmas=pragmas)
+
+
+def add_engine_hook(app, hook):
+    """
+    Makes hook get called with every engine that StorageSQLAlchemy creates
+    for app, for instance to add event listeners. Engines are created
+    lazily, so hooks can be added in create_app without connecting.
+    """
+
+    app.extensions.setdefault(ENGINE_HOOKS, []).append(hook)
+
+
+def _set_pragmas(pragmas, dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute("PRAGMA {}={}".format(name, value))
+    cursor.close()
+
+
+class StorageSQLAlchemy(SQLAlchemy):
+    """
+    SQLAlchemy extension that applies the application's storage profile to
+    SQLite engines. The pragmas are set by a connect listener, so every new
+    connection gets them, and profiles with a pool size keep file database
+    connections in a QueuePool instead of opening one for each session.
+    Other databases are not affected. Hooks added with add_engine_hook are
+    called with every new engine.
+    """
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        if sa_url.drivername.startswith("sqlite"):
+            profile = storage_profile(app.config)
+            if profile.pool_size and sa_url.database not in (None, "", ":memory:"):
+                options["poolclass"] = QueuePool
+                options["pool_size"] = profile.pool_size
+                options.setdefault("connect_args", {})["check_same_thread"] = False
+            # not an engine option, removed again in create_engine
+            options["sqlite_pragmas"] = profile.pragmas
+        options["engine_hooks"] = list(app.extensions.get(ENGINE_HOOKS, ()))
+        super().apply_driver_hacks(app, sa_url, options)
+
+    def create_engine(self, sa_url, engine_opts):
+        pragmas = engine_opts.pop("sqlite_pragmas", None)
+        hooks = engine_opts.pop("engine_hooks", ())
+        engine = super().create_engine(sa_url, engine_opts)
+        if pragmas:
+            event.listen(engine, "connect", functools.partial(_set_pragmas, pragmas))
+        for hook in hooks:
+            hook(engine)
+        return engine
@@ -0,0 +1,94 @@
+import itertools
+import os
+import threading
+
+
+class VersionCounters(object):
+    """
+    Keeps track of when tables and individual rows were last written so that
+    representations can be given an entity tag without reading them from the
+    database. Every bump takes the next value of a single process wide clock,
+    which means a tag built from several counters changes whenever any of
+    them is bumped. Rows are identified by the natural key used in their URL.
+
+    Counters only live in memory, so tags also include a random epoch that is
+    different for every process. Tags handed out before a restart therefore
+    never match. Writes made to the database without going through the API
+    are not noticed.
+
+    The API must be served by a single process. A write handled by one
+    process doesn't bump the counters of the others, which keep answering
+    304 and serving cached bodies for the tags they handed out themselves.
+    Threads share the counters, so threaded servers and the ASGI mode are
+    fine.
+
+    A thread can defer its bumps while it makes writes that are committed
+    later in one transaction, and apply or discard them once it knows the
+    outcome.
+    """
+
+    def __init__(self):
+        self.epoch = os.urandom(4).hex()
+        self._clock = itertools.count(1)
+        self._stamps = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def bump(self, table, *keys):
+        """
+        Marks a table, and optionally some of its rows, as modified. Must be
+        called by every write path after the change has been committed.
+
+        : param str table: name of the table that was written
+        : param keys: natural keys of the rows that were written
+        """
+
+        deferred = getattr(self._local, "deferred", None)
+        if deferred is not None:
+            deferred.append((table, keys))
+            return
+        with self._lock:
+            stamp = next(self._clock)
+            self._stamps[table] = stamp
+            for key in keys:
+                self._stamps[(table, key)] = stamp
+
+    def etag(self, *dependencies):
+        """
+        Builds an entity tag for a representation. Each dependency is either
+        a table name, for representations that cover the whole table, or a
+        (table, key) tuple for a single row. Rows and tables that have never
+        been written since the process started count as version 0.
+        """
+
+        stamps = self._stamps
+        return "{}-{}".format(
+            self.epoch, max(stamps.get(dependency, 0) for dependency in dependencies)
+        )
+
+    def defer(self):
+        """
+        Starts collecting the bumps made by this thread instead of applying
+        them, until end_deferred is called.
+        """
+
+        self._local.deferred = []
+
+    def deferred(self):
+        """
+        Returns the bumps this thread has deferred so far, or None if it
+        isn't deferring them.
+        """
+
+        return getattr(self._local, "deferred", None)
+
+    def end_deferred(self, apply):
+        """
+        Stops deferring the bumps of this thread. They are applied after
+        the writes have been committed, and dropped if they were rolled back.
+        """
+
+        deferred, self._local.deferred = self.deferred(), None
+        if apply:
+            for table, keys in deferred or ():
+                self.bump(table, *keys)